@@ -431,9 +431,16 @@ def gen_sh(
         resume_args = f"""--resume {resolve_path(resume_from_checkpoint)} {line_break}"""
 
 
+    ############# Gradient checkpointing args ########################
+    # Checkpointing recomputes the forward of a block in backward. 12G and 16G need it for all blocks, 20G+ only
+    # checkpoints the blocks whose activations do not fit in a 4GB budget (measured at startup)
+    if vram in ["12G", "16G"]:
+        checkpointing_policy = "all"
+    else:
+        checkpointing_policy = "budget:4"
+
     ############# Optimizer args ########################
-    # CRITICAL FIX: Do NOT use blocks_to_swap as it causes deadlocks (see SD_SCRIPTS_HANG_ANALYSIS.md)
-    # Instead, use gradient_checkpointing + split_mode + fp8 for memory optimization
+    # Block swap schedules the transfers on a CUDA stream with events (no worker thread), so it does not deadlock
 
     if vram == "16G":
         # 16G VRAM - No block swapping, use adafactor for memory efficiency
@@ -442,11 +449,10 @@ def gen_sh(
   --lr_scheduler constant_with_warmup {line_break}
   --max_grad_norm 0.0 {line_break}"""
     elif vram == "12G":
-        # 12G VRAM - Use split_mode to train only single blocks, no block swapping
+        # 12G VRAM - Swap 18 blocks between CPU and GPU, all blocks are trained
         optimizer = f"""--optimizer_type adafactor {line_break}
   --optimizer_args "relative_step=False" "scale_parameter=False" "warmup_init=False" {line_break}
-  --split_mode {line_break}
-  --network_args "train_blocks=single" {line_break}
+  --blocks_to_swap 18 {line_break}
   --lr_scheduler constant_with_warmup {line_break}
   --max_grad_norm 0.0 {line_break}"""
     else:
@@ -469,6 +475,8 @@ def gen_sh(
     clip_path = resolve_path("models/clip/clip_l.safetensors")
     t5_path = resolve_path("models/clip/t5xxl_fp16.safetensors")
     ae_path = resolve_path("models/vae/ae.sft")
+    # fp8 copy of the flow model, converted on the first run
+    fp8_cache_dir = resolve_path("models/fp8_cache")
     sh = f"""accelerate launch {line_break}
   --mixed_precision bf16 {line_break}
   --num_cpu_threads_per_process 1 {line_break}
@@ -483,6 +491,7 @@ def gen_sh(
   --max_data_loader_n_workers {workers} {line_break}
   --seed {seed} {line_break}
   --gradient_checkpointing {line_break}
+  --gradient_checkpointing_policy {checkpointing_policy} {line_break}
   --mixed_precision bf16 {line_break}
   --save_precision bf16 {line_break}
   --network_module networks.lora_flux {line_break}
@@ -491,6 +500,7 @@ def gen_sh(
   --cache_text_encoder_outputs {line_break}
   --cache_text_encoder_outputs_to_disk {line_break}
   --fp8_base {line_break}
+  --fp8_cache_dir {fp8_cache_dir} {line_break}
   --highvram {line_break}
   --max_train_epochs {max_train_epochs} {line_break}
   --save_every_n_epochs {save_every_n_epochs} {line_break}
@@ -1204,6 +1214,7 @@ def init_advanced():
         'max_data_loader_n_workers',
         'seed',
         'gradient_checkpointing',
+        'gradient_checkpointing_policy',
         'mixed_precision',
         'save_precision',
         'network_module',
@@ -1212,6 +1223,7 @@ def init_advanced():
         'cache_text_encoder_outputs',
         'cache_text_encoder_outputs_to_disk',
         'fp8_base',
+        'fp8_cache_dir',
         'highvram',
         'max_train_epochs',
         'save_every_n_epochs',
@@ -1230,6 +1242,7 @@ def init_advanced():
         'sample_every_n_steps',
         'max_grad_norm',
         'split_mode',
+        'blocks_to_swap',
         'network_args',
         'save_state',
         'resume'
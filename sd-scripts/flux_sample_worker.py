@@ -0,0 +1,341 @@
+# Sample image worker for FLUX.1 LoRA training
+#
+# runs in its own process, watches output_dir for new epoch/step checkpoints and renders the sample prompts with them,
+# so sampling does not stop the training loop. use with `--sample_worker` of flux_train_network.py, which saves the
+# cached text encoder outputs of the sample prompts to output_dir and skips sampling in the training process.
+#
+# run on a second GPU with CUDA_VISIBLE_DEVICES, on the training GPU at lower priority (`--nice`, `--max_vram_fraction`),
+# or on CPU with `--tiny_random_model` to test the pipeline without model files.
+
+import argparse
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from accelerate import Accelerator
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library.device_utils import init_ipex, clean_memory_on_device
+
+init_ipex()
+
+from library.utils import setup_logging, str_to_dtype
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+import networks.lora_flux as lora_flux
+from library import flux_models, flux_train_utils, flux_utils, strategy_base, strategy_flux, train_util
+
+WORKER_STATE_FILE = "sample_worker_state.json"
+
+
+def create_tiny_models(dtype: torch.dtype) -> Tuple[flux_models.Flux, flux_models.AutoEncoder]:
+    r"""
+    tiny FLUX and AE with random weights, for testing the worker on CPU
+    """
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=2.0,
+        num_heads=2,
+        depth=1,
+        depth_single_blocks=1,
+        axes_dim=[8, 12, 12],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    ae_params = flux_models.AutoEncoderParams(
+        resolution=64,
+        in_channels=3,
+        ch=32,
+        out_ch=3,
+        ch_mult=[1, 1, 1, 1],
+        num_res_blocks=1,
+        z_channels=16,
+        scale_factor=0.3611,
+        shift_factor=0.1159,
+    )
+    return flux_models.Flux(params).to(dtype), flux_models.AutoEncoder(ae_params).to(dtype)
+
+
+def create_tiny_te_outputs(prompts: List[Dict], dtype: torch.dtype, seq_len: int = 16) -> Dict[str, List[torch.Tensor]]:
+    te_outputs = {}
+    for prompt_dict in prompts:
+        for p in [prompt_dict.get("prompt", ""), prompt_dict.get("negative_prompt", "")]:
+            if p not in te_outputs:
+                generator = torch.Generator().manual_seed(len(te_outputs))
+                l_pooled = torch.randn(1, 32, generator=generator).to(dtype)
+                t5_out = torch.randn(1, seq_len, 32, generator=generator).to(dtype)
+                te_outputs[p] = [l_pooled, t5_out, torch.zeros(1, seq_len, 3), torch.ones(1, seq_len, dtype=torch.long)]
+    return te_outputs
+
+
+class SampleWorker:
+    def __init__(self, args: argparse.Namespace, accelerator: Accelerator, flux, ae, text_encoders, sample_prompts_te_outputs):
+        self.args = args
+        self.accelerator = accelerator
+        self.flux = flux
+        self.ae = ae
+        self.text_encoders = text_encoders
+        self.sample_prompts_te_outputs = sample_prompts_te_outputs
+        self.network: Optional[lora_flux.LoRANetwork] = None
+
+        self.save_dir = os.path.join(args.output_dir, "sample")
+        os.makedirs(self.save_dir, exist_ok=True)
+
+        output_name = args.output_name
+        epoch_name = re.escape(output_name or train_util.DEFAULT_EPOCH_NAME)
+        step_name = re.escape(output_name or train_util.DEFAULT_STEP_NAME)
+        last_name = re.escape(output_name or train_util.DEFAULT_LAST_OUTPUT_NAME)
+        self.epoch_pattern = re.compile(rf"^{epoch_name}-(\d{{6}})\.safetensors$")
+        self.step_pattern = re.compile(rf"^{step_name}-step(\d{{8}})\.safetensors$")
+        self.last_pattern = re.compile(rf"^{last_name}\.safetensors$")
+
+        # rendered checkpoints, kept in the sample directory so a restarted worker does not render them again
+        self.state_file = os.path.join(self.save_dir, WORKER_STATE_FILE)
+        self.done: Dict[str, int] = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self.done = json.load(f)
+        self.pending_sizes: Dict[str, int] = {}
+
+    def parse_checkpoint_name(self, filename: str) -> Optional[Tuple[Optional[int], Optional[int], bool]]:
+        r"""
+        returns (epoch, steps, is_last) of a checkpoint file name, or None if the file is not a checkpoint of this training
+        """
+        m = self.epoch_pattern.match(filename)
+        if m:
+            return int(m.group(1)), None, False
+        m = self.step_pattern.match(filename)
+        if m:
+            return None, int(m.group(1)), False
+        if self.last_pattern.match(filename):
+            return None, None, True
+        return None
+
+    def find_new_checkpoints(self) -> List[str]:
+        r"""
+        checkpoints which are not rendered yet, oldest first. a file is returned after its size is unchanged for one poll,
+        because the training process may still be writing it (`--async_save` writes to a .tmp file and renames it)
+        """
+        checkpoints = []
+        sizes = {}
+        for filename in os.listdir(self.args.output_dir):
+            if self.parse_checkpoint_name(filename) is None:
+                continue
+            path = os.path.join(self.args.output_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # removed by save_last_n_*
+            if self.done.get(filename) == stat.st_mtime_ns:
+                continue
+            sizes[filename] = stat.st_size
+            if self.pending_sizes.get(filename) == stat.st_size:
+                checkpoints.append((stat.st_mtime_ns, filename))
+        self.pending_sizes = sizes
+        return [filename for _, filename in sorted(checkpoints)]
+
+    def load_network(self, path: str):
+        weights_sd = load_file(path)
+        if not self.text_encoders:
+            te_keys = [key for key in weights_sd.keys() if key.startswith("lora_te")]
+            if te_keys:
+                logger.warning(
+                    f"LoRA for text encoders is ignored because cached text encoder outputs are used: {len(te_keys)} keys"
+                    f" / キャッシュされたText Encoder出力を使用するため、Text EncoderのLoRAは無視されます: {len(te_keys)}キー"
+                )
+                for key in te_keys:
+                    del weights_sd[key]
+
+        if self.network is None:
+            # LoRA modules are created and applied once, later checkpoints of the same training only replace the weights
+            text_encoders = self.text_encoders or []
+            self.network, _ = lora_flux.create_network_from_weights(1.0, None, self.ae, text_encoders, self.flux, weights_sd, True)
+            self.network.apply_to(text_encoders, self.flux, apply_text_encoder=len(text_encoders) > 0, apply_unet=True)
+            self.network.eval()
+            self.network.to(self.accelerator.device)
+
+        info = self.network.load_state_dict(weights_sd, strict=True)
+        logger.info(f"loaded LoRA weights from {path}: {info}")
+
+    def render(self, filename: str):
+        epoch, steps, is_last = self.parse_checkpoint_name(filename)
+        path = os.path.join(self.args.output_dir, filename)
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata() or {}
+        if is_last or epoch is None:
+            steps = int(metadata.get("ss_steps", steps or 0))
+        if is_last:
+            epoch = int(metadata["ss_epoch"]) if "ss_epoch" in metadata else None
+
+        logger.info(f"generating sample images for {filename} / サンプル画像生成: {filename}")
+        self.load_network(path)
+
+        prompts = train_util.load_prompts(self.args.sample_prompts)
+        with torch.no_grad(), self.accelerator.autocast():
+            for prompt_dicts in flux_train_utils.group_sample_prompts(prompts, self.args.sample_batch_size):
+                flux_train_utils.sample_image_inference_batch(
+                    self.accelerator,
+                    self.args,
+                    self.flux,
+                    self.text_encoders,
+                    self.ae,
+                    self.save_dir,
+                    prompt_dicts,
+                    epoch,
+                    steps,
+                    self.sample_prompts_te_outputs,
+                    None,
+                    None,
+                )
+        clean_memory_on_device(self.accelerator.device)
+
+        self.done[filename] = os.stat(path).st_mtime_ns
+        with open(self.state_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.done, f, indent=2)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def run(self):
+        logger.info(f"watching {self.args.output_dir} for checkpoints / チェックポイントを監視しています: {self.args.output_dir}")
+        while True:
+            checkpoints = self.find_new_checkpoints()
+            for filename in checkpoints:
+                self.render(filename)
+                if self.parse_checkpoint_name(filename)[2]:
+                    logger.info("the final model is sampled, exiting / 最終モデルのサンプルを生成しました。終了します")
+                    return
+            if self.args.once and len(self.pending_sizes) == len(checkpoints):
+                return  # no checkpoints are left for the next poll
+            time.sleep(self.args.poll_interval)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True, help="output_dir of the training / 学習の出力ディレクトリ")
+    parser.add_argument("--output_name", type=str, default=None, help="output_name of the training / 学習の出力名")
+    parser.add_argument("--sample_prompts", type=str, required=True, help="file for prompts / プロンプトのファイル")
+    parser.add_argument("--pretrained_model_name_or_path", type=str, default=None, help="FLUX.1 model / FLUX.1 モデル")
+    parser.add_argument("--ae", type=str, default=None, help="path to ae / aeのパス")
+    parser.add_argument(
+        "--clip_l",
+        type=str,
+        default=None,
+        help="path to clip_l, only needed if the prompts are not in the cached text encoder outputs"
+        " / clip_lのパス。プロンプトがText Encoder出力のキャッシュにない場合のみ必要",
+    )
+    parser.add_argument(
+        "--t5xxl",
+        type=str,
+        default=None,
+        help="path to t5xxl, only needed if the prompts are not in the cached text encoder outputs"
+        " / t5xxlのパス。プロンプトがText Encoder出力のキャッシュにない場合のみ必要",
+    )
+    parser.add_argument("--t5xxl_max_token_length", type=int, default=None, help="maximum token length for T5-XXL / T5-XXLの最大トークン長")
+    parser.add_argument("--apply_t5_attn_mask", action="store_true", help="apply attention mask to T5-XXL / T5-XXLにアテンションマスクを適用する")
+    parser.add_argument(
+        "--t5_trim_multiple",
+        type=int,
+        default=None,
+        help="cut the masked padding of T5-XXL outputs to a multiple of this value, requires --apply_t5_attn_mask"
+        " / T5-XXL出力のマスクされたパディングをこの値の倍数まで切り詰める。--apply_t5_attn_maskが必要",
+    )
+    parser.add_argument(
+        "--te_outputs",
+        type=str,
+        default=None,
+        help=f"cached text encoder outputs of the sample prompts, default is output_dir/{flux_train_utils.SAMPLE_PROMPTS_TE_OUTPUTS_FILE}"
+        f" / サンプルプロンプトのText Encoder出力のキャッシュ。デフォルトは output_dir/{flux_train_utils.SAMPLE_PROMPTS_TE_OUTPUTS_FILE}",
+    )
+    parser.add_argument("--dtype", type=str, default="bf16", help="dtype of the models / モデルのdtype")
+    parser.add_argument("--fp8_base", action="store_true", help="use fp8 for FLUX.1 model / FLUX.1 モデルにfp8を使う")
+    parser.add_argument("--cpu", action="store_true", help="render on CPU / CPUで生成する")
+    parser.add_argument(
+        "--nice", type=int, default=10, help="niceness of the worker process (POSIX only) / ワーカープロセスのnice値（POSIXのみ）"
+    )
+    parser.add_argument(
+        "--max_vram_fraction",
+        type=float,
+        default=None,
+        help="limit the VRAM used by the worker when sharing the GPU with the training / 学習とGPUを共有する場合のワーカーのVRAM使用率の上限",
+    )
+    parser.add_argument(
+        "--sample_batch_size",
+        type=int,
+        default=1,
+        help="max number of prompts with the same resolution, steps and guidance denoised in one batch"
+        " / 解像度、ステップ数、ガイダンスが同じプロンプトを1バッチで生成する最大数",
+    )
+    parser.add_argument("--poll_interval", type=float, default=10.0, help="seconds between polls / 監視の間隔（秒）")
+    parser.add_argument("--once", action="store_true", help="render the existing checkpoints and exit / 既存のチェックポイントを生成して終了する")
+    parser.add_argument(
+        "--tiny_random_model",
+        action="store_true",
+        help="use a tiny FLUX/AE with random weights and random text encoder outputs, for tests"
+        " / テスト用に、ランダムな重みの小さなFLUX/AEとランダムなText Encoder出力を使う",
+    )
+    return parser
+
+
+def main(args: argparse.Namespace):
+    if args.nice and hasattr(os, "nice"):
+        os.nice(args.nice)
+
+    dtype = torch.float32 if args.cpu else str_to_dtype(args.dtype)
+    mixed_precision = "no" if dtype == torch.float32 else ("bf16" if dtype == torch.bfloat16 else "fp16")
+    accelerator = Accelerator(cpu=args.cpu, mixed_precision=mixed_precision)
+    device = accelerator.device
+    if args.max_vram_fraction is not None and device.type == "cuda":
+        torch.cuda.set_per_process_memory_fraction(args.max_vram_fraction, device)
+
+    text_encoders = None
+    if args.tiny_random_model:
+        flux, ae = create_tiny_models(dtype)
+        sample_prompts_te_outputs = create_tiny_te_outputs(train_util.load_prompts(args.sample_prompts), dtype)
+    else:
+        _, flux = flux_utils.load_flow_model(args.pretrained_model_name_or_path, None if args.fp8_base else dtype, "cpu")
+        if args.fp8_base:
+            flux.to(torch.float8_e4m3fn)
+        ae = flux_utils.load_ae(args.ae, dtype, "cpu")
+
+        te_outputs_file = args.te_outputs or os.path.join(args.output_dir, flux_train_utils.SAMPLE_PROMPTS_TE_OUTPUTS_FILE)
+        sample_prompts_te_outputs = None
+        if os.path.isfile(te_outputs_file):
+            logger.info(f"load cached Text Encoder outputs: {te_outputs_file}")
+            sample_prompts_te_outputs = flux_train_utils.load_sample_prompts_te_outputs(te_outputs_file, device)
+
+        if args.clip_l is not None and args.t5xxl is not None:
+            _, is_schnell, _, _ = flux_utils.analyze_checkpoint_state(args.pretrained_model_name_or_path)
+            t5xxl_max_token_length = args.t5xxl_max_token_length or (256 if is_schnell else 512)
+            strategy_base.TokenizeStrategy.set_strategy(strategy_flux.FluxTokenizeStrategy(t5xxl_max_token_length))
+            strategy_base.TextEncodingStrategy.set_strategy(strategy_flux.FluxTextEncodingStrategy(args.apply_t5_attn_mask))
+            clip_l = flux_utils.load_clip_l(args.clip_l, dtype, device)
+            t5xxl = flux_utils.load_t5xxl(args.t5xxl, dtype, device)
+            text_encoders = [clip_l.eval(), t5xxl.eval()]
+        elif sample_prompts_te_outputs is None:
+            raise ValueError(
+                "cached Text Encoder outputs are not found, specify --clip_l and --t5xxl"
+                " / Text Encoder出力のキャッシュが見つかりません。--clip_l と --t5xxl を指定してください"
+            )
+
+    flux.eval().to(device)
+    ae.eval()  # moved to the device only while decoding
+
+    worker = SampleWorker(args, accelerator, flux, ae, text_encoders, sample_prompts_te_outputs)
+    worker.run()
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
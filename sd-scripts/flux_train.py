@@ -30,7 +30,7 @@ from library.device_utils import init_ipex, clean_memory_on_device
 init_ipex()
 
 from accelerate.utils import set_seed
-from library import deepspeed_utils, flux_train_utils, flux_utils, strategy_base, strategy_flux
+from library import deepspeed_utils, flux_models, flux_train_utils, flux_utils, strategy_base, strategy_flux
 from library.sd3_train_utils import FlowMatchEulerDiscreteScheduler
 
 import library.train_util as train_util
@@ -84,6 +84,16 @@ def train(args):
         "blocks_to_swap is not supported with cpu_offload_checkpointing / blocks_to_swapはcpu_offload_checkpointingと併用できません"
     )
 
+    if args.gradient_checkpointing_policy is not None:
+        flux_models.parse_gradient_checkpointing_policy(args.gradient_checkpointing_policy)  # raise if invalid
+        assert (
+            not args.cpu_offload_checkpointing
+        ), "gradient_checkpointing_policy is not supported with cpu_offload_checkpointing / gradient_checkpointing_policyはcpu_offload_checkpointingと併用できません"
+
+    assert (
+        not args.compile_blocks or not args.torch_compile
+    ), "compile_blocks is not supported with torch_compile / compile_blocksはtorch_compileと併用できません"
+
     cache_latents = args.cache_latents
     use_dreambooth_method = args.in_json is None
 
@@ -466,6 +476,21 @@ def train(args):
             accelerator.unwrap_model(flux).move_to_device_except_swap_blocks(accelerator.device)  # reduce peak memory usage
         optimizer, train_dataloader, lr_scheduler = accelerator.prepare(optimizer, train_dataloader, lr_scheduler)
 
+        flux_train_utils.apply_gradient_checkpointing_policy(
+            args,
+            accelerator,
+            accelerator.unwrap_model(flux),
+            train_dataset_group.get_resolutions(),
+            max(dataset.batch_size for dataset in train_dataset_group.datasets),
+        )
+        if args.compile_blocks:
+            # a bucket has a partial batch at the end if the batch size is larger than 1
+            max_batch_size = max(dataset.batch_size for dataset in train_dataset_group.datasets)
+            num_shapes = len(train_dataset_group.get_resolutions()) * (2 if max_batch_size > 1 else 1)
+            accelerator.unwrap_model(flux).compile_blocks(
+                args.dynamo_backend, args.compile_blocks_dynamic, args.compile_cache_dir, num_shapes
+            )
+
     # 実験的機能：勾配も含めたfp16学習を行う　PyTorchにパッチを当ててfp16でのgrad scaleを有効にする
     if args.full_fp16:
         # During deepseed training, accelerate not handles fp16/bf16|mixed precision directly via scaler. Let deepspeed engine do.
@@ -1,6 +1,7 @@
 import argparse
 import copy
 import math
+import os
 import random
 from typing import Any, Optional, Union
 
@@ -16,10 +17,13 @@ from library import (
     flux_models,
     flux_train_utils,
     flux_utils,
+    fp8_model_cache,
+    model_loading,
     sd3_train_utils,
     strategy_base,
     strategy_flux,
     train_util,
+    weight_server,
 )
 from library.utils import setup_logging
 
@@ -35,6 +39,8 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
         self.sample_prompts_te_outputs = None
         self.is_schnell: Optional[bool] = None
         self.is_swapping_blocks: bool = False
+        self.skip_loading_t5xxl: bool = False
+        self.skip_loading_ae: bool = False
 
     def assert_extra_args(
         self,
@@ -48,6 +54,12 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
         if args.fp8_base_unet:
             args.fp8_base = True  # if fp8_base_unet is enabled, fp8_base is also enabled for FLUX.1
 
+        if args.t5_trim_multiple and not args.apply_t5_attn_mask:
+            logger.warning(
+                "t5_trim_multiple is ignored without apply_t5_attn_mask, because the padding tokens are not masked"
+                " / apply_t5_attn_maskが指定されていないため、パディングトークンがマスクされずt5_trim_multipleは無視されます"
+            )
+
         if args.cache_text_encoder_outputs_to_disk and not args.cache_text_encoder_outputs:
             logger.warning(
                 "cache_text_encoder_outputs_to_disk is enabled, so cache_text_encoder_outputs is also enabled / cache_text_encoder_outputs_to_diskが有効になっているため、cache_text_encoder_outputsも有効になります"
@@ -84,20 +96,126 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
                 )
                 args.blocks_to_swap = 18  # 18 is safe for most cases
 
+        if args.gradient_checkpointing_policy is not None:
+            flux_models.parse_gradient_checkpointing_policy(args.gradient_checkpointing_policy)  # raise if invalid
+            assert (
+                not args.cpu_offload_checkpointing
+            ), "gradient_checkpointing_policy is not supported with cpu_offload_checkpointing / gradient_checkpointing_policyはcpu_offload_checkpointingと併用できません"
+            if not args.gradient_checkpointing:
+                logger.warning(
+                    "gradient_checkpointing_policy is ignored without gradient_checkpointing"
+                    " / gradient_checkpointingが指定されていないため、gradient_checkpointing_policyは無視されます"
+                )
+
+        assert (
+            not args.compile_blocks or not args.torch_compile
+        ), "compile_blocks is not supported with torch_compile / compile_blocksはtorch_compileと併用できません"
+
         train_dataset_group.verify_bucket_reso_steps(32)  # TODO check this
         if val_dataset_group is not None:
             val_dataset_group.verify_bucket_reso_steps(32)  # TODO check this
 
+        # T5XXL and AE are only needed to fill the caches if they are not used for sampling, skip them if the disk
+        # caches are complete. CLIP-L is always loaded, it is small and may be trained
+        dataset_groups = [train_dataset_group] + ([val_dataset_group] if val_dataset_group is not None else [])
+        encodes_sample_prompts = args.sample_prompts is not None
+        if args.cache_text_encoder_outputs_to_disk and not encodes_sample_prompts and args.base_weights is None:
+            te_caching_strategy = self.get_text_encoder_outputs_caching_strategy(args)
+            self.skip_loading_t5xxl = all(
+                [group.is_text_encoder_outputs_disk_cached(te_caching_strategy) for group in dataset_groups]
+            )
+        if args.cache_latents and args.cache_latents_to_disk and (not encodes_sample_prompts or args.sample_worker):
+            latents_caching_strategy = strategy_base.LatentsCachingStrategy.get_strategy()
+            self.skip_loading_ae = all([group.is_latents_disk_cached(latents_caching_strategy) for group in dataset_groups])
+        if self.skip_loading_t5xxl:
+            logger.info("all Text Encoder outputs are cached, T5XXL is not loaded / Text Encoderの出力がすべてキャッシュ済みのため、T5XXLを読み込みません")
+        if self.skip_loading_ae:
+            logger.info("all latents are cached, AE is not loaded / latentsがすべてキャッシュ済みのため、AEを読み込みません")
+
+        # the largest resolution and batch size for the activation budget of gradient checkpointing
+        self.resolutions = train_dataset_group.get_resolutions()
+        self.max_batch_size = max(dataset.batch_size for dataset in train_dataset_group.datasets)
+
     def load_target_model(self, args, weight_dtype, accelerator):
         # currently offload to cpu for some models
 
         # if the file is fp8 and we are using fp8_base, we can load it as is (fp8)
         loading_dtype = None if args.fp8_base else weight_dtype
 
+        # with fp8_cache_dir, FLUX (and T5-XXL with fp8_cache_t5xxl) is converted to fp8 once and the fp8 copy is loaded
+        flux_path = args.pretrained_model_name_or_path
+        t5xxl_path = args.t5xxl
+        if args.fp8_base and args.fp8_cache_dir is not None:
+            with accelerator.local_main_process_first():  # convert in one process
+                is_diffusers, _, _, ckpt_paths = flux_utils.analyze_checkpoint_state(flux_path)
+                if is_diffusers:
+                    logger.warning(
+                        "fp8 cache is not supported for Diffusers FLUX model / DiffusersのFLUXモデルはfp8キャッシュに対応していません"
+                    )
+                else:
+                    flux_path = fp8_model_cache.get_fp8_model_path(args.fp8_cache_dir, flux_path, ckpt_paths)
+                # T5-XXL is used in weight_dtype unless the file is fp8, the fp8 copy is a different model for the captions
+                if args.fp8_cache_t5xxl and not args.fp8_base_unet and not self.skip_loading_t5xxl:
+                    t5xxl_path = fp8_model_cache.get_fp8_model_path(args.fp8_cache_dir, t5xxl_path)
+                    if args.cache_text_encoder_outputs_to_disk:
+                        logger.warning(
+                            "T5XXL is used in fp8, recreate the Text Encoder outputs cached with another dtype"
+                            " / T5XXLをfp8で使用します。他のdtypeでキャッシュしたText Encoderの出力は作り直してください"
+                        )
+
+        # with use_weight_server, the models are mapped from the shared copies of tools/weight_server.py
+        clip_l_path = args.clip_l
+        ae_path = args.ae
+        if args.use_weight_server:
+            _, _, _, ckpt_paths = flux_utils.analyze_checkpoint_state(flux_path)
+            if ckpt_paths == [flux_path]:
+                flux_path = weight_server.resolve(flux_path)
+            else:
+                logger.warning(
+                    "weight server is not supported for Diffusers or sharded FLUX model"
+                    " / DiffusersまたはシャードされたFLUXモデルはウェイトサーバーに対応していません"
+                )
+            clip_l_path = weight_server.resolve(clip_l_path)
+            if not self.skip_loading_t5xxl:
+                t5xxl_path = weight_server.resolve(t5xxl_path)
+            if not self.skip_loading_ae:
+                ae_path = weight_server.resolve(ae_path)
+
+        # the models are read concurrently, the models which are not needed for the warm caches are not loaded
+        t5xxl_loading_dtype = None if args.fp8_base and not args.fp8_base_unet else weight_dtype  # fp8 file is loaded as is
+        disable_mmap = args.disable_mmap_load_safetensors
+        _, _, _, flux_paths = flux_utils.analyze_checkpoint_state(flux_path)
+
+        loader = model_loading.ModelLoader(
+            None if args.model_load_memory_budget is None else int(args.model_load_memory_budget * 1024**3)
+        )
         # if we load to cpu, flux.to(fp8) takes a long time, so we should load to gpu in future
-        self.is_schnell, model = flux_utils.load_flow_model(
-            args.pretrained_model_name_or_path, loading_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors
+        loader.add(
+            "flux",
+            lambda: flux_utils.load_flow_model(flux_path, loading_dtype, "cpu", disable_mmap=disable_mmap),
+            model_loading.estimate_loaded_size(flux_paths, loading_dtype),
+        )
+        loader.add(
+            "clip_l",
+            lambda: flux_utils.load_clip_l(clip_l_path, weight_dtype, "cpu", disable_mmap=disable_mmap),
+            model_loading.estimate_loaded_size([clip_l_path], weight_dtype),
         )
+        if not self.skip_loading_t5xxl:
+            # loading t5xxl to cpu takes a long time, so we should load to gpu in future
+            loader.add(
+                "t5xxl",
+                lambda: flux_utils.load_t5xxl(t5xxl_path, t5xxl_loading_dtype, "cpu", disable_mmap=disable_mmap),
+                model_loading.estimate_loaded_size([t5xxl_path], t5xxl_loading_dtype),
+            )
+        if not self.skip_loading_ae:
+            loader.add(
+                "ae",
+                lambda: flux_utils.load_ae(ae_path, weight_dtype, "cpu", disable_mmap=disable_mmap),
+                model_loading.estimate_loaded_size([ae_path], weight_dtype),
+            )
+        models = loader.run()
+
+        self.is_schnell, model = models["flux"]
         if args.fp8_base:
             # check dtype of model
             if model.dtype == torch.float8_e4m3fnuz or model.dtype == torch.float8_e5m2 or model.dtype == torch.float8_e5m2fnuz:
@@ -120,26 +238,20 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             logger.info(f"enable block swap: blocks_to_swap={args.blocks_to_swap}")
             model.enable_block_swap(args.blocks_to_swap, accelerator.device)
 
-        clip_l = flux_utils.load_clip_l(args.clip_l, weight_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors)
+        clip_l = models["clip_l"]
         clip_l.eval()
 
-        # if the file is fp8 and we are using fp8_base (not unet), we can load it as is (fp8)
-        if args.fp8_base and not args.fp8_base_unet:
-            loading_dtype = None  # as is
-        else:
-            loading_dtype = weight_dtype
+        t5xxl = models.get("t5xxl")
+        if t5xxl is not None:
+            t5xxl.eval()
+            if args.fp8_base and not args.fp8_base_unet:
+                # check dtype of model
+                if t5xxl.dtype == torch.float8_e4m3fnuz or t5xxl.dtype == torch.float8_e5m2 or t5xxl.dtype == torch.float8_e5m2fnuz:
+                    raise ValueError(f"Unsupported fp8 model dtype: {t5xxl.dtype}")
+                elif t5xxl.dtype == torch.float8_e4m3fn:
+                    logger.info("Loaded fp8 T5XXL model")
 
-        # loading t5xxl to cpu takes a long time, so we should load to gpu in future
-        t5xxl = flux_utils.load_t5xxl(args.t5xxl, loading_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors)
-        t5xxl.eval()
-        if args.fp8_base and not args.fp8_base_unet:
-            # check dtype of model
-            if t5xxl.dtype == torch.float8_e4m3fnuz or t5xxl.dtype == torch.float8_e5m2 or t5xxl.dtype == torch.float8_e5m2fnuz:
-                raise ValueError(f"Unsupported fp8 model dtype: {t5xxl.dtype}")
-            elif t5xxl.dtype == torch.float8_e4m3fn:
-                logger.info("Loaded fp8 T5XXL model")
-
-        ae = flux_utils.load_ae(args.ae, weight_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors)
+        ae = models.get("ae")
 
         return flux_utils.MODEL_VERSION_FLUX_V1, [clip_l, t5xxl], ae, model
 
@@ -208,23 +320,25 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             if not args.lowram:
                 # メモリ消費を減らす
                 logger.info("move vae and unet to cpu to save memory")
-                org_vae_device = vae.device
+                org_vae_device = vae.device if vae is not None else None  # None if not loaded
                 org_unet_device = unet.device
-                vae.to("cpu")
+                if vae is not None:
+                    vae.to("cpu")
                 unet.to("cpu")
                 clean_memory_on_device(accelerator.device)
 
             # When TE is not be trained, it will not be prepared so we need to use explicit autocast
             logger.info("move text encoders to gpu")
             text_encoders[0].to(accelerator.device, dtype=weight_dtype)  # always not fp8
-            text_encoders[1].to(accelerator.device)
+            if text_encoders[1] is not None:  # None if all outputs are cached to disk and T5XXL is not loaded
+                text_encoders[1].to(accelerator.device)
 
-            if text_encoders[1].dtype == torch.float8_e4m3fn:
-                # if we load fp8 weights, the model is already fp8, so we use it as is
-                self.prepare_text_encoder_fp8(1, text_encoders[1], text_encoders[1].dtype, weight_dtype)
-            else:
-                # otherwise, we need to convert it to target dtype
-                text_encoders[1].to(weight_dtype)
+                if text_encoders[1].dtype == torch.float8_e4m3fn:
+                    # if we load fp8 weights, the model is already fp8, so we use it as is
+                    self.prepare_text_encoder_fp8(1, text_encoders[1], text_encoders[1].dtype, weight_dtype)
+                else:
+                    # otherwise, we need to convert it to target dtype
+                    text_encoders[1].to(weight_dtype)
 
             with accelerator.autocast():
                 dataset.new_cache_text_encoder_outputs(text_encoders, accelerator)
@@ -249,19 +363,26 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
                                 )
                 self.sample_prompts_te_outputs = sample_prompts_te_outputs
 
+                if args.sample_worker and accelerator.is_main_process:
+                    te_outputs_file = os.path.join(args.output_dir, flux_train_utils.SAMPLE_PROMPTS_TE_OUTPUTS_FILE)
+                    logger.info(f"save Text Encoder outputs for sample worker: {te_outputs_file}")
+                    flux_train_utils.save_sample_prompts_te_outputs(te_outputs_file, sample_prompts_te_outputs)
+
             accelerator.wait_for_everyone()
 
             # move back to cpu
             if not self.is_train_text_encoder(args):
                 logger.info("move CLIP-L back to cpu")
                 text_encoders[0].to("cpu")
-            logger.info("move t5XXL back to cpu")
-            text_encoders[1].to("cpu")
+            if text_encoders[1] is not None:
+                logger.info("move t5XXL back to cpu")
+                text_encoders[1].to("cpu")
             clean_memory_on_device(accelerator.device)
 
             if not args.lowram:
                 logger.info("move vae and unet back to original device")
-                vae.to(org_vae_device)
+                if vae is not None:
+                    vae.to(org_vae_device)
                 unet.to(org_unet_device)
         else:
             # Text Encoderから毎回出力を取得するので、GPUに乗せておく
@@ -286,6 +407,9 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
     #     return noise_pred
 
     def sample_images(self, accelerator, args, epoch, global_step, device, ae, tokenizer, text_encoder, flux):
+        if args.sample_worker:
+            return  # sampled by flux_sample_worker.py from the saved checkpoints
+
         text_encoders = text_encoder  # for compatibility
         text_encoders = self.get_models_for_text_encoding(args, accelerator, text_encoders)
 
@@ -357,10 +481,9 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             args, noise_scheduler, latents, noise, accelerator.device, weight_dtype
         )
 
-        # pack latents and get img_ids
+        # pack latents
         packed_noisy_model_input = flux_utils.pack_latents(noisy_model_input)  # b, c, h*2, w*2 -> b, h*w, c*4
         packed_latent_height, packed_latent_width = noisy_model_input.shape[2] // 2, noisy_model_input.shape[3] // 2
-        img_ids = flux_utils.prepare_img_ids(bsz, packed_latent_height, packed_latent_width).to(device=accelerator.device)
 
         # get guidance
         # ensure guidance_scale in args is float
@@ -372,13 +495,22 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             for t in text_encoder_conds:
                 if t is not None and t.dtype.is_floating_point:
                     t.requires_grad_(True)
-            img_ids.requires_grad_(True)
             guidance_vec.requires_grad_(True)
 
         # Predict the noise residual
         l_pooled, t5_out, txt_ids, t5_attn_mask = text_encoder_conds
         if not args.apply_t5_attn_mask:
             t5_attn_mask = None
+        elif args.t5_trim_multiple:
+            # cut the masked padding of T5 outputs, the attention runs over fewer tokens
+            length = flux_train_utils.get_trimmed_t5_length([t5_attn_mask], args.t5_trim_multiple)
+            t5_out, t5_attn_mask = flux_train_utils.trim_t5_outputs(length, t5_out, t5_attn_mask)
+
+        # txt_ids are zeros and img_ids depend only on the bucket, so the cached ids (and the cached pe in FLUX) are used.
+        # they do not require grad: the packed latents already do for gradient checkpointing
+        txt_ids, img_ids = flux_utils.get_position_ids(
+            bsz, t5_out.shape[1], packed_latent_height, packed_latent_width, accelerator.device
+        )
 
         def call_dit(img, img_ids, t5_out, txt_ids, l_pooled, timesteps, guidance_vec, t5_attn_mask):
             # grad is enabled even if unet is not in train mode, because Text Encoder is in train mode
@@ -426,12 +558,15 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             if len(diff_output_pr_indices) > 0:
                 network.set_multiplier(0.0)
                 unet.prepare_block_swap_before_forward()
+                prior_txt_ids, prior_img_ids = flux_utils.get_position_ids(
+                    len(diff_output_pr_indices), t5_out.shape[1], packed_latent_height, packed_latent_width, accelerator.device
+                )
                 with torch.no_grad():
                     model_pred_prior = call_dit(
                         img=packed_noisy_model_input[diff_output_pr_indices],
-                        img_ids=img_ids[diff_output_pr_indices],
+                        img_ids=prior_img_ids,
                         t5_out=t5_out[diff_output_pr_indices],
-                        txt_ids=txt_ids[diff_output_pr_indices],
+                        txt_ids=prior_txt_ids,
                         l_pooled=l_pooled[diff_output_pr_indices],
                         timesteps=timesteps[diff_output_pr_indices],
                         guidance_vec=guidance_vec[diff_output_pr_indices] if guidance_vec is not None else None,
@@ -521,14 +656,23 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
         self, args: argparse.Namespace, accelerator: Accelerator, unet: torch.nn.Module
     ) -> torch.nn.Module:
         if not self.is_swapping_blocks:
-            return super().prepare_unet_with_accelerator(args, accelerator, unet)
-
-        # if we doesn't swap blocks, we can move the model to device
-        flux: flux_models.Flux = unet
-        flux = accelerator.prepare(flux, device_placement=[not self.is_swapping_blocks])
-        accelerator.unwrap_model(flux).move_to_device_except_swap_blocks(accelerator.device)  # reduce peak memory usage
-        accelerator.unwrap_model(flux).prepare_block_swap_before_forward()
-
+            flux = super().prepare_unet_with_accelerator(args, accelerator, unet)
+        else:
+            # if we doesn't swap blocks, we can move the model to device
+            flux: flux_models.Flux = unet
+            flux = accelerator.prepare(flux, device_placement=[not self.is_swapping_blocks])
+            accelerator.unwrap_model(flux).move_to_device_except_swap_blocks(accelerator.device)  # reduce peak memory usage
+            accelerator.unwrap_model(flux).prepare_block_swap_before_forward()
+
+        flux_train_utils.apply_gradient_checkpointing_policy(
+            args, accelerator, accelerator.unwrap_model(flux), self.resolutions, self.max_batch_size
+        )
+        if args.compile_blocks:
+            # a bucket has a partial batch at the end if the batch size is larger than 1
+            num_shapes = len(self.resolutions) * (2 if self.max_batch_size > 1 else 1)
+            accelerator.unwrap_model(flux).compile_blocks(
+                args.dynamo_backend, args.compile_blocks_dynamic, args.compile_cache_dir, num_shapes
+            )
         return flux
 
 
@@ -0,0 +1,178 @@
+# background writer for model weights and training states
+#
+# the training loop only takes a CPU snapshot of the weights (or saves the state to a local staging directory) and
+# returns. writing, hashing, atomic renaming, uploading and removing old checkpoints are done in a worker thread.
+# the queue is bounded, so at most `max_pending` snapshots are held in memory; further saves wait for the worker.
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, Optional
+
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state_dict(state_dict: Dict[str, torch.Tensor], dtype: Optional[torch.dtype] = None) -> Dict[str, torch.Tensor]:
+    r"""
+    copy the state dict to CPU. tensors on CUDA are copied asynchronously to pinned memory and synchronized once at the end
+    """
+    snapshot = {}
+    synchronize = False
+    for key, value in state_dict.items():
+        value = value.detach()
+        target_dtype = dtype if dtype is not None else value.dtype
+        if value.device.type == "cuda":
+            buffer = torch.empty(value.shape, dtype=target_dtype, device="cpu", pin_memory=True)
+            buffer.copy_(value, non_blocking=True)
+            synchronize = True
+        else:
+            buffer = value.to(target_dtype, copy=True)
+        snapshot[key] = buffer
+    if synchronize:
+        torch.cuda.synchronize()
+    return snapshot
+
+
+def save_weights_atomic(file: str, state_dict: Dict[str, torch.Tensor], metadata: Optional[Dict[str, str]]):
+    r"""
+    write to a temporary file in the same directory and rename it, so readers never see a partial file.
+    same format as `save_weights` of the networks: safetensors with the model hashes, or torch.save
+    """
+    tmp_file = file + ".tmp"
+    if os.path.splitext(file)[1] == ".safetensors":
+        from library.utils import mem_eff_save_file
+
+        mem_eff_save_file(state_dict, tmp_file, metadata, add_model_hashes=True)
+    else:
+        torch.save(state_dict, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def recover_dir(dst_dir: str):
+    r"""
+    finish a `publish_dir` which was interrupted: the previous directory is moved back if the new one was not put in
+    place, otherwise it is removed
+    """
+    old_dir = dst_dir + ".old"
+    if not os.path.exists(old_dir):
+        return
+    if os.path.exists(dst_dir):
+        shutil.rmtree(old_dir)
+    else:
+        logger.warning(f"restore interrupted save: {old_dir} -> {dst_dir} / 中断された保存を復元します: {dst_dir}")
+        os.replace(old_dir, dst_dir)
+
+
+def publish_dir(src_dir: str, dst_dir: str):
+    r"""
+    move a directory to its final place. it is moved next to the destination first, so the final rename is atomic.
+    the previous directory is renamed aside and removed after the rename, so one of them exists at any time
+    """
+    recover_dir(dst_dir)
+    tmp_dir = dst_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    shutil.move(src_dir, tmp_dir)
+    old_dir = dst_dir + ".old"
+    if os.path.exists(dst_dir):
+        os.replace(dst_dir, old_dir)
+    os.replace(tmp_dir, dst_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+class AsyncCheckpointWriter:
+    def __init__(self, max_pending: int = 2, staging_dir: Optional[str] = None):
+        r"""
+        Args:
+            max_pending: maximum number of saves waiting for the worker, caps the memory used by snapshots
+            staging_dir: local directory for training states before they are moved to output_dir, system temp dir if None
+        """
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_pending))
+        self.staging_dir = staging_dir
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, name="checkpoint_writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                name, fn = job
+                try:
+                    fn()
+                except BaseException as e:
+                    logger.error(f"failed to save {name} / 保存に失敗しました: {e}")
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"background checkpoint writing failed / バックグラウンドでの保存に失敗しました: {error}") from error
+
+    def submit(self, name: str, fn: Callable[[], None]):
+        r"""
+        run `fn` in the worker after the previously submitted jobs. blocks while the queue is full
+        """
+        self._raise_if_failed()
+        self.queue.put((name, fn))
+
+    def save_weights(
+        self,
+        file: str,
+        state_dict: Dict[str, torch.Tensor],
+        dtype: Optional[torch.dtype],
+        metadata: Optional[Dict[str, str]],
+        after: Optional[Callable[[], None]] = None,
+    ):
+        snapshot = snapshot_state_dict(state_dict, dtype)
+        metadata = dict(metadata) if metadata else None  # metadata is updated by the training loop for the next save
+
+        def job():
+            save_weights_atomic(file, snapshot, metadata)
+            logger.info(f"checkpoint saved: {file}")
+            if after is not None:
+                after()
+
+        self.submit(file, job)
+
+    def save_state(self, accelerator, state_dir: str, after: Optional[Callable[[], None]] = None):
+        r"""
+        save the state with accelerate to the local staging directory, then move it to `state_dir` in the worker.
+        accelerate writes the state in its own layout, so the state is staged on disk instead of snapshotted in memory
+        """
+        if self.staging_dir is not None:
+            os.makedirs(self.staging_dir, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=os.path.basename(state_dir) + "-", dir=self.staging_dir)
+        accelerator.save_state(staging)
+
+        def job():
+            publish_dir(staging, state_dir)
+            logger.info(f"state saved: {state_dir}")
+            if after is not None:
+                after()
+
+        self.submit(state_dir, job)
+
+    def wait(self):
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,231 @@
+# reading cache files (latents / text encoder outputs npz) through a small I/O thread pool
+#
+# replaces the SIGALRM based timeout around np.load: signals only work in the main thread and cost syscalls per read.
+# reads are done by worker threads and the caller waits with a deadline, so a hung filesystem still fails fast.
+
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds of the latency histogram in milliseconds, the last bucket is unbounded
+HISTOGRAM_BOUNDS_MS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384]
+
+_config = {"max_workers": 4, "timeout": 30.0, "retries": 2, "backoff": 0.5, "max_prefetch": 64, "log_every": 0}
+
+
+def configure(
+    max_workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+    retries: Optional[int] = None,
+    backoff: Optional[float] = None,
+    log_every: Optional[int] = None,
+):
+    r"""
+    set the configuration of the reader. call this in the main process before DataLoader workers are started,
+    the workers inherit it when they are forked. the reader of the current process is recreated.
+    """
+    global _reader
+    for key, value in (
+        ("max_workers", max_workers),
+        ("timeout", timeout),
+        ("retries", retries),
+        ("backoff", backoff),
+        ("log_every", log_every),
+    ):
+        if value is not None:
+            _config[key] = value
+    if _reader is not None:
+        _reader.shutdown()
+        _reader = None
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.total_ms = 0.0
+
+    def add(self, ms: float):
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total_ms += ms
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, q: float) -> float:
+        r"""
+        upper bound of the bucket containing the q-th percentile (0 < q <= 100)
+        """
+        count = self.count
+        if count == 0:
+            return 0.0
+        threshold = count * q / 100.0
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= threshold:
+                return float(HISTOGRAM_BOUNDS_MS[i]) if i < len(HISTOGRAM_BOUNDS_MS) else float("inf")
+        return float("inf")
+
+    def to_dict(self) -> Dict[str, int]:
+        keys = [f"<={bound}ms" for bound in HISTOGRAM_BOUNDS_MS] + [f">{HISTOGRAM_BOUNDS_MS[-1]}ms"]
+        return dict(zip(keys, self.counts))
+
+
+class CacheReader:
+    r"""
+    reads whole files with a thread pool. each read has a deadline, failed reads are retried with exponential backoff,
+    and `prefetch` starts reads ahead of time so the following `read` only waits for the remaining time.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        timeout: float = 30.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_prefetch: int = 64,
+        log_every: int = 0,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_prefetch = max_prefetch
+        self.log_every = log_every
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cache_io")
+        self.prefetched: "OrderedDict[str, Future]" = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.histogram = LatencyHistogram()
+        self.num_errors = 0
+        self.num_timeouts = 0
+        self.num_retries = 0
+        self.num_prefetch_hits = 0
+
+    def _read_file(self, path: str, deadline: float) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # transient errors happen on network volumes, retry until the deadline
+                wait = self.backoff * (2**attempt)
+                if attempt >= self.retries or time.monotonic() + wait >= deadline:
+                    raise
+                with self.lock:
+                    self.num_retries += 1
+                attempt += 1
+                time.sleep(wait)
+
+    def _submit(self, path: str) -> Future:
+        deadline = time.monotonic() + self.timeout
+        return self.executor.submit(self._read_file, path, deadline)
+
+    def prefetch(self, paths: Iterable[str]):
+        with self.lock:
+            for path in paths:
+                if path is None or path in self.prefetched:
+                    continue
+                self.prefetched[path] = self._submit(path)
+                while len(self.prefetched) > self.max_prefetch:
+                    self.prefetched.popitem(last=False)  # unused prefetch is dropped, the thread finishes it anyway
+
+    def read(self, path: str) -> bytes:
+        start = time.monotonic()
+        with self.lock:
+            future = self.prefetched.pop(path, None)
+            if future is not None:
+                self.num_prefetch_hits += 1
+        if future is None:
+            future = self._submit(path)
+
+        try:
+            data = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.num_timeouts += 1
+            raise TimeoutError(f"Timeout reading {path} after {self.timeout} seconds. Check filesystem/network.")
+        except Exception:
+            with self.lock:
+                self.num_errors += 1
+            raise
+
+        with self.lock:
+            self.histogram.add((time.monotonic() - start) * 1000.0)
+            count = self.histogram.count
+        if self.log_every > 0 and count % self.log_every == 0:
+            self.log_stats()
+        return data
+
+    def load_npz(self, path: str):
+        return np.load(io.BytesIO(self.read(path)))
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "reads": self.histogram.count,
+                "mean_ms": self.histogram.total_ms / max(self.histogram.count, 1),
+                "p50_ms": self.histogram.percentile(50),
+                "p95_ms": self.histogram.percentile(95),
+                "p99_ms": self.histogram.percentile(99),
+                "errors": self.num_errors,
+                "timeouts": self.num_timeouts,
+                "retries": self.num_retries,
+                "prefetch_hits": self.num_prefetch_hits,
+                "histogram": self.histogram.to_dict(),
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        histogram = ", ".join(f"{k}: {v}" for k, v in stats.pop("histogram").items() if v > 0)
+        logger.info(f"cache reads: {stats}, latency histogram: {histogram}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_reader: Optional[CacheReader] = None
+_reader_pid: Optional[int] = None
+
+
+def get_cache_reader() -> CacheReader:
+    r"""
+    returns the reader of the current process. threads do not survive fork, so DataLoader workers create their own.
+    """
+    global _reader, _reader_pid
+    if _reader is None or _reader_pid != os.getpid():
+        _reader = CacheReader(**_config)
+        _reader_pid = os.getpid()
+    return _reader
+
+
+def load_npz(path: str):
+    return get_cache_reader().load_npz(path)
+
+
+def prefetch(paths: Iterable[str]):
+    get_cache_reader().prefetch(paths)
@@ -0,0 +1,161 @@
+# regional torch.compile: compiles the forward of each transformer block instead of the whole model. the model has
+# bucketed shapes, LoRA patched Linears and block swap, which break or recompile a whole model graph, while a block
+# graph is small, shared by the blocks of the same class and compiled once per shape.
+# the graph is shared only if dynamo traces the parameters as inputs (inline_inbuilt_nn_modules, PyTorch 2.5 or later).
+# before that, the parameters are constants of the graph and each block is compiled for each shape
+
+import os
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+import torch
+
+from library import step_profiler
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# graphs of a block for each shape: with grad for training, without grad for sampling and validation
+NUM_GRAD_MODES = 2
+# shapes which are not known when compiling: the sample images and the shapes of the unknown buckets
+EXTRA_SHAPES = 8
+DEFAULT_NUM_SHAPES = 32
+
+
+def enable_module_inlining() -> bool:
+    r"""
+    lets dynamo trace the parameters of the modules as graph inputs, so the blocks of the same class share the graphs.
+    returns False if the PyTorch does not support it
+    """
+    if not hasattr(torch._dynamo.config, "inline_inbuilt_nn_modules"):
+        return False
+    torch._dynamo.config.inline_inbuilt_nn_modules = True
+    return True
+
+
+def get_num_compiles() -> int:
+    r"""
+    number of frames compiled by dynamo in this process, including recompiles. a call served from the cache does not
+    count
+    """
+    from torch._dynamo.utils import counters
+
+    return counters["frames"]["ok"]
+
+
+def set_compile_cache_dir(cache_dir: str):
+    r"""
+    persists the compiled kernels and graphs of Inductor and Triton to `cache_dir`, so a resumed run with the same
+    shapes loads them instead of compiling again. call this before the first compile
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    os.environ["TORCHINDUCTOR_AUTOGRAD_CACHE"] = "1"  # PyTorch 2.6 or later
+
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autograd_cache"):
+        inductor_config.autograd_cache = True
+    logger.info(f"compile cache: {cache_dir} / コンパイルキャッシュ: {cache_dir}")
+
+
+class CompiledForward:
+    r"""
+    torch.compile'd replacement of a block's `_forward`. a call which compiles (or loads from the compile cache) is
+    recorded as a "compile" span in the step profiler
+
+    Args:
+        forward: the bound `_forward` of the block
+        name: name in the profiler, e.g. the class of the block
+        dynamic_dims: index of the argument -> dimension marked as dynamic (the token dimension). None to compile a
+            static graph for each shape
+    """
+
+    def __init__(
+        self,
+        forward: Callable,
+        name: str,
+        backend: str = "inductor",
+        dynamic_dims: Optional[Dict[int, int]] = None,
+    ):
+        self.name = name
+        self.dynamic_dims = dynamic_dims
+        self.compiled = torch.compile(forward, backend=backend, dynamic=False if dynamic_dims is None else None)
+
+    def __call__(self, *args):
+        if self.dynamic_dims is not None:
+            # maybe_mark_dynamic does not raise if the graph specializes the dimension
+            mark_dynamic = getattr(torch._dynamo, "maybe_mark_dynamic", torch._dynamo.mark_dynamic)
+            for index, dim in self.dynamic_dims.items():
+                if index < len(args) and isinstance(args[index], torch.Tensor):
+                    mark_dynamic(args[index], dim)
+
+        num_compiles = get_num_compiles()
+        start_ns = time.perf_counter_ns()
+        output = self.compiled(*args)
+        if get_num_compiles() != num_compiles:
+            shapes = tuple(tuple(a.shape) if isinstance(a, torch.Tensor) else a for a in args)
+            step_profiler.get_profiler().record(
+                "compile", start_ns, block=self.name, grad=torch.is_grad_enabled(), shape=str(shapes)
+            )
+        return output
+
+
+def get_cache_size_limit(blocks, num_shapes: Optional[int], dynamic: bool, inlined: bool) -> int:
+    r"""
+    graphs of the `_forward` code of a block class: one per shape and grad mode, and per block if the blocks do not share
+    the graphs. dynamo falls back to eager silently beyond the limit
+    """
+    num_graphs = NUM_GRAD_MODES * (1 if dynamic else (num_shapes or DEFAULT_NUM_SHAPES) + EXTRA_SHAPES)
+    if not inlined:
+        num_graphs *= max(Counter(block.__class__.__name__ for block in blocks).values())
+    return num_graphs
+
+
+def compile_blocks(
+    blocks,
+    backend: str = "inductor",
+    dynamic_dims: Optional[Dict[str, Dict[int, int]]] = None,
+    cache_dir: Optional[str] = None,
+    num_shapes: Optional[int] = None,
+):
+    r"""
+    replaces `_forward` of each block with a compiled one. the blocks must keep the checkpointing and swapping logic in
+    `forward` and the computation in `_forward`. LoRA should be applied before, its patched Linears are traced into the
+    graph of the block
+
+    Args:
+        dynamic_dims: class name of the block -> the dynamic dims for `CompiledForward`, None for static shapes
+        num_shapes: number of the input shapes in training (buckets and their partial batches), for the cache size
+            limit of dynamo. None for DEFAULT_NUM_SHAPES
+    """
+    if cache_dir is not None:
+        set_compile_cache_dir(cache_dir)
+    inlined = enable_module_inlining()
+    if not inlined:
+        logger.warning(
+            "this PyTorch does not share the compiled graphs between the blocks, each block is compiled. PyTorch 2.5 or later"
+            " is recommended / このPyTorchではブロック間でグラフが共有されず、ブロックごとにコンパイルされます。PyTorch 2.5以降を推奨します"
+        )
+    cache_size_limit = get_cache_size_limit(blocks, num_shapes, dynamic_dims is not None, inlined)
+    config = torch._dynamo.config
+    config.cache_size_limit = max(config.cache_size_limit, cache_size_limit)
+    if hasattr(config, "accumulated_cache_size_limit"):
+        config.accumulated_cache_size_limit = max(config.accumulated_cache_size_limit, cache_size_limit)
+
+    for block in blocks:
+        name = block.__class__.__name__
+        block._forward = CompiledForward(block._forward, name, backend, None if dynamic_dims is None else dynamic_dims.get(name))
+    logger.info(
+        f"compiled {len(blocks)} blocks with {backend}, {'dynamic' if dynamic_dims is not None else 'static'} shapes"
+        f" / {len(blocks)}ブロックを{backend}でコンパイルしました（{'動的' if dynamic_dims is not None else '静的'}形状）"
+    )
@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
 import time
 from typing import Optional, Union, Callable, Tuple
 import torch
@@ -16,7 +15,9 @@ def synchronize_device(device: torch.device):
         torch.mps.synchronize()
 
 
-def swap_weight_devices_cuda(device: torch.device, layer_to_cpu: nn.Module, layer_to_cuda: nn.Module):
+def _weight_swap_jobs(
+    device: torch.device, layer_to_cpu: nn.Module, layer_to_cuda: nn.Module
+) -> list[Tuple[nn.Module, nn.Module, torch.Tensor, torch.Tensor]]:
     assert layer_to_cpu.__class__ == layer_to_cuda.__class__
 
     weight_swap_jobs: list[Tuple[nn.Module, nn.Module, torch.Tensor, torch.Tensor]] = []
@@ -39,30 +40,64 @@ def swap_weight_devices_cuda(device: torch.device, layer_to_cpu: nn.Module, laye
                     #     f"Module {module_to_cuda_name} not found in CPU model or shape mismatch, so not swapping and moving to device"
                     # )
                     module_to_cuda.weight.data = module_to_cuda.weight.data.to(device)
+    return weight_swap_jobs
 
-    torch.cuda.current_stream().synchronize()  # this prevents the illegal loss value
 
-    stream = torch.Stream(device="cuda")
+def _cpu_buffer(cpu_buffers: Optional[dict], module: nn.Module, weight: torch.Tensor, pin_memory: bool) -> Tuple[torch.Tensor, bool]:
+    r"""
+    returns the persistent CPU buffer of the weight of `module`, and whether it already has the current weight. the buffer
+    is up to date if the weight is frozen: it was copied from (or to) the device and the device copy is not modified
+    """
+    buffer = cpu_buffers.get(module) if cpu_buffers is not None else None
+    if buffer is not None and buffer.shape == weight.shape and buffer.dtype == weight.dtype:
+        return buffer, not module.weight.requires_grad
+
+    buffer = torch.empty(weight.shape, dtype=weight.dtype, device="cpu", pin_memory=pin_memory)
+    if cpu_buffers is not None:
+        cpu_buffers[module] = buffer
+    return buffer, False
+
+
+def swap_weight_devices_cuda(
+    device: torch.device,
+    layer_to_cpu: nn.Module,
+    layer_to_cuda: nn.Module,
+    stream: Optional[torch.cuda.Stream] = None,
+    cpu_buffers: Optional[dict] = None,
+) -> torch.cuda.Event:
+    r"""
+    moves the weights of `layer_to_cpu` to CPU and the weights of `layer_to_cuda` to the device, reusing the device memory
+    of `layer_to_cpu`. the copies are queued on `stream` after the work queued on the current stream so far, and the host
+    does not wait for them: the current stream must wait for the returned event before `layer_to_cuda` is used.
+    `cpu_buffers` keeps the pinned CPU buffers of the weights, so that they are allocated once and frozen weights are not
+    copied back to CPU
+    """
+    weight_swap_jobs = _weight_swap_jobs(device, layer_to_cpu, layer_to_cuda)
+
+    stream = stream if stream is not None else torch.cuda.Stream(device=device)
+    stream.wait_stream(torch.cuda.current_stream(device))  # layer_to_cpu is not used after this point
     with torch.cuda.stream(stream):
         # cuda to cpu
         for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-            cuda_data_view.record_stream(stream)
-            module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True)
+            buffer, up_to_date = _cpu_buffer(cpu_buffers, module_to_cpu, cuda_data_view, pin_memory=True)
+            if not up_to_date:
+                buffer.copy_(cuda_data_view, non_blocking=True)
+            module_to_cpu.weight.data = buffer
 
-        stream.synchronize()
-
-        # cpu to cuda
+        # cpu to cuda, after the copies above on the same stream
         for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
             cuda_data_view.copy_(module_to_cuda.weight.data, non_blocking=True)
             module_to_cuda.weight.data = cuda_data_view
 
-    stream.synchronize()
-    torch.cuda.current_stream().synchronize()  # this prevents the illegal loss value
+    event = torch.cuda.Event()
+    event.record(stream)
+    return event
 
 
-def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, layer_to_cuda: nn.Module):
-    """
-    not tested
+def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, layer_to_cuda: nn.Module, cpu_buffers: Optional[dict] = None):
+    r"""
+    synchronous version of `swap_weight_devices_cuda` for the other devices. it also works with the CPU device, because the
+    weights are copied to separate CPU buffers
     """
     assert layer_to_cpu.__class__ == layer_to_cuda.__class__
 
@@ -71,10 +106,12 @@ def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, l
         if hasattr(module_to_cpu, "weight") and module_to_cpu.weight is not None:
             weight_swap_jobs.append((module_to_cpu, module_to_cuda, module_to_cpu.weight.data, module_to_cuda.weight.data))
 
-
     # device to cpu
     for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-        module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True)
+        buffer, up_to_date = _cpu_buffer(cpu_buffers, module_to_cpu, cuda_data_view, pin_memory=False)
+        if not up_to_date:
+            buffer.copy_(cuda_data_view, non_blocking=True)
+        module_to_cpu.weight.data = buffer
 
     synchronize_device(device)
 
@@ -95,6 +132,14 @@ def weighs_to_device(layer: nn.Module, device: torch.device):
 class Offloader:
     """
     common offloading class
+
+    the swaps are scheduled without host threads. on CUDA, the copies of each swap are queued on a dedicated stream and the
+    compute stream waits for an event before the block is used, so the host never blocks on a transfer. the ordering is:
+    1. the copy of the block to CPU starts after all work queued on the compute stream before the swap is submitted
+    2. the copy of the other block to the device starts after it, in the same stream, so the reused device memory is free
+    3. the compute stream waits for the event of the swap in `wait_for_block`, before the block is used
+    4. the CPU buffers are persistent and pinned, and copies from and to the same buffer are ordered by the copy stream
+    on the other devices, the swaps are done synchronously in the calling thread
     """
 
     def __init__(self, num_blocks: int, blocks_to_swap: int, device: torch.device, debug: bool = False):
@@ -103,61 +148,51 @@ class Offloader:
         self.device = device
         self.debug = debug
 
-        self.thread_pool = ThreadPoolExecutor(max_workers=1)
-        self.futures = {}
         self.cuda_available = device.type == "cuda"
+        self.stream = torch.cuda.Stream(device=device) if self.cuda_available else None
+        self.events: dict[int, Optional[torch.cuda.Event]] = {}  # block index to cuda -> event of the swap
+        self.cpu_buffers: dict[nn.Module, torch.Tensor] = {}  # module -> persistent CPU buffer of the weight
 
-    def swap_weight_devices(self, block_to_cpu: nn.Module, block_to_cuda: nn.Module):
+    def swap_weight_devices(self, block_to_cpu: nn.Module, block_to_cuda: nn.Module) -> Optional[torch.cuda.Event]:
         if self.cuda_available:
-            swap_weight_devices_cuda(self.device, block_to_cpu, block_to_cuda)
+            return swap_weight_devices_cuda(self.device, block_to_cpu, block_to_cuda, self.stream, self.cpu_buffers)
         else:
-            swap_weight_devices_no_cuda(self.device, block_to_cpu, block_to_cuda)
+            swap_weight_devices_no_cuda(self.device, block_to_cpu, block_to_cuda, self.cpu_buffers)
+            return None
 
     def _submit_move_blocks(self, blocks, block_idx_to_cpu, block_idx_to_cuda):
-        def move_blocks(bidx_to_cpu, block_to_cpu, bidx_to_cuda, block_to_cuda):
-            if self.debug:
-                start_time = time.perf_counter()
-                print(f"Move block {bidx_to_cpu} to CPU and block {bidx_to_cuda} to {'CUDA' if self.cuda_available else 'device'}")
-
-            self.swap_weight_devices(block_to_cpu, block_to_cuda)
-
-            if self.debug:
-                print(f"Moved blocks {bidx_to_cpu} and {bidx_to_cuda} in {time.perf_counter()-start_time:.2f}s")
-            return bidx_to_cpu, bidx_to_cuda  # , event
+        if self.debug:
+            start_time = time.perf_counter()
+            print(f"Move block {block_idx_to_cpu} to CPU and block {block_idx_to_cuda} to {'CUDA' if self.cuda_available else 'device'}")
 
-        block_to_cpu = blocks[block_idx_to_cpu]
-        block_to_cuda = blocks[block_idx_to_cuda]
+        if block_idx_to_cuda in self.events:
+            self._wait_blocks_move(block_idx_to_cuda)  # not waited, e.g. an interrupted forward: keep the order
+        self.events[block_idx_to_cuda] = self.swap_weight_devices(blocks[block_idx_to_cpu], blocks[block_idx_to_cuda])
 
-        self.futures[block_idx_to_cuda] = self.thread_pool.submit(
-            move_blocks, block_idx_to_cpu, block_to_cpu, block_idx_to_cuda, block_to_cuda
-        )
+        if self.debug:
+            print(f"Submitted moving blocks {block_idx_to_cpu} and {block_idx_to_cuda} in {time.perf_counter()-start_time:.2f}s")
 
     def _wait_blocks_move(self, block_idx):
-        if block_idx not in self.futures:
+        if block_idx not in self.events:
             return
 
         if self.debug:
             print(f"Wait for block {block_idx}")
-            start_time = time.perf_counter()
-
-        future = self.futures.pop(block_idx)
 
-        # FIX: Add timeout to prevent indefinite blocking on CUDA deadlocks
-        try:
-            _, bidx_to_cuda = future.result(timeout=30.0)  # 30 second timeout
-        except TimeoutError:
-            error_msg = f"Block swap timeout for block {block_idx} after 30 seconds. This indicates a CUDA deadlock."
-            print(f"ERROR: {error_msg}")
-            raise RuntimeError(error_msg)
-        except Exception as e:
-            error_msg = f"Block swap failed for block {block_idx}: {e}"
-            print(f"ERROR: {error_msg}")
-            raise RuntimeError(error_msg)
+        event = self.events.pop(block_idx)
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)  # the host does not wait
 
-        assert block_idx == bidx_to_cuda, f"Block index mismatch: {block_idx} != {bidx_to_cuda}"
-
-        if self.debug:
-            print(f"Waited for block {block_idx}: {time.perf_counter()-start_time:.2f}s")
+    def _weights_to_cpu(self, block: nn.Module):
+        for module in block.modules():
+            if hasattr(module, "weight") and module.weight is not None:
+                weight = module.weight.data
+                buffer, up_to_date = _cpu_buffer(self.cpu_buffers, module, weight, pin_memory=self.cuda_available)
+                if buffer.data_ptr() == weight.data_ptr():
+                    continue  # already in the buffer
+                if not up_to_date or weight.device.type == "cpu":
+                    buffer.copy_(weight)
+                module.weight.data = buffer
 
 
 # Gradient tensors
@@ -216,13 +251,18 @@ class ModelOffloader(Offloader):
         if self.debug:
             print("Prepare block devices before forward")
 
+        # swaps of the previous forward without backward (e.g. sampling) are finished before the weights are moved
+        if self.stream is not None:
+            self.stream.synchronize()
+        self.events.clear()
+
         for b in blocks[0 : self.num_blocks - self.blocks_to_swap]:
             b.to(self.device)
             weighs_to_device(b, self.device)  # make sure weights are on device
 
         for b in blocks[self.num_blocks - self.blocks_to_swap :]:
             b.to(self.device)  # move block to device first
-            weighs_to_device(b, torch.device("cpu"))  # make sure weights are on cpu
+            self._weights_to_cpu(b)  # make sure weights are on cpu, in the persistent buffers
 
         synchronize_device(self.device)
         clean_memory_on_device(self.device)
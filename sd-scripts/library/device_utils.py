@@ -40,15 +40,18 @@ def clean_memory_on_device(device: torch.device):
     r"""
     Clean memory on the specified device, will be called from training scripts.
     """
-    gc.collect()
-
-    # device may "cuda" or "cuda:0", so we need to check the type of device
-    if device.type == "cuda":
-        torch.cuda.empty_cache()
-    if device.type == "xpu":
-        torch.xpu.empty_cache()
-    if device.type == "mps":
-        torch.mps.empty_cache()
+    from library import step_profiler  # imported here to avoid circular import through library.utils
+
+    with step_profiler.span("clean_memory"):
+        gc.collect()
+
+        # device may "cuda" or "cuda:0", so we need to check the type of device
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+        if device.type == "xpu":
+            torch.xpu.empty_cache()
+        if device.type == "mps":
+            torch.mps.empty_cache()
 
 
 @functools.lru_cache(maxsize=None)
@@ -0,0 +1,107 @@
+# flat contiguous buffers for the parameters and gradients of a network
+#
+# LoRA networks have hundreds of tiny parameters, and the optimizer step, gradient clipping, zeroing the gradients and
+# copying the weights to CPU all cost a kernel launch per tensor. `flatten_param_groups` moves the parameters of each
+# optimizer param group (and dtype/device) into one flat buffer, and the module parameters become views of it. the
+# optimizer gets one flat parameter per buffer, whose gradient buffer is shared with the gradients of the views.
+# the module parameters keep their names and shapes, so the state dict is unchanged.
+
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FlatBuffer:
+    def __init__(self, params: List[torch.nn.Parameter]):
+        r"""
+        allocate the buffer and make `params` views of it. all params must have the same dtype and device
+        """
+        self.params = params
+        dtype, device = params[0].dtype, params[0].device
+        numel = sum(p.numel() for p in params)
+
+        self.flat_param = torch.nn.Parameter(torch.empty(numel, dtype=dtype, device=device))
+        self.flat_param.grad = torch.zeros_like(self.flat_param)
+
+        self.offsets: List[Tuple[int, int]] = []
+        offset = 0
+        with torch.no_grad():
+            for p in params:
+                n = p.numel()
+                view = self.flat_param.data[offset : offset + n].view_as(p)
+                view.copy_(p.data)
+                p.data = view
+                p.grad = self.flat_param.grad[offset : offset + n].view_as(p)
+                self.offsets.append((offset, n))
+                offset += n
+
+    def contains(self, tensor: torch.Tensor) -> bool:
+        return tensor.device == self.flat_param.device and tensor.untyped_storage().data_ptr() == self.flat_param.untyped_storage().data_ptr()
+
+    def is_intact(self) -> bool:
+        r"""
+        False if a parameter or a gradient was replaced (e.g. by `.to()` or `zero_grad(set_to_none=True)`)
+        """
+        return self.flat_param.grad is not None and all(
+            self.contains(p.data) and p.grad is not None and p.grad.untyped_storage().data_ptr() == self.flat_param.grad.untyped_storage().data_ptr()
+            for p in self.params
+        )
+
+
+def flatten_param_groups(param_groups: List[Dict]) -> Tuple[List[Dict], List[FlatBuffer]]:
+    r"""
+    returns the param groups with the params replaced by flat parameters, and the buffers.
+    call this after the network is moved to its final device and dtype: `.to()` copies the parameters out of the buffers.
+    the gradients must be zeroed with `zero_grad(set_to_none=False)` to keep them in the buffers
+    """
+    flat_groups = []
+    buffers = []
+    for group in param_groups:
+        params = group["params"] if isinstance(group, dict) else group
+        by_dtype_device: Dict[Tuple[torch.dtype, torch.device], List[torch.nn.Parameter]] = {}
+        for p in params:
+            if p.requires_grad:
+                by_dtype_device.setdefault((p.dtype, p.device), []).append(p)
+
+        group_buffers = [FlatBuffer(ps) for ps in by_dtype_device.values()]
+        buffers.extend(group_buffers)
+        if isinstance(group, dict):
+            flat_group = dict(group)
+            flat_group["params"] = [buffer.flat_param for buffer in group_buffers]
+        else:
+            flat_group = [buffer.flat_param for buffer in group_buffers]
+        flat_groups.append(flat_group)
+
+    num_params = sum(len(buffer.params) for buffer in buffers)
+    logger.info(f"flattened {num_params} parameters into {len(buffers)} buffers / {num_params}個のパラメータを{len(buffers)}個のバッファにまとめました")
+    return flat_groups, buffers
+
+
+def copy_state_dict_to_cpu(
+    state_dict: Dict[str, torch.Tensor], dtype: torch.dtype, buffers: Optional[List[FlatBuffer]] = None
+) -> Dict[str, torch.Tensor]:
+    r"""
+    same as `v.detach().clone().to("cpu").to(dtype)` for each value, but the flat buffers are copied to CPU once and the
+    values in them are cloned from the CPU copy
+    """
+    cpu_buffers = {}
+    result = {}
+    for key, value in state_dict.items():
+        buffer = next((b for b in buffers or [] if b.contains(value)), None)
+        if buffer is None:
+            result[key] = value.detach().clone().to("cpu").to(dtype)
+            continue
+
+        if id(buffer) not in cpu_buffers:
+            cpu_buffers[id(buffer)] = buffer.flat_param.detach().to("cpu").to(dtype)
+        cpu_flat = cpu_buffers[id(buffer)]
+        offset = value.storage_offset() - buffer.flat_param.storage_offset()
+        result[key] = cpu_flat[offset : offset + value.numel()].view(value.shape).clone()  # clone: safetensors rejects shared tensors
+    return result
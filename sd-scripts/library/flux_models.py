@@ -5,9 +5,10 @@
 import math
 import os
 import time
+from collections import OrderedDict
 from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from library import utils
 from library.device_utils import clean_memory_on_device, init_ipex
@@ -19,7 +20,7 @@ from einops import rearrange
 from torch import Tensor, nn
 from torch.utils.checkpoint import checkpoint
 
-from library import custom_offloading_utils
+from library import compile_utils, custom_offloading_utils
 
 # USE_REENTRANT = True
 
@@ -521,6 +522,108 @@ class EmbedND(nn.Module):
         return emb.unsqueeze(1)
 
 
+class PositionIdsCache:
+    r"""
+    bounded LRU cache of txt_ids / img_ids and the rope embedding (pe) of FLUX, keyed by (batch size, text length, packed
+    latent height and width, dtype, device). the ids only depend on the shapes, so they are built once for each bucket and
+    the pe is computed once for each of them, instead of every forward. the cached tensors must not be modified in place.
+    `Flux.forward` uses the cached pe only when both ids are the tensors returned by `get_ids`
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.keys: Dict[int, tuple] = {}  # id(img_ids) -> key
+
+    def clear(self):
+        self.entries.clear()
+        self.keys.clear()
+
+    def get_ids(
+        self,
+        batch_size: int,
+        txt_len: int,
+        packed_latent_height: int,
+        packed_latent_width: int,
+        device: Union[str, torch.device],
+        dtype: torch.dtype = torch.float32,
+    ) -> tuple[Tensor, Tensor]:
+        device = torch.device(device)
+        key = (batch_size, txt_len, packed_latent_height, packed_latent_width, dtype, device)
+        entry = self.entries.get(key)
+        if entry is None:
+            # same as flux_utils.prepare_img_ids, and the zero txt_ids of the text encoding strategy
+            img_ids = torch.zeros(packed_latent_height, packed_latent_width, 3, dtype=dtype)
+            img_ids[..., 1] = img_ids[..., 1] + torch.arange(packed_latent_height)[:, None]
+            img_ids[..., 2] = img_ids[..., 2] + torch.arange(packed_latent_width)[None, :]
+            img_ids = img_ids.reshape(1, -1, 3).repeat(batch_size, 1, 1).to(device)
+            txt_ids = torch.zeros(batch_size, txt_len, 3, dtype=dtype, device=device)
+
+            entry = {"txt_ids": txt_ids, "img_ids": img_ids, "pe": {}}
+            self.entries[key] = entry
+            self.keys[id(img_ids)] = key
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.keys.pop(id(evicted["img_ids"]), None)
+        else:
+            self.entries.move_to_end(key)
+        return entry["txt_ids"], entry["img_ids"]
+
+    def find(self, txt_ids: Tensor, img_ids: Tensor) -> Optional[tuple]:
+        r"""
+        returns the key of `txt_ids` and `img_ids` if they are the cached tensors, otherwise None
+        """
+        key = self.keys.get(id(img_ids))
+        entry = self.entries.get(key) if key is not None else None
+        if entry is None or entry["img_ids"] is not img_ids or entry["txt_ids"] is not txt_ids:
+            return None
+        if img_ids.requires_grad or txt_ids.requires_grad:
+            return None
+        return key
+
+    def get_ids_with_batch_size(self, txt_ids: Tensor, img_ids: Tensor, batch_size: int) -> tuple[Tensor, Tensor]:
+        r"""
+        ids for `batch_size` (e.g. the doubled batch of CFG), from the cache if the given ids are cached
+        """
+        key = self.find(txt_ids, img_ids)
+        if key is None:
+            repeats = batch_size // txt_ids.shape[0]
+            return torch.cat([txt_ids] * repeats, dim=0), torch.cat([img_ids] * repeats, dim=0)
+        _, txt_len, packed_latent_height, packed_latent_width, dtype, device = key
+        return self.get_ids(batch_size, txt_len, packed_latent_height, packed_latent_width, device, dtype)
+
+    def get_pe(self, pe_embedder: "EmbedND", txt_ids: Tensor, img_ids: Tensor) -> Tensor:
+        r"""
+        `pe_embedder(cat(txt_ids, img_ids))`, cached if the ids are the cached tensors
+        """
+        key = self.find(txt_ids, img_ids)
+        autocast_state = _autocast_state(img_ids.device)
+        if key is None or autocast_state is None:
+            return pe_embedder(torch.cat((txt_ids, img_ids), dim=1))
+
+        # rope runs einsum, which depends on autocast
+        pe_key = (pe_embedder.theta, tuple(pe_embedder.axes_dim), autocast_state)
+        pes = self.entries[key]["pe"]
+        if pe_key not in pes:
+            with torch.no_grad():
+                pes[pe_key] = pe_embedder(torch.cat((txt_ids, img_ids), dim=1))
+        return pes[pe_key]
+
+
+def _autocast_state(device: torch.device) -> Optional[tuple]:
+    if hasattr(torch, "get_autocast_dtype"):  # PyTorch 2.4+
+        return torch.is_autocast_enabled(device.type), torch.get_autocast_dtype(device.type)
+    if device.type == "cuda":
+        return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    if device.type == "cpu":
+        return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return None  # not cached
+
+
+# shared by training, validation and sampling
+position_ids_cache = PositionIdsCache()
+
+
 def timestep_embedding(t: Tensor, dim, max_period=10000, time_factor: float = 1000.0):
     """
     Create sinusoidal timestep embeddings.
@@ -875,6 +978,75 @@ class LastLayer(nn.Module):
 # endregion
 
 
+def parse_gradient_checkpointing_policy(policy: str) -> Tuple[str, Optional[float]]:
+    r"""
+    parses a gradient checkpointing policy: "all", "every:K" (every K-th block), "first:N" (the first N blocks) or
+    "budget:GB" (checkpoint the fewest blocks whose activations, without checkpointing, fit in GB)
+    """
+    name, _, value = policy.partition(":")
+    if name == "all" and value == "":
+        return name, None
+    if name in ["every", "first", "budget"] and value != "":
+        try:
+            number = float(value) if name == "budget" else int(value)
+        except ValueError:
+            number = None
+        if number is not None and number > 0:
+            return name, number
+    raise ValueError(
+        f"invalid gradient checkpointing policy: {policy}, use all, every:K, first:N or budget:GB"
+        f" / 無効なgradient checkpointingのポリシーです: {policy}。all, every:K, first:N, budget:GBのいずれかを指定してください"
+    )
+
+
+def select_gradient_checkpointing_blocks(
+    policy: str, num_blocks: int, activation_sizes: Optional[List[int]] = None
+) -> List[int]:
+    r"""
+    returns the indices of the blocks (double blocks, then single blocks) to checkpoint with `policy`.
+    budget needs `activation_sizes`, the bytes which each block keeps for backward without checkpointing. the blocks
+    have the same compute, so the smallest ones are left out of checkpointing until the budget is used up
+    """
+    name, value = parse_gradient_checkpointing_policy(policy)
+    if name == "all":
+        return list(range(num_blocks))
+    if name == "every":
+        return [i for i in range(num_blocks) if i % value == 0]
+    if name == "first":
+        return list(range(min(value, num_blocks)))
+
+    assert activation_sizes is not None and len(activation_sizes) == num_blocks, "activation sizes of all blocks are required"
+    budget = value * 1024**3
+    not_checkpointed = set()
+    for i in sorted(range(num_blocks), key=lambda i: activation_sizes[i]):
+        if activation_sizes[i] > budget:
+            break
+        budget -= activation_sizes[i]
+        not_checkpointed.add(i)
+    return [i for i in range(num_blocks) if i not in not_checkpointed]
+
+
+def measure_saved_activation_size(module: nn.Module, forward, *inputs) -> int:
+    r"""
+    runs `forward(*inputs)` with grad and returns the bytes of the tensors which autograd keeps for backward, not
+    counting the inputs and the parameters of `module`. shared storages are counted once
+    """
+    excluded = {t.untyped_storage().data_ptr() for t in inputs if isinstance(t, torch.Tensor)}
+    excluded.update(p.untyped_storage().data_ptr() for p in module.parameters())
+    saved = {}
+
+    def pack(t: torch.Tensor):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in excluded:
+            saved[ptr] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        output = forward(*inputs)
+    del output
+    return sum(saved.values())
+
+
 class Flux(nn.Module):
     """
     Transformer model for flow matching on sequences.
@@ -938,7 +1110,14 @@ class Flux(nn.Module):
     def dtype(self):
         return next(self.parameters()).dtype
 
-    def enable_gradient_checkpointing(self, cpu_offload: bool = False):
+    def enable_gradient_checkpointing(self, cpu_offload: bool = False, blocks: Optional[List[int]] = None):
+        r"""
+        blocks: indices of the blocks (double blocks, then single blocks) to checkpoint, None for all blocks. the other
+        blocks keep their activations for backward. see `select_gradient_checkpointing_blocks`
+        """
+        all_blocks = self.double_blocks + self.single_blocks
+        assert blocks is None or not cpu_offload, "cpu_offload is not supported with a subset of blocks"
+
         self.gradient_checkpointing = True
         self.cpu_offload_checkpointing = cpu_offload
 
@@ -947,10 +1126,14 @@ class Flux(nn.Module):
         if self.guidance_in.__class__ != nn.Identity:
             self.guidance_in.enable_gradient_checkpointing()
 
-        for block in self.double_blocks + self.single_blocks:
-            block.enable_gradient_checkpointing(cpu_offload=cpu_offload)
+        blocks = set(range(len(all_blocks)) if blocks is None else blocks)
+        for i, block in enumerate(all_blocks):
+            if i in blocks:
+                block.enable_gradient_checkpointing(cpu_offload=cpu_offload)
+            else:
+                block.disable_gradient_checkpointing()
 
-        print(f"FLUX: Gradient checkpointing enabled. CPU offload: {cpu_offload}")
+        print(f"FLUX: Gradient checkpointing enabled for {len(blocks)}/{len(all_blocks)} blocks. CPU offload: {cpu_offload}")
 
     def disable_gradient_checkpointing(self):
         self.gradient_checkpointing = False
@@ -966,6 +1149,46 @@ class Flux(nn.Module):
 
         print("FLUX: Gradient checkpointing disabled.")
 
+    def measure_block_activation_sizes(self, txt_len: int, h: int, w: int, dtype: torch.dtype) -> List[int]:
+        r"""
+        measures the bytes which each block keeps for backward without checkpointing, for one sample of `txt_len` T5
+        tokens and an image of h x w packed latents. call this in the autocast context of the training. the blocks
+        which are swapped out to CPU are not run, the size of the first block of the same type is used for them
+        """
+        device = self.img_in.weight.device
+        txt_ids, img_ids = position_ids_cache.get_ids(1, txt_len, h, w, device)
+        pe = position_ids_cache.get_pe(self.pe_embedder, txt_ids, img_ids)
+        img = torch.randn(1, h * w, self.hidden_size, device=device, dtype=dtype, requires_grad=True)
+        txt = torch.randn(1, txt_len, self.hidden_size, device=device, dtype=dtype, requires_grad=True)
+        vec = torch.randn(1, self.hidden_size, device=device, dtype=dtype, requires_grad=True)
+        x = torch.cat((txt, img), dim=1).detach().requires_grad_(True)
+
+        def measure(blocks: nn.ModuleList, inputs: tuple) -> List[int]:
+            sizes = []
+            for block in blocks:
+                if next(block.parameters()).device != device and len(sizes) > 0:
+                    sizes.append(sizes[0])  # swapped out
+                    continue
+                sizes.append(measure_saved_activation_size(block, block._forward, *inputs))
+            return sizes
+
+        return measure(self.double_blocks, (img, txt, vec, pe)) + measure(self.single_blocks, (x, vec, pe))
+
+    def compile_blocks(
+        self, backend: str = "inductor", dynamic: bool = False, cache_dir: Optional[str] = None, num_shapes: Optional[int] = None
+    ):
+        r"""
+        compiles `_forward` of the double and single blocks, once per shape, or once with the token dimension dynamic.
+        call this after LoRA is applied. `num_shapes` is the number of the input shapes in training
+        """
+        dynamic_dims = None
+        if dynamic:
+            # token dimension of img, txt, pe and txt_attention_mask
+            dynamic_dims = {"DoubleStreamBlock": {0: 1, 1: 1, 3: 2, 4: 1}, "SingleStreamBlock": {0: 1, 2: 2, 3: 1}}
+        compile_utils.compile_blocks(
+            list(self.double_blocks) + list(self.single_blocks), backend, dynamic_dims, cache_dir, num_shapes
+        )
+
     def enable_block_swap(self, num_blocks: int, device: torch.device):
         self.blocks_to_swap = num_blocks
         double_blocks_to_swap = num_blocks // 2
@@ -1032,8 +1255,7 @@ class Flux(nn.Module):
         vec = vec + self.vector_in(y)
         txt = self.txt_in(txt)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = position_ids_cache.get_pe(self.pe_embedder, txt_ids, img_ids)
         if block_controlnet_hidden_states is not None:
             controlnet_depth = len(block_controlnet_hidden_states)
         if block_controlnet_single_hidden_states is not None:
@@ -1277,8 +1499,7 @@ class ControlNetFlux(nn.Module):
         vec = vec + self.vector_in(y)
         txt = self.txt_in(txt)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = position_ids_cache.get_pe(self.pe_embedder, txt_ids, img_ids)
 
         block_samples = ()
         block_single_samples = ()
@@ -1420,8 +1641,7 @@ class FluxUpper(nn.Module):
         vec = vec + self.vector_in(y)
         txt = self.txt_in(txt)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        pe = position_ids_cache.get_pe(self.pe_embedder, txt_ids, img_ids)
 
         for block in self.double_blocks:
             img, txt = block(img=img, txt=txt, vec=vec, pe=pe, txt_attention_mask=txt_attention_mask)
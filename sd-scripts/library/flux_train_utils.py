@@ -85,18 +85,20 @@ def sample_images(
     except Exception:
         pass
 
+    sample_batch_size = getattr(args, "sample_batch_size", 1)
+
     if distributed_state.num_processes <= 1:
         # If only one device is available, just use the original prompt list. We don't need to care about the distribution of prompts.
         with torch.no_grad(), accelerator.autocast():
-            for prompt_dict in prompts:
-                sample_image_inference(
+            for prompt_dicts in group_sample_prompts(prompts, sample_batch_size):
+                sample_image_inference_batch(
                     accelerator,
                     args,
                     flux,
                     text_encoders,
                     ae,
                     save_dir,
-                    prompt_dict,
+                    prompt_dicts,
                     epoch,
                     steps,
                     sample_prompts_te_outputs,
@@ -112,15 +114,15 @@ def sample_images(
 
         with torch.no_grad():
             with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
-                for prompt_dict in prompt_dict_lists[0]:
-                    sample_image_inference(
+                for prompt_dicts in group_sample_prompts(prompt_dict_lists[0], sample_batch_size):
+                    sample_image_inference_batch(
                         accelerator,
                         args,
                         flux,
                         text_encoders,
                         ae,
                         save_dir,
-                        prompt_dict,
+                        prompt_dicts,
                         epoch,
                         steps,
                         sample_prompts_te_outputs,
@@ -135,6 +137,41 @@ def sample_images(
     clean_memory_on_device(accelerator.device)
 
 
+def get_sample_params(prompt_dict: dict) -> Tuple[int, int, int, float, float]:
+    r"""
+    returns (width, height, sample_steps, cfg_scale, emb_guidance_scale) of a prompt. prompts with the same values can be
+    denoised in one batch
+    """
+    sample_steps = prompt_dict.get("sample_steps", 20)
+    width = prompt_dict.get("width", 512)
+    height = prompt_dict.get("height", 512)
+    # TODO refactor variable names
+    cfg_scale = prompt_dict.get("guidance_scale", 1.0)
+    emb_guidance_scale = prompt_dict.get("scale", 3.5)
+    height = max(64, height - height % 16)  # round to divisible by 16
+    width = max(64, width - width % 16)  # round to divisible by 16
+    return width, height, sample_steps, cfg_scale, emb_guidance_scale
+
+
+def group_sample_prompts(prompts: List[dict], batch_size: int) -> List[List[dict]]:
+    r"""
+    group prompts by resolution, steps, guidance and CFG scale in the order of their first appearance, and split the groups
+    into batches of at most `batch_size`. prompts with a controlnet image are not batched
+    """
+    groups: Dict[tuple, List[dict]] = {}
+    for prompt_dict in prompts:
+        key = get_sample_params(prompt_dict)
+        if batch_size <= 1 or prompt_dict.get("controlnet_image") is not None:
+            key = key + (prompt_dict["enum"],)
+        groups.setdefault(key, []).append(prompt_dict)
+
+    batches = []
+    for group in groups.values():
+        for i in range(0, len(group), max(1, batch_size)):
+            batches.append(group[i : i + max(1, batch_size)])
+    return batches
+
+
 def sample_image_inference(
     accelerator: Accelerator,
     args: argparse.Namespace,
@@ -150,49 +187,42 @@ def sample_image_inference(
     controlnet,
 ):
     assert isinstance(prompt_dict, dict)
-    negative_prompt = prompt_dict.get("negative_prompt")
-    sample_steps = prompt_dict.get("sample_steps", 20)
-    width = prompt_dict.get("width", 512)
-    height = prompt_dict.get("height", 512)
-    # TODO refactor variable names
-    cfg_scale = prompt_dict.get("guidance_scale", 1.0)
-    emb_guidance_scale = prompt_dict.get("scale", 3.5)
-    seed = prompt_dict.get("seed")
-    controlnet_image = prompt_dict.get("controlnet_image")
-    prompt: str = prompt_dict.get("prompt", "")
-    # sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
-
-    if prompt_replacement is not None:
-        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-        if negative_prompt is not None:
-            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
-
-    if seed is not None:
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
-    else:
-        # True random sample image generation
-        torch.seed()
-        torch.cuda.seed()
+    sample_image_inference_batch(
+        accelerator,
+        args,
+        flux,
+        text_encoders,
+        ae,
+        save_dir,
+        [prompt_dict],
+        epoch,
+        steps,
+        sample_prompts_te_outputs,
+        prompt_replacement,
+        controlnet,
+    )
 
-    if negative_prompt is None:
-        negative_prompt = ""
-    height = max(64, height - height % 16)  # round to divisible by 16
-    width = max(64, width - width % 16)  # round to divisible by 16
-    logger.info(f"prompt: {prompt}")
-    if cfg_scale != 1.0:
-        logger.info(f"negative_prompt: {negative_prompt}")
-    elif negative_prompt != "":
-        logger.info(f"negative prompt is ignored because scale is 1.0")
-    logger.info(f"height: {height}")
-    logger.info(f"width: {width}")
-    logger.info(f"sample_steps: {sample_steps}")
-    logger.info(f"embedded guidance scale: {emb_guidance_scale}")
-    if cfg_scale != 1.0:
-        logger.info(f"CFG scale: {cfg_scale}")
-    # logger.info(f"sample_sampler: {sampler_name}")
-    if seed is not None:
-        logger.info(f"seed: {seed}")
+
+def sample_image_inference_batch(
+    accelerator: Accelerator,
+    args: argparse.Namespace,
+    flux: flux_models.Flux,
+    text_encoders: Optional[List[CLIPTextModel]],
+    ae: flux_models.AutoEncoder,
+    save_dir,
+    prompt_dicts: List[dict],
+    epoch,
+    steps,
+    sample_prompts_te_outputs,
+    prompt_replacement,
+    controlnet,
+):
+    r"""
+    denoise the prompts in one batch. all prompts must have the same `get_sample_params`. the noise of each prompt is
+    generated with its own seed as in the per-prompt path, and the latents are decoded one by one
+    """
+    width, height, sample_steps, cfg_scale, emb_guidance_scale = get_sample_params(prompt_dicts[0])
+    assert all(get_sample_params(prompt_dict) == (width, height, sample_steps, cfg_scale, emb_guidance_scale) for prompt_dict in prompt_dicts)
 
     # encode prompts
     tokenize_strategy = strategy_base.TokenizeStrategy.get_strategy()
@@ -219,38 +249,109 @@ def sample_image_inference(
                         text_encoder_conds[i] = encoded_text_encoder_conds[i]
         return text_encoder_conds
 
-    l_pooled, t5_out, txt_ids, t5_attn_mask = encode_prompt(prompt)
-    # encode negative prompts
-    if cfg_scale != 1.0:
-        neg_l_pooled, neg_t5_out, _, neg_t5_attn_mask = encode_prompt(negative_prompt)
-        neg_t5_attn_mask = (
-            neg_t5_attn_mask.to(accelerator.device) if args.apply_t5_attn_mask and neg_t5_attn_mask is not None else None
+    weight_dtype = ae.dtype  # TOFO give dtype as argument
+    packed_latent_height = height // 16
+    packed_latent_width = width // 16
+
+    prompts, seeds, conds, neg_conds, noises, controlnet_images = [], [], [], [], [], []
+    for prompt_dict in prompt_dicts:
+        negative_prompt = prompt_dict.get("negative_prompt")
+        seed = prompt_dict.get("seed")
+        controlnet_image = prompt_dict.get("controlnet_image")
+        prompt: str = prompt_dict.get("prompt", "")
+        # sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
+
+        if prompt_replacement is not None:
+            prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+            if negative_prompt is not None:
+                negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+
+        if seed is not None:
+            torch.manual_seed(seed)
+            torch.cuda.manual_seed(seed)
+        else:
+            # True random sample image generation
+            torch.seed()
+            torch.cuda.seed()
+
+        if negative_prompt is None:
+            negative_prompt = ""
+        logger.info(f"prompt: {prompt}")
+        if cfg_scale != 1.0:
+            logger.info(f"negative_prompt: {negative_prompt}")
+        elif negative_prompt != "":
+            logger.info(f"negative prompt is ignored because scale is 1.0")
+        logger.info(f"height: {height}")
+        logger.info(f"width: {width}")
+        logger.info(f"sample_steps: {sample_steps}")
+        logger.info(f"embedded guidance scale: {emb_guidance_scale}")
+        if cfg_scale != 1.0:
+            logger.info(f"CFG scale: {cfg_scale}")
+        # logger.info(f"sample_sampler: {sampler_name}")
+        if seed is not None:
+            logger.info(f"seed: {seed}")
+
+        conds.append(encode_prompt(prompt))
+        # encode negative prompts
+        if cfg_scale != 1.0:
+            neg_conds.append(encode_prompt(negative_prompt))
+
+        # sample image
+        noises.append(
+            torch.randn(
+                1,
+                packed_latent_height * packed_latent_width,
+                16 * 2 * 2,
+                device=accelerator.device,
+                dtype=weight_dtype,
+                generator=torch.Generator(device=accelerator.device).manual_seed(seed) if seed is not None else None,
+            )
         )
+
+        if controlnet_image is not None:
+            controlnet_image = Image.open(controlnet_image).convert("RGB")
+            controlnet_image = controlnet_image.resize((width, height), Image.LANCZOS)
+            controlnet_image = torch.from_numpy((np.array(controlnet_image) / 127.5) - 1)
+            controlnet_image = controlnet_image.permute(2, 0, 1).unsqueeze(0).to(weight_dtype).to(accelerator.device)
+        controlnet_images.append(controlnet_image)
+        prompts.append(prompt)
+        seeds.append(seed)
+
+    def cat_conds(conds_list):
+        # text encoder outputs of each prompt have the batch size 1
+        return [
+            None if conds_list[0][i] is None else torch.cat([c[i].to(accelerator.device) for c in conds_list], dim=0)
+            for i in range(len(conds_list[0]))
+        ]
+
+    l_pooled, t5_out, txt_ids, t5_attn_mask = cat_conds(conds)
+    if cfg_scale != 1.0:
+        neg_l_pooled, neg_t5_out, _, neg_t5_attn_mask = cat_conds(neg_conds)
+        neg_t5_attn_mask = neg_t5_attn_mask if args.apply_t5_attn_mask and neg_t5_attn_mask is not None else None
+
+    t5_trim_multiple = getattr(args, "t5_trim_multiple", None)
+    if t5_trim_multiple and args.apply_t5_attn_mask:
+        # the prompts and the negative prompts are concatenated in CFG, so they are cut to the same length
+        masks = [t5_attn_mask] + ([neg_t5_attn_mask] if cfg_scale != 1.0 else [])
+        length = get_trimmed_t5_length(masks, t5_trim_multiple)
+        t5_out, t5_attn_mask = trim_t5_outputs(length, t5_out, t5_attn_mask)
+        if cfg_scale != 1.0:
+            neg_t5_out, neg_t5_attn_mask = trim_t5_outputs(length, neg_t5_out, neg_t5_attn_mask)
+
+    if cfg_scale != 1.0:
         neg_cond = (cfg_scale, neg_l_pooled, neg_t5_out, neg_t5_attn_mask)
     else:
         neg_cond = None
 
-    # sample image
-    weight_dtype = ae.dtype  # TOFO give dtype as argument
-    packed_latent_height = height // 16
-    packed_latent_width = width // 16
-    noise = torch.randn(
-        1,
-        packed_latent_height * packed_latent_width,
-        16 * 2 * 2,
-        device=accelerator.device,
-        dtype=weight_dtype,
-        generator=torch.Generator(device=accelerator.device).manual_seed(seed) if seed is not None else None,
-    )
+    batch_size = len(prompt_dicts)
+    noise = torch.cat(noises, dim=0)
     timesteps = get_schedule(sample_steps, noise.shape[1], shift=True)  # FLUX.1 dev -> shift=True
-    img_ids = flux_utils.prepare_img_ids(1, packed_latent_height, packed_latent_width).to(accelerator.device, weight_dtype)
-    t5_attn_mask = t5_attn_mask.to(accelerator.device) if args.apply_t5_attn_mask else None
-
-    if controlnet_image is not None:
-        controlnet_image = Image.open(controlnet_image).convert("RGB")
-        controlnet_image = controlnet_image.resize((width, height), Image.LANCZOS)
-        controlnet_image = torch.from_numpy((np.array(controlnet_image) / 127.5) - 1)
-        controlnet_image = controlnet_image.permute(2, 0, 1).unsqueeze(0).to(weight_dtype).to(accelerator.device)
+    # cached ids: the pe is computed once for all timesteps (and for the next sampling of the same size)
+    txt_ids, img_ids = flux_utils.get_position_ids(
+        batch_size, t5_out.shape[1], packed_latent_height, packed_latent_width, accelerator.device
+    )
+    t5_attn_mask = t5_attn_mask if args.apply_t5_attn_mask else None
+    controlnet_image = None if controlnet_images[0] is None else torch.cat(controlnet_images, dim=0)
 
     with accelerator.autocast(), torch.no_grad():
         x = denoise(
@@ -274,33 +375,70 @@ def sample_image_inference(
     clean_memory_on_device(accelerator.device)
     org_vae_device = ae.device  # will be on cpu
     ae.to(accelerator.device)  # distributed_state.device is same as accelerator.device
-    with accelerator.autocast(), torch.no_grad():
-        x = ae.decode(x)
+    images = []
+    for latents in x.split(1):
+        with accelerator.autocast(), torch.no_grad():
+            image = ae.decode(latents)
+        image = image.clamp(-1, 1)
+        image = image.permute(0, 2, 3, 1)
+        images.append(Image.fromarray((127.5 * (image + 1.0)).float().cpu().numpy().astype(np.uint8)[0]))
     ae.to(org_vae_device)
     clean_memory_on_device(accelerator.device)
 
-    x = x.clamp(-1, 1)
-    x = x.permute(0, 2, 3, 1)
-    image = Image.fromarray((127.5 * (x + 1.0)).float().cpu().numpy().astype(np.uint8)[0])
-
     # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
     # but adding 'enum' to the filename should be enough
 
     ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
     num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-    seed_suffix = "" if seed is None else f"_{seed}"
-    i: int = prompt_dict["enum"]
-    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
+    for prompt_dict, prompt, seed, image in zip(prompt_dicts, prompts, seeds, images):
+        seed_suffix = "" if seed is None else f"_{seed}"
+        i: int = prompt_dict["enum"]
+        img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
+        image.save(os.path.join(save_dir, img_filename))
+
+        # send images to wandb if enabled
+        if "wandb" in [tracker.name for tracker in accelerator.trackers]:
+            wandb_tracker = accelerator.get_tracker("wandb")
 
-    # send images to wandb if enabled
-    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
-        wandb_tracker = accelerator.get_tracker("wandb")
+            import wandb
 
-        import wandb
+            # not to commit images to avoid inconsistency between training and logging steps
+            wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
 
-        # not to commit images to avoid inconsistency between training and logging steps
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+
+SAMPLE_PROMPTS_TE_OUTPUTS_FILE = "sample_prompts_te_outputs.safetensors"
+
+
+def save_sample_prompts_te_outputs(file: str, sample_prompts_te_outputs: Dict[str, List[Optional[torch.Tensor]]]):
+    r"""
+    save the cached text encoder outputs of the sample prompts for the sample worker (flux_sample_worker.py).
+    key of each tensor is `{prompt index}.{output index}`, the prompts are stored in the metadata
+    """
+    prompts = list(sample_prompts_te_outputs.keys())
+    state_dict = {}
+    for i, prompt in enumerate(prompts):
+        for j, output in enumerate(sample_prompts_te_outputs[prompt]):
+            if output is not None:
+                state_dict[f"{i}.{j}"] = output.detach().cpu().contiguous()
+    metadata = {"prompts": json.dumps(prompts), "num_outputs": str(max(len(v) for v in sample_prompts_te_outputs.values()))}
+
+    os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+    save_file(state_dict, file + ".tmp", metadata)
+    os.replace(file + ".tmp", file)
+
+
+def load_sample_prompts_te_outputs(file: str, device: Union[str, torch.device] = "cpu") -> Dict[str, List[Optional[torch.Tensor]]]:
+    from safetensors import safe_open
+
+    with safe_open(file, framework="pt", device=str(device)) as f:
+        metadata = f.metadata()
+        prompts = json.loads(metadata["prompts"])
+        num_outputs = int(metadata["num_outputs"])
+        keys = set(f.keys())
+        return {
+            prompt: [f.get_tensor(f"{i}.{j}") if f"{i}.{j}" in keys else None for j in range(num_outputs)]
+            for i, prompt in enumerate(prompts)
+        }
 
 
 def time_shift(mu: float, sigma: float, t: torch.Tensor):
@@ -332,6 +470,31 @@ def get_schedule(
     return timesteps.tolist()
 
 
+def get_trimmed_t5_length(t5_attn_masks: List[Optional[torch.Tensor]], multiple: int) -> Optional[int]:
+    r"""
+    the longest real length of the T5 tokens in `t5_attn_masks` (the masks of a batch, and of the negative prompts),
+    rounded up to `multiple` and limited to the padded length. None if there is no mask.
+    this syncs with the device once to get the length
+    """
+    t5_attn_masks = [m for m in t5_attn_masks if m is not None]
+    if len(t5_attn_masks) == 0:
+        return None
+    padded_length = t5_attn_masks[0].shape[1]
+    real_length = int(max(m.sum(dim=1).max() for m in t5_attn_masks).item())
+    length = max(1, math.ceil(real_length / multiple)) * multiple
+    return min(length, padded_length)
+
+
+def trim_t5_outputs(length: Optional[int], *tensors: Optional[torch.Tensor]) -> List[Optional[torch.Tensor]]:
+    r"""
+    cuts t5_out, txt_ids and t5_attn_mask to `length` tokens. with apply_t5_attn_mask the cut tokens are padding which
+    is masked in T5 and in the FLUX blocks, so the output of FLUX is the same and the attention runs over fewer tokens
+    """
+    if length is None:
+        return list(tensors)
+    return [None if t is None else t[:, :length] for t in tensors]
+
+
 def denoise(
     model: flux_models.Flux,
     img: torch.Tensor,
@@ -349,6 +512,9 @@ def denoise(
     # this is ignored for schnell
     guidance_vec = torch.full((img.shape[0],), guidance, device=img.device, dtype=img.dtype)
     do_cfg = neg_cond is not None
+    if do_cfg:
+        # ids of the doubled batch, from the cache if possible
+        nc_c_txt_ids, nc_c_img_ids = flux_models.position_ids_cache.get_ids_with_batch_size(txt_ids, img_ids, img.shape[0] * 2)
 
     for t_curr, t_prev in zip(tqdm(timesteps[:-1]), timesteps[1:]):
         t_vec = torch.full((img.shape[0],), t_curr, dtype=img.dtype, device=img.device)
@@ -397,14 +563,14 @@ def denoise(
 
             nc_c_pred = model(
                 img=torch.cat([img, img], dim=0),
-                img_ids=torch.cat([img_ids, img_ids], dim=0),
+                img_ids=nc_c_img_ids,
                 txt=torch.cat([neg_t5_out, txt], dim=0),
-                txt_ids=torch.cat([txt_ids, txt_ids], dim=0),
+                txt_ids=nc_c_txt_ids,
                 y=torch.cat([neg_l_pooled, vec], dim=0),
                 block_controlnet_hidden_states=block_samples,
                 block_controlnet_single_hidden_states=block_single_samples,
-                timesteps=t_vec,
-                guidance=guidance_vec,
+                timesteps=torch.cat([t_vec, t_vec], dim=0),
+                guidance=torch.cat([guidance_vec, guidance_vec], dim=0),
                 txt_attention_mask=nc_c_t5_attn_mask,
             )
             neg_pred, pred = torch.chunk(nc_c_pred, 2, dim=0)
@@ -547,6 +713,47 @@ def apply_model_prediction_type(args, model_pred, noisy_model_input, sigmas):
     return model_pred, weighting
 
 
+def apply_gradient_checkpointing_policy(
+    args: argparse.Namespace,
+    accelerator: Accelerator,
+    flux: flux_models.Flux,
+    resolutions: List[Tuple[int, int]],
+    batch_size: int,
+):
+    r"""
+    checkpoints the blocks selected by --gradient_checkpointing_policy. call this after the model is placed on the device.
+    for budget, the activations of each block are measured for the largest resolution and the longest T5 output
+    """
+    if not args.gradient_checkpointing or args.gradient_checkpointing_policy is None:
+        return
+
+    num_blocks = len(flux.double_blocks) + len(flux.single_blocks)
+    policy, _ = flux_models.parse_gradient_checkpointing_policy(args.gradient_checkpointing_policy)
+    activation_sizes = None
+    if policy == "budget":
+        width, height = max(resolutions, key=lambda reso: reso[0] * reso[1])
+        txt_len = strategy_base.TokenizeStrategy.get_strategy().t5xxl_max_length
+        weight_dtype, _ = train_util.prepare_dtype(args)
+        with accelerator.autocast():
+            sizes = flux.measure_block_activation_sizes(txt_len, height // 16, width // 16, weight_dtype)
+        clean_memory_on_device(accelerator.device)
+
+        activation_sizes = [size * batch_size for size in sizes]
+        logger.info(
+            f"activations per block for {width}x{height}, batch size {batch_size}:"
+            f" {min(activation_sizes) / 1024**2:.0f}-{max(activation_sizes) / 1024**2:.0f} MiB"
+            f" / {width}x{height}、バッチサイズ{batch_size}でのブロックごとのアクティベーション:"
+            f" {min(activation_sizes) / 1024**2:.0f}-{max(activation_sizes) / 1024**2:.0f} MiB"
+        )
+
+    blocks = flux_models.select_gradient_checkpointing_blocks(args.gradient_checkpointing_policy, num_blocks, activation_sizes)
+    flux.enable_gradient_checkpointing(blocks=blocks)
+    logger.info(
+        f"gradient checkpointing policy {args.gradient_checkpointing_policy}: {len(blocks)}/{num_blocks} blocks are checkpointed"
+        f" / gradient checkpointingのポリシー {args.gradient_checkpointing_policy}: {len(blocks)}/{num_blocks} ブロックをチェックポイント"
+    )
+
+
 def save_models(
     ckpt_path: str,
     flux: flux_models.Flux,
@@ -644,6 +851,96 @@ def add_flux_train_arguments(parser: argparse.ArgumentParser):
         action="store_true",
         help="apply attention mask to T5-XXL encode and FLUX double blocks / T5-XXLエンコードとFLUXダブルブロックにアテンションマスクを適用する",
     )
+    parser.add_argument(
+        "--t5_trim_multiple",
+        type=int,
+        default=None,
+        help="cut the T5-XXL outputs of each batch to the longest caption, rounded up to this multiple (e.g. 64), in training"
+        " and sampling. requires --apply_t5_attn_mask: the cut tokens are masked padding, so the results are the same"
+        " / 各バッチのT5-XXL出力を最長のキャプションの長さ（この値の倍数に切り上げ、例: 64）に切り詰める（学習とサンプル生成）。"
+        "--apply_t5_attn_maskが必要。切り詰めるトークンはマスクされたパディングのため結果は変わらない",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_policy",
+        type=str,
+        default=None,
+        help="blocks of FLUX to checkpoint with --gradient_checkpointing: all (default), every:K (every K-th block),"
+        " first:N (the first N blocks), or budget:GB (checkpoint as few blocks as possible, so that the activations of the"
+        " others fit in GB, measured at startup). not supported with --cpu_offload_checkpointing"
+        " / --gradient_checkpointingでチェックポイントするFLUXのブロック: all（デフォルト）、every:K（Kブロックごと）、"
+        "first:N（先頭のNブロック）、budget:GB（起動時に計測し、残りのブロックのアクティベーションがGBに収まるよう最小限のブロックをチェックポイント）。"
+        "--cpu_offload_checkpointingとは併用できません",
+    )
+    parser.add_argument(
+        "--compile_blocks",
+        action="store_true",
+        help="compile each double and single block of FLUX with torch.compile (--dynamo_backend), once per bucket shape."
+        " LoRA is compiled into the blocks. PyTorch 2.5 or later is recommended. not supported with --torch_compile"
+        " / FLUXの各ダブル・シングルブロックをtorch.compile（--dynamo_backend）でバケットの形状ごとにコンパイルする。"
+        "LoRAもブロックと共にコンパイルされる。PyTorch 2.5以降を推奨。--torch_compileとは併用できません",
+    )
+    parser.add_argument(
+        "--compile_blocks_dynamic",
+        action="store_true",
+        help="with --compile_blocks, compile the token dimension as dynamic instead of once per bucket shape"
+        " / --compile_blocksで、バケットの形状ごとではなくトークン数を動的な次元としてコンパイルする",
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="directory to keep the compiled kernels of --compile_blocks, so that resumed runs do not compile again"
+        " / --compile_blocksのコンパイル済みカーネルを保存するディレクトリ。再開時に再コンパイルしない",
+    )
+    parser.add_argument(
+        "--fp8_cache_dir",
+        type=str,
+        default=None,
+        help="with --fp8_base, convert FLUX to fp8 once and keep the copy in this directory, later runs load the fp8 copy"
+        " directly. the copies are renewed when the source files change"
+        " / --fp8_baseで、FLUXを一度だけfp8に変換してこのディレクトリに保存し、以降の実行ではfp8のコピーを直接読み込む。"
+        "元のファイルが変わるとコピーは作り直される",
+    )
+    parser.add_argument(
+        "--fp8_cache_t5xxl",
+        action="store_true",
+        help="with --fp8_cache_dir, also convert a bf16/fp16 T5-XXL to fp8 and use it in fp8 (without --fp8_base_unet)."
+        " T5-XXL is not fp8 without this option, so the text encoder outputs change: recreate the cached outputs"
+        " / --fp8_cache_dirで、bf16/fp16のT5-XXLもfp8に変換してfp8で使用する（--fp8_base_unetなしの場合）。"
+        "このオプションがない場合T5-XXLはfp8にならないため、Text Encoderの出力が変わる。キャッシュした出力は作り直すこと",
+    )
+    parser.add_argument(
+        "--model_load_memory_budget",
+        type=float,
+        default=None,
+        help="host memory in GB for loading FLUX, CLIP-L, T5-XXL and AE concurrently. a model starts loading when it fits"
+        " the budget, 0 loads them one at a time. default is the available memory"
+        " / FLUX、CLIP-L、T5-XXL、AEを並列に読み込むときのホストメモリ（GB）。予算に収まるモデルから読み込みを開始する。"
+        "0で一つずつ読み込む。デフォルトは空きメモリ",
+    )
+    parser.add_argument(
+        "--use_weight_server",
+        action="store_true",
+        help="map FLUX, CLIP-L, T5-XXL and AE from the shared memory copies of tools/weight_server.py instead of reading"
+        " them. models which are not copied yet are read from the files and copied by the server for the next run"
+        " / tools/weight_server.pyの共有メモリのコピーからFLUX、CLIP-L、T5-XXL、AEをマップして読み込む。"
+        "まだコピーされていないモデルはファイルから読み込まれ、次回の実行のためにサーバーがコピーする",
+    )
+    parser.add_argument(
+        "--sample_batch_size",
+        type=int,
+        default=1,
+        help="max number of sample prompts with the same resolution, steps and guidance denoised in one batch (default: 1)"
+        " / 解像度、ステップ数、ガイダンスが同じサンプルプロンプトを1バッチで生成する最大数（デフォルト: 1）",
+    )
+    parser.add_argument(
+        "--sample_worker",
+        action="store_true",
+        help="do not sample images in the training process. saved checkpoints are sampled by flux_sample_worker.py instead,"
+        " the cached text encoder outputs of the sample prompts are saved to output_dir for it"
+        " / 学習プロセスでサンプル画像を生成しない。保存されたチェックポイントは flux_sample_worker.py で生成する。"
+        "そのためにサンプルプロンプトのText Encoder出力のキャッシュを output_dir に保存する",
+    )
 
     parser.add_argument(
         "--guidance_scale",
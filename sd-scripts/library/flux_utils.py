@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 from dataclasses import replace
 from typing import List, Optional, Tuple, Union
 
@@ -17,13 +18,26 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from library import flux_models
+from library import flux_models, weight_server
 from library.utils import load_safetensors
 
 MODEL_VERSION_FLUX_V1 = "flux1"
 MODEL_NAME_DEV = "dev"
 MODEL_NAME_SCHNELL = "schnell"
 
+# init_empty_weights patches nn.Module.register_parameter globally, so building the models and assigning the state dicts
+# must not overlap when the models are loaded in threads. reading the state dicts is done outside of the lock
+MODEL_BUILD_LOCK = threading.RLock()
+
+
+def _load_state_dict(
+    ckpt_path: str, device: Union[str, torch.device], disable_mmap: bool, dtype: Optional[torch.dtype]
+) -> dict[str, torch.Tensor]:
+    # the shared copies of tools/weight_server.py are mapped instead of read, the weights are not copied
+    if weight_server.is_shared(ckpt_path) and torch.device(device).type == "cpu":
+        return weight_server.attach(ckpt_path, dtype)
+    return load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
+
 
 def analyze_checkpoint_state(ckpt_path: str) -> Tuple[bool, bool, Tuple[int, int], List[str]]:
     """
@@ -99,7 +113,7 @@ def load_flow_model(
 
     # build model
     logger.info(f"Building Flux model {name} from {'Diffusers' if is_diffusers else 'BFL'} checkpoint")
-    with torch.device("meta"):
+    with MODEL_BUILD_LOCK, torch.device("meta"):
         params = flux_models.configs[name].params
 
         # set the number of blocks
@@ -118,7 +132,7 @@ def load_flow_model(
     logger.info(f"Loading state dict from {ckpt_path}")
     sd = {}
     for ckpt_path in ckpt_paths:
-        sd.update(load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype))
+        sd.update(_load_state_dict(ckpt_path, device, disable_mmap, dtype))
 
     # convert Diffusers to BFL
     if is_diffusers:
@@ -133,7 +147,8 @@ def load_flow_model(
             break  # the model doesn't have annoying prefix
         sd[new_key] = sd.pop(key)
 
-    info = model.load_state_dict(sd, strict=False, assign=True)
+    with MODEL_BUILD_LOCK:
+        info = model.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded Flux: {info}")
     return is_schnell, model
 
@@ -142,13 +157,14 @@ def load_ae(
     ckpt_path: str, dtype: torch.dtype, device: Union[str, torch.device], disable_mmap: bool = False
 ) -> flux_models.AutoEncoder:
     logger.info("Building AutoEncoder")
-    with torch.device("meta"):
+    with MODEL_BUILD_LOCK, torch.device("meta"):
         # dev and schnell have the same AE params
         ae = flux_models.AutoEncoder(flux_models.configs[MODEL_NAME_DEV].ae_params).to(dtype)
 
     logger.info(f"Loading state dict from {ckpt_path}")
-    sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
-    info = ae.load_state_dict(sd, strict=False, assign=True)
+    sd = _load_state_dict(ckpt_path, device, disable_mmap, dtype)
+    with MODEL_BUILD_LOCK:
+        info = ae.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded AE: {info}")
     return ae
 
@@ -266,15 +282,16 @@ def load_clip_l(
         # "transformers_version": None,
     }
     config = CLIPConfig(**CLIPL_CONFIG)
-    with init_empty_weights():
+    with MODEL_BUILD_LOCK, init_empty_weights():
         clip = CLIPTextModel._from_config(config)
 
     if state_dict is not None:
         sd = state_dict
     else:
         logger.info(f"Loading state dict from {ckpt_path}")
-        sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
-    info = clip.load_state_dict(sd, strict=False, assign=True)
+        sd = _load_state_dict(ckpt_path, device, disable_mmap, dtype)
+    with MODEL_BUILD_LOCK:
+        info = clip.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded CLIP-L: {info}")
     return clip
 
@@ -321,15 +338,16 @@ def load_t5xxl(
 """
     config = json.loads(T5_CONFIG_JSON)
     config = T5Config(**config)
-    with init_empty_weights():
+    with MODEL_BUILD_LOCK, init_empty_weights():
         t5xxl = T5EncoderModel._from_config(config)
 
     if state_dict is not None:
         sd = state_dict
     else:
         logger.info(f"Loading state dict from {ckpt_path}")
-        sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
-    info = t5xxl.load_state_dict(sd, strict=False, assign=True)
+        sd = _load_state_dict(ckpt_path, device, disable_mmap, dtype)
+    with MODEL_BUILD_LOCK:
+        info = t5xxl.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded T5xxl: {info}")
     return t5xxl
 
@@ -347,6 +365,21 @@ def prepare_img_ids(batch_size: int, packed_latent_height: int, packed_latent_wi
     return img_ids
 
 
+def get_position_ids(
+    batch_size: int,
+    txt_len: int,
+    packed_latent_height: int,
+    packed_latent_width: int,
+    device: Union[str, torch.device],
+    dtype: torch.dtype = torch.float32,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    cached txt_ids (zeros) and img_ids (same as `prepare_img_ids`) on `device`. FLUX reuses the cached pe for these ids.
+    the returned tensors are shared, do not modify them in place
+    """
+    return flux_models.position_ids_cache.get_ids(batch_size, txt_len, packed_latent_height, packed_latent_width, device, dtype)
+
+
 def unpack_latents(x: torch.Tensor, packed_latent_height: int, packed_latent_width: int) -> torch.Tensor:
     """
     x: [b (h w) (c ph pw)] -> [b c (h ph) (w pw)], ph=2, pw=2
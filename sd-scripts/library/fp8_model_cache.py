@@ -0,0 +1,160 @@
+# cache of fp8 (float8_e4m3fn) copies of bf16/fp16 models for --fp8_base
+#
+# loading a bf16 model and casting it to fp8 reads and converts the full model on every launch. the cached copy is
+# converted once, tensor by tensor, and loaded as is with mmap. every floating tensor is cast to fp8, the same as
+# `model.to(torch.float8_e4m3fn)` after loading, so the loaded FLUX model is identical. a bf16/fp16 T5-XXL is not cast
+# to fp8 by --fp8_base, so its fp8 copy (--fp8_cache_t5xxl) changes the text encoder outputs.
+# the cache file is named by a fingerprint of the source (size, header and sampled chunks), so a changed source gets
+# a new cache file. hashing the whole source would take as long as the conversion.
+
+import glob
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, List, Optional
+
+import torch
+
+from library.utils import MemoryEfficientSafeOpen, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+CACHE_SUFFIX = ".fp8_e4m3fn.safetensors"
+_FLOAT_DTYPES = ["F64", "F32", "F16", "BF16"]
+_ALIGN = 256
+
+
+def _read_header(path: str) -> Dict:
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(header_size))
+
+
+def is_fp8_file(path: str) -> bool:
+    r"""
+    True if the first floating tensor of the safetensors file is float8_e4m3fn, the same check as `model.dtype`
+    """
+    header = _read_header(path)
+    for key, value in header.items():
+        if key == "__metadata__":
+            continue
+        if value["dtype"] in _FLOAT_DTYPES:
+            return False
+        if value["dtype"] == "F8_E4M3":
+            return True
+    return False
+
+
+def source_fingerprint(paths: List[str]) -> str:
+    r"""
+    sha256 of the size, the header and FINGERPRINT_SAMPLES evenly spaced chunks of each file
+    """
+    sha256 = hashlib.sha256()
+    for path in paths:
+        size = os.path.getsize(path)
+        sha256.update(str(size).encode("utf-8"))
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            sha256.update(f.read(header_size))
+            for i in range(FINGERPRINT_SAMPLES):
+                f.seek(size * i // FINGERPRINT_SAMPLES)
+                sha256.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return sha256.hexdigest()
+
+
+def get_cache_path(cache_dir: str, paths: List[str], fingerprint: Optional[str] = None) -> str:
+    r"""
+    <cache_dir>/<name>.<hash of the source path>.<fingerprint>.fp8_e4m3fn.safetensors. the hash of the path keeps the
+    caches of different models with the same file name apart
+    """
+    name = os.path.splitext(os.path.basename(paths[0]))[0]
+    path_hash = hashlib.sha256(os.path.abspath(paths[0]).encode("utf-8")).hexdigest()[:8]
+    fingerprint = fingerprint or source_fingerprint(paths)
+    return os.path.join(cache_dir, f"{name}.{path_hash}.{fingerprint[:16]}{CACHE_SUFFIX}")
+
+
+def convert_to_fp8(paths: List[str], output_path: str, metadata: Optional[Dict[str, str]] = None):
+    r"""
+    writes the tensors of `paths` to `output_path` with the floating tensors cast to float8_e4m3fn. one tensor is in
+    memory at a time. the file is written to a temporary file and renamed, so an interrupted conversion leaves no cache
+    """
+    entries = []  # (path, key, dtype string, shape)
+    for path in paths:
+        for key, value in _read_header(path).items():
+            if key != "__metadata__":
+                entries.append((path, key, value["dtype"], value["shape"]))
+
+    header = {"__metadata__": {"format": "pt", **(metadata or {})}}
+    offset = 0
+    for _, key, dtype, shape in entries:
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        if dtype in _FLOAT_DTYPES:
+            dtype, size = "F8_E4M3", numel
+        else:
+            size = numel * MemoryEfficientSafeOpen._get_torch_dtype(dtype).itemsize
+        header[key] = {"dtype": dtype, "shape": shape, "data_offsets": [offset, offset + size]}
+        offset += size
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-(len(header_bytes) + 8) % _ALIGN)
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    files = {path: MemoryEfficientSafeOpen(path) for path in paths}
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for path, key, dtype, _ in entries:
+                tensor = files[path].get_tensor(key)
+                if tensor.numel() == 0:
+                    continue
+                if dtype in _FLOAT_DTYPES:
+                    tensor = tensor.to(torch.float8_e4m3fn)
+                if tensor.dim() == 0:
+                    tensor = tensor.unsqueeze(0)
+                tensor.contiguous().view(torch.uint8).numpy().tofile(f)
+        os.replace(tmp_path, output_path)
+    finally:
+        for file in files.values():
+            file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_fp8_model_path(cache_dir: str, path: str, paths: Optional[List[str]] = None) -> str:
+    r"""
+    returns the cached fp8 copy of the model at `path` (split into `paths` if it has shards), converting it on the first
+    call. returns `path` if the model is already fp8. older caches of the same source are removed
+    """
+    paths = paths or [path]
+    if is_fp8_file(paths[0]):
+        return path
+
+    fingerprint = source_fingerprint(paths)
+    cache_path = get_cache_path(cache_dir, paths, fingerprint)
+    if os.path.exists(cache_path):
+        logger.info(f"use fp8 cache: {cache_path} / fp8キャッシュを使用します: {cache_path}")
+        return cache_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    logger.info(
+        f"convert {path} to fp8, this is done once: {cache_path} / {path} をfp8に変換します（初回のみ）: {cache_path}"
+    )
+    convert_to_fp8(paths, cache_path, {"fp8_cache_source": os.path.basename(path), "fp8_cache_fingerprint": fingerprint})
+
+    # older caches of the same source, the name without the fingerprint is the same
+    prefix = cache_path[: -len(CACHE_SUFFIX)].rsplit(".", 1)[0] + "."
+    for old_path in glob.glob(glob.escape(prefix) + "*" + CACHE_SUFFIX):
+        if old_path != cache_path:
+            logger.info(f"remove old fp8 cache: {old_path} / 古いfp8キャッシュを削除します: {old_path}")
+            os.remove(old_path)
+    return cache_path
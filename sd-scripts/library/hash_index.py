@@ -0,0 +1,161 @@
+# persistent index of the hashes of model files, so a multi-GB base model is hashed once instead of on every run
+#
+# the index is a JSONL file (SD_SCRIPTS_HASH_INDEX, or ~/.cache/sd-scripts/hash_index.jsonl) shared by the processes.
+# an entry is valid while the absolute path, size, mtime_ns and inode of the file are the same. entries are appended,
+# the last one of a path wins, and the file is compacted when it has many outdated lines.
+# the hashes are the ones of train_util: sha256 of the file, addnet (sha256 of the data of a safetensors file) and
+# legacy (sha256 of 64 KiB at 1 MiB, first 8 digits). all three are computed with one read of the file.
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from library.utils import LEGACY_HASH_END, LEGACY_HASH_START, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+BLOCK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_entries: Dict[str, Dict] = {}  # absolute path -> entry
+_index_mtime_ns: Optional[int] = None
+
+
+def get_index_path() -> str:
+    return os.environ.get(
+        "SD_SCRIPTS_HASH_INDEX", os.path.join(os.path.expanduser("~"), ".cache", "sd-scripts", "hash_index.jsonl")
+    )
+
+
+def _file_key(path: str) -> Dict:
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def _load_index():
+    r"""
+    reads the index if it was changed by this or another process. call with the lock
+    """
+    global _index_mtime_ns
+    index_path = get_index_path()
+    try:
+        mtime_ns = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return
+    if mtime_ns == _index_mtime_ns:
+        return
+
+    num_lines = 0
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line being written by another process
+            _entries[entry["path"]] = entry
+            num_lines += 1
+    _index_mtime_ns = mtime_ns
+
+    if num_lines > 2 * len(_entries) + 100:
+        try:
+            _write_index()
+        except OSError as e:
+            logger.warning(f"failed to compact the hash index {index_path}: {e} / ハッシュのインデックスを圧縮できませんでした")
+
+
+def _write_index():
+    r"""
+    rewrites the index with the last entry of each path, removed files are dropped
+    """
+    for path in [path for path in _entries if not os.path.exists(path)]:
+        del _entries[path]
+    index_path = get_index_path()
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in _entries.values():
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, index_path)
+
+
+def _append(entry: Dict):
+    _entries[entry["path"]] = entry
+    index_path = get_index_path()
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path, "a", encoding="utf-8") as f:  # a short append is not interleaved with other processes
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        logger.warning(f"failed to update the hash index {index_path}: {e} / ハッシュのインデックスを更新できませんでした")
+
+
+def compute_file_hashes(path: str) -> Dict[str, str]:
+    r"""
+    sha256, addnet and legacy hashes of the file with one read. addnet is None if the file is not safetensors
+    """
+    sha256 = hashlib.sha256()
+    addnet = hashlib.sha256()
+    legacy = hashlib.sha256()
+    data_start = None
+    position = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BLOCK_SIZE), b""):
+            sha256.update(chunk)
+            if data_start is None:
+                data_start = int.from_bytes(chunk[:8], "little") + 8 if len(chunk) >= 8 else 0
+            if position + len(chunk) > data_start:
+                addnet.update(chunk[max(0, data_start - position) :])
+            start, end = max(position, LEGACY_HASH_START), min(position + len(chunk), LEGACY_HASH_END)
+            if start < end:
+                legacy.update(chunk[start - position : end - position])
+            position += len(chunk)
+
+    is_safetensors = os.path.splitext(path)[1] in [".safetensors", ".sft"] and data_start is not None and data_start <= position
+    return {
+        "sha256": sha256.hexdigest(),
+        "addnet": addnet.hexdigest() if is_safetensors else None,
+        "legacy": legacy.hexdigest()[0:8],
+    }
+
+
+def get_file_hashes(path: str) -> Dict[str, str]:
+    r"""
+    hashes of the file from the index, computed and added to the index if the file is new or changed
+    """
+    key = _file_key(path)
+    with _lock:
+        entry = _entries.get(key["path"])
+        if entry is None or any(entry[k] != v for k, v in key.items()):
+            _load_index()
+            entry = _entries.get(key["path"])
+        if entry is not None and all(entry[k] == v for k, v in key.items()):
+            return entry["hashes"]
+
+    logger.info(f"calculating hashes of {path} / ハッシュを計算しています: {path}")
+    hashes = compute_file_hashes(path)
+    if _file_key(path) == key:  # not changed while hashing
+        with _lock:
+            _append({**key, "hashes": hashes})
+    return hashes
+
+
+def update_in_background(path: str) -> threading.Thread:
+    r"""
+    adds the hashes of a newly written file to the index in a background thread, so the next use of the hashes does not
+    read the file
+    """
+
+    def update():
+        try:
+            get_file_hashes(path)
+        except OSError as e:
+            logger.warning(f"failed to hash {path}: {e} / ハッシュを計算できませんでした: {path}")
+
+    thread = threading.Thread(target=update, name="hash_index", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,113 @@
+# shared-memory arena for cached latents
+#
+# DataLoader workers receive the dataset either by fork (copy-on-write) or by pickling (spawn). In both cases
+# per-image latent tensors end up duplicated or sent one storage at a time. The arena packs all latents of the
+# same shape into one contiguous shared-memory tensor and rebinds each ImageInfo to a view of it, so workers
+# attach to a handful of storages without copying the data.
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# (field name, shape, dtype)
+ArenaKey = Tuple[str, Tuple[int, ...], torch.dtype]
+
+LATENTS = "latents"
+LATENTS_FLIPPED = "latents_flipped"
+ALPHA_MASK = "alpha_mask"
+
+
+def _to_tensor(x: Any) -> Optional[torch.Tensor]:
+    if x is None:
+        return None
+    if isinstance(x, np.ndarray):
+        return torch.from_numpy(np.ascontiguousarray(x))
+    return x
+
+
+class LatentArena:
+    """
+    One contiguous shared-memory tensor per (field, shape, dtype) and an index from image_key to its slot.
+    """
+
+    def __init__(self):
+        self.tensors: Dict[ArenaKey, torch.Tensor] = {}
+        self.index: Dict[str, Dict[str, Tuple[ArenaKey, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.tensors.values())
+
+    def get(self, image_key: str, field: str = LATENTS) -> Optional[torch.Tensor]:
+        slot = self.index.get(image_key, {}).get(field)
+        if slot is None:
+            return None
+        key, i = slot
+        return self.tensors[key][i]
+
+    @classmethod
+    def build(
+        cls,
+        image_infos: List[Any],
+        load_latents_from_disk: Optional[Callable[[str, Tuple[int, int]], Tuple]] = None,
+    ) -> "LatentArena":
+        """
+        Pack the cached latents of `image_infos` into shared memory and rebind each info to views of the arena.
+
+        Latents already held in memory (`info.latents`) are moved into the arena. If `load_latents_from_disk` is given,
+        infos that only have `info.latents_npz` are loaded once here, so the npz files are not read again every epoch.
+        Infos without any cached latents are left untouched.
+        """
+        arena = cls()
+
+        # collect tensors per arena key. loading from disk is done here, so the peak memory is the loaded latents
+        # plus one arena tensor at a time
+        groups: Dict[ArenaKey, List[Tuple[Any, str, torch.Tensor]]] = {}
+        loaded = 0
+        for info in image_infos:
+            if info.latents is None:
+                if load_latents_from_disk is None or info.latents_npz is None:
+                    continue
+                latents, original_size, crop_ltrb, flipped_latents, alpha_mask = load_latents_from_disk(
+                    info.latents_npz, info.bucket_reso
+                )
+                info.latents = _to_tensor(latents)
+                info.latents_flipped = _to_tensor(flipped_latents)
+                info.alpha_mask = _to_tensor(alpha_mask)
+                info.latents_original_size = original_size
+                info.latents_crop_ltrb = crop_ltrb
+                loaded += 1
+
+            for field in (LATENTS, LATENTS_FLIPPED, ALPHA_MASK):
+                tensor = getattr(info, field)
+                if tensor is None:
+                    continue
+                key = (field, tuple(tensor.shape), tensor.dtype)
+                groups.setdefault(key, []).append((info, field, tensor))
+
+        for key, items in groups.items():
+            _, shape, dtype = key
+            storage = torch.empty((len(items),) + shape, dtype=dtype).share_memory_()
+            for i, (info, field, tensor) in enumerate(items):
+                storage[i].copy_(tensor)
+                setattr(info, field, storage[i])  # view of the shared storage, the original tensor is released here
+                arena.index.setdefault(info.image_key, {})[field] = (key, i)
+            arena.tensors[key] = storage
+
+        logger.info(
+            f"latent arena: {len(arena)} images, {len(arena.tensors)} shared tensors, {arena.nbytes / 1024**2:.1f} MiB"
+            + (f", {loaded} loaded from disk" if loaded > 0 else "")
+        )
+        return arena
@@ -0,0 +1,153 @@
+# concurrent loading of the models of a training script (e.g. FLUX, CLIP-L, T5-XXL and AE)
+#
+# the models are read from separate files, so loading them one after another waits for the sum of the reads. the loads
+# are run in threads, reading and casting release the GIL. each load is charged with the host memory of the loaded
+# model, and a load starts only if the charged memory fits the budget, so a small host RAM falls back to loading one
+# model at a time instead of swapping.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from library.utils import MemoryEfficientSafeOpen, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+TIMELINE_WIDTH = 40
+
+
+def get_available_memory() -> Optional[int]:
+    r"""
+    MemAvailable of /proc/meminfo in bytes, None if it is not available (not Linux)
+    """
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def estimate_loaded_size(paths: List[Optional[str]], dtype: Optional[torch.dtype] = None) -> int:
+    r"""
+    bytes of the tensors of the safetensors files after loading with `dtype` (as stored if None), from the headers.
+    missing files count as 0
+    """
+    size = 0
+    for path in paths:
+        if path is None or not os.path.isfile(path):
+            continue
+        with MemoryEfficientSafeOpen(path) as f:
+            for key in f.keys():
+                metadata = f.header[key]
+                if dtype is None:
+                    offset_start, offset_end = metadata["data_offsets"]
+                    size += offset_end - offset_start
+                else:
+                    numel = 1
+                    for dim in metadata["shape"]:
+                        numel *= dim
+                    size += numel * dtype.itemsize
+    return size
+
+
+class ModelLoadRecord:
+    def __init__(self, name: str, size: int, start: float, end: float):
+        self.name = name
+        self.size = size
+        self.start = start
+        self.end = end
+
+
+class ModelLoader:
+    r"""
+    runs the added loaders concurrently within a host memory budget
+
+    Args:
+        memory_budget: bytes of host memory for the loaded models. None for the available memory at `run`, 0 to load
+            one model at a time
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None):
+        self.memory_budget = memory_budget
+        self.tasks: List[tuple] = []  # (name, load function, size)
+        self.records: List[ModelLoadRecord] = []
+
+    def add(self, name: str, load_fn: Callable[[], Any], size: int = 0):
+        r"""
+        Args:
+            size: host memory of the loaded model in bytes, see `estimate_loaded_size`
+        """
+        self.tasks.append((name, load_fn, size))
+
+    def run(self) -> Dict[str, Any]:
+        r"""
+        loads all models and returns name -> loaded model. the loads are started in the order of `add`, a load which
+        does not fit the budget waits until the running loads finish, and runs alone if it still does not fit
+        """
+        budget = self.memory_budget if self.memory_budget is not None else get_available_memory()
+        condition = threading.Condition()
+        state = {"charged": 0, "running": 0, "next": 0}
+        origin = time.perf_counter()
+
+        def load(index: int, name: str, load_fn: Callable[[], Any], size: int):
+            with condition:
+                # start in the order of `add`, and only if the model fits the budget or nothing else is running
+                while state["next"] != index or (
+                    budget is not None and state["running"] > 0 and state["charged"] + size > budget
+                ):
+                    condition.wait()
+                if budget is not None and state["charged"] + size > budget:
+                    logger.warning(
+                        f"{name} does not fit the memory budget ({(state['charged'] + size) / 1024**3:.1f} GB > {budget / 1024**3:.1f} GB)"
+                        f" / {name}はメモリの予算に収まりません（{(state['charged'] + size) / 1024**3:.1f} GB > {budget / 1024**3:.1f} GB）"
+                    )
+                state["charged"] += size  # the loaded model stays in memory
+                state["running"] += 1
+                state["next"] += 1
+                condition.notify_all()
+
+            start = time.perf_counter() - origin
+            try:
+                return load_fn()
+            finally:
+                self.records.append(ModelLoadRecord(name, size, start, time.perf_counter() - origin))
+                with condition:
+                    state["running"] -= 1
+                    condition.notify_all()
+
+        self.records = []
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            futures = [executor.submit(load, i, *task) for i, task in enumerate(self.tasks)]
+            results = {task[0]: future.result() for task, future in zip(self.tasks, futures)}
+
+        logger.info(self.format_timeline())
+        return results
+
+    def format_timeline(self) -> str:
+        r"""
+        one line for each model with its start, end and a bar on the common time axis
+        """
+        total = max([record.end for record in self.records], default=0.0)
+        sequential = sum([record.end - record.start for record in self.records])
+        lines = [f"model load timeline: {total:.1f}s, {sequential:.1f}s if sequential / モデル読み込みのタイムライン"]
+        scale = TIMELINE_WIDTH / total if total > 0 else 0.0
+        name_width = max([len(record.name) for record in self.records], default=0)
+        for record in sorted(self.records, key=lambda r: r.start):
+            begin = min(int(record.start * scale), TIMELINE_WIDTH - 1)
+            end = max(begin + 1, int(record.end * scale))
+            bar = " " * begin + "#" * (end - begin) + " " * (TIMELINE_WIDTH - end)
+            lines.append(
+                f"  {record.name:<{name_width}} |{bar}| {record.start:6.1f}s - {record.end:6.1f}s, {record.size / 1024**3:.2f} GB"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,271 @@
+# opt-in per-step phase profiler for the training loop
+#
+# records timed spans (data wait, forward, backward, optimizer, sampling, saving, ...) for each step and exports them as
+# a Chrome trace (open with chrome://tracing or https://ui.perfetto.dev) and JSONL summaries every N steps.
+# when disabled, `span` is a no-op context manager and nothing is recorded.
+
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StepProfiler:
+    def __init__(
+        self,
+        trace_path: Optional[str] = None,
+        summary_path: Optional[str] = None,
+        summary_every: int = 100,
+        synchronize: Optional[Callable[[], None]] = None,
+        enabled: bool = True,
+    ):
+        r"""
+        Args:
+            trace_path: Chrome trace output file, None to disable the trace
+            summary_path: JSONL summary output file, None to only log the summaries
+            summary_every: steps per summary
+            synchronize: called at the end of each span, e.g. to wait for the GPU. without it, spans measure the
+                time on the host, and GPU work is attributed to the span which waits for it
+        """
+        self.enabled = enabled
+        self.summary_every = summary_every
+        self.synchronize = synchronize
+        self.pid = os.getpid()
+        self.origin_ns = time.perf_counter_ns()
+
+        self.trace_file = None
+        self.num_trace_events = 0
+        self.summary_file = None
+        if enabled:
+            if trace_path is not None:
+                os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+                self.trace_file = open(trace_path, "w", encoding="utf-8")
+                self.trace_file.write("[\n")
+            if summary_path is not None:
+                os.makedirs(os.path.dirname(summary_path) or ".", exist_ok=True)
+                self.summary_file = open(summary_path, "a", encoding="utf-8")
+
+        self.step = 0
+        self.open_spans: Dict[str, int] = {}
+        self.step_start_ns: Optional[int] = None
+        self.step_samples = 0
+        self.last_step_end_ns: Optional[int] = None
+        self.step_attrs: Dict[str, Any] = {}
+
+        # current summary window
+        self.window_durations: Dict[str, List[float]] = {}
+        self.window_start_ns: Optional[int] = None
+        self.window_steps = 0
+        self.window_samples = 0
+        self.window_attr_steps: Dict[str, Dict[str, int]] = {}
+        self.window_attr_durations: Dict[str, Dict[str, List[float]]] = {}
+
+    @classmethod
+    def disabled(cls) -> "StepProfiler":
+        return cls(enabled=False)
+
+    def _trace(self, name: str, start_ns: int, end_ns: int, args: Optional[Dict[str, Any]] = None):
+        if self.trace_file is None:
+            return
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start_ns - self.origin_ns) / 1000.0,
+            "dur": (end_ns - start_ns) / 1000.0,
+            "pid": self.pid,
+            "tid": 0,
+            "args": {"step": self.step, **(args or {})},
+        }
+        self.trace_file.write(("" if self.num_trace_events == 0 else ",\n") + json.dumps(event))
+        self.num_trace_events += 1
+
+    def _record(self, name: str, start_ns: int, end_ns: int, args: Optional[Dict[str, Any]] = None):
+        self.window_durations.setdefault(name, []).append((end_ns - start_ns) / 1e6)
+        self._trace(name, start_ns, end_ns, args)
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name: str, args: Dict[str, Any]):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name, **args)
+
+    def begin(self, name: str):
+        r"""
+        start a span without a context manager, for long blocks. must be closed by `end` with the same name
+        """
+        if self.enabled:
+            self.open_spans[name] = time.perf_counter_ns()
+
+    def end(self, name: str, **args):
+        if not self.enabled or name not in self.open_spans:
+            return
+        start_ns = self.open_spans.pop(name)
+        if self.synchronize is not None:
+            self.synchronize()
+        self._record(name, start_ns, time.perf_counter_ns(), args)
+
+    def record(self, name: str, start_ns: int, **args):
+        r"""
+        records a span from `start_ns` (time.perf_counter_ns) to now, for a span which is known only after it ends
+        """
+        if not self.enabled:
+            return
+        if self.synchronize is not None:
+            self.synchronize()
+        self._record(name, start_ns, time.perf_counter_ns(), args)
+
+    def set_step_attrs(self, **attrs):
+        r"""
+        attributes of the current step (e.g. bucket resolution), added to the trace and counted in the summary
+        """
+        if self.enabled:
+            self.step_attrs.update(attrs)
+
+    def begin_epoch(self):
+        r"""
+        call just before the batches of an epoch are iterated. data_wait of the first step is measured from here, so the
+        epoch end phases (validation, save, sample), recorded as their own spans, are not counted as waiting for data
+        """
+        if self.enabled:
+            self.last_step_end_ns = time.perf_counter_ns()
+
+    def begin_step(self, num_samples: int = 0):
+        if not self.enabled:
+            return
+        self.step_samples = num_samples
+        now = time.perf_counter_ns()
+        if self.window_start_ns is None:
+            self.window_start_ns = now
+        if self.last_step_end_ns is not None:
+            # time between the end of the previous step and the arrival of this batch
+            self._record("data_wait", self.last_step_end_ns, now)
+        self.step_start_ns = now
+
+    def end_step(self):
+        if not self.enabled or self.step_start_ns is None:
+            return
+        now = time.perf_counter_ns()
+        self._record("step", self.step_start_ns, now, self.step_attrs)
+        for key, value in self.step_attrs.items():
+            counts = self.window_attr_steps.setdefault(key, {})
+            counts[str(value)] = counts.get(str(value), 0) + 1
+            durations = self.window_attr_durations.setdefault(key, {})
+            durations.setdefault(str(value), []).append((now - self.step_start_ns) / 1e6)
+        self.step_attrs = {}
+        self.step_start_ns = None
+        self.last_step_end_ns = now
+        self.step += 1
+        self.window_steps += 1
+        self.window_samples += self.step_samples
+
+        if self.window_steps >= self.summary_every:
+            self.flush_summary()
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = (time.perf_counter_ns() - self.window_start_ns) / 1e9 if self.window_start_ns is not None else 0.0
+        phases = {}
+        for name, durations in self.window_durations.items():
+            durations = np.asarray(durations)
+            phases[name] = {
+                "count": int(len(durations)),
+                "mean_ms": float(durations.mean()),
+                "p95_ms": float(np.percentile(durations, 95)),
+                "total_ms": float(durations.sum()),
+            }
+        # step time for each attribute value, e.g. each bucket. the median is not affected by a few slow steps such as
+        # the first step of a bucket which compiles the model
+        step_ms_by_attr = {}
+        for key, values in self.window_attr_durations.items():
+            step_ms_by_attr[key] = {}
+            for value, durations in values.items():
+                durations = np.asarray(durations)
+                step_ms_by_attr[key][value] = {
+                    "count": int(len(durations)),
+                    "mean_ms": float(durations.mean()),
+                    "median_ms": float(np.median(durations)),
+                    "max_ms": float(durations.max()),
+                }
+        return {
+            "step": self.step,
+            "steps": self.window_steps,
+            "elapsed_s": elapsed,
+            "it_per_s": self.window_steps / elapsed if elapsed > 0 else 0.0,
+            "samples_per_s": self.window_samples / elapsed if elapsed > 0 else 0.0,
+            "phases": phases,
+            "step_attrs": self.window_attr_steps,
+            "step_ms_by_attr": step_ms_by_attr,
+        }
+
+    def flush_summary(self):
+        if not self.enabled or self.window_steps == 0:
+            return
+        summary = self.summary()
+        if self.summary_file is not None:
+            self.summary_file.write(json.dumps(summary) + "\n")
+            self.summary_file.flush()
+        if self.trace_file is not None:
+            self.trace_file.flush()
+
+        phases = ", ".join(f"{name} {p['mean_ms']:.1f}/{p['p95_ms']:.1f}ms" for name, p in summary["phases"].items())
+        logger.info(
+            f"profile: step {summary['step']}, {summary['it_per_s']:.3f} it/s, {summary['samples_per_s']:.3f} samples/s,"
+            f" mean/p95: {phases}"
+        )
+        for key, values in summary["step_ms_by_attr"].items():
+            steps = ", ".join(f"{value} {s['median_ms']:.1f}/{s['max_ms']:.1f}ms ({s['count']})" for value, s in values.items())
+            logger.info(f"profile: step median/max by {key}: {steps}")
+
+        self.window_durations = {}
+        self.window_start_ns = time.perf_counter_ns()
+        self.window_steps = 0
+        self.window_samples = 0
+        self.window_attr_steps = {}
+        self.window_attr_durations = {}
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush_summary()
+        if self.trace_file is not None:
+            self.trace_file.write("\n]\n")
+            self.trace_file.close()
+            self.trace_file = None
+        if self.summary_file is not None:
+            self.summary_file.close()
+            self.summary_file = None
+
+
+_profiler = StepProfiler.disabled()
+
+
+def set_profiler(profiler: StepProfiler):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler() -> StepProfiler:
+    return _profiler
+
+
+def span(name: str, **args):
+    r"""
+    span on the active profiler, usable from library code without passing the profiler around
+    """
+    return _profiler.span(name, **args)
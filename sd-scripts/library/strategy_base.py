@@ -2,8 +2,6 @@
 
 import os
 import re
-import signal
-from contextlib import contextmanager
 from typing import Any, List, Optional, Tuple, Union, Callable
 
 import numpy as np
@@ -14,6 +12,7 @@ from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextModelWithProjecti
 # TODO remove circular import by moving ImageInfo to a separate file
 # from library.train_util import ImageInfo
 
+from library import cache_io
 from library.utils import setup_logging
 
 setup_logging()
@@ -22,27 +21,6 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-# FIX: Timeout context manager for file I/O operations
-@contextmanager
-def timeout_context(seconds):
-    """Context manager to add timeout to blocking operations (Unix/Linux/Mac only)"""
-    def timeout_handler(signum, frame):
-        raise TimeoutError(f"Operation timed out after {seconds} seconds")
-
-    # Only works on Unix-like systems
-    if hasattr(signal, 'SIGALRM'):
-        old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(seconds)
-        try:
-            yield
-        finally:
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, old_handler)
-    else:
-        # Windows doesn't support SIGALRM, just yield without timeout
-        yield
-
-
 class TokenizeStrategy:
     _strategy = None  # strategy instance: actual strategy class
 
@@ -607,12 +585,11 @@ class LatentsCachingStrategy:
             latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
             key_reso_suffix = f"_{latents_size[0]}x{latents_size[1]}"  # e.g. "_32x64", HxW
 
-        # FIX: Add timeout to prevent hanging on network filesystem or corrupted files
+        # FIX: read through the I/O thread pool with a deadline to prevent hanging on network filesystem or corrupted files
         try:
-            with timeout_context(30):  # 30 second timeout for file I/O
-                npz = np.load(npz_path)
-        except TimeoutError:
-            error_msg = f"Timeout loading latents from {npz_path} after 30 seconds. Check filesystem/network."
+            npz = cache_io.load_npz(npz_path)
+        except TimeoutError as e:
+            error_msg = f"Timeout loading latents from {npz_path}: {e}"
             logger.error(error_msg)
             raise RuntimeError(error_msg)
         except Exception as e:
@@ -4,7 +4,7 @@ from typing import Any, List, Optional, Tuple, Union
 
 import torch
 from transformers import AutoTokenizer, AutoModel, Gemma2Model, GemmaTokenizerFast
-from library import train_util
+from library import cache_io, train_util
 from library.strategy_base import (
     LatentsCachingStrategy,
     TokenizeStrategy,
@@ -203,7 +203,7 @@ class LuminaTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy)
         Returns:
             List[np.ndarray]: hidden_state, input_ids, attention_mask
         """
-        data = np.load(npz_path)
+        data = cache_io.load_npz(npz_path)
         hidden_state = data["hidden_state"]
         attention_mask = data["attention_mask"]
         input_ids = data["input_ids"]
@@ -3,6 +3,7 @@
 import argparse
 import ast
 import asyncio
+import bisect
 from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
 import importlib
@@ -32,6 +33,8 @@ from packaging.version import Version
 import torch
 from library.device_utils import init_ipex, clean_memory_on_device
 from library.strategy_base import LatentsCachingStrategy, TokenizeStrategy, TextEncoderOutputsCachingStrategy, TextEncodingStrategy
+from library.latent_arena import LatentArena
+from library import cache_io, hash_index
 
 init_ipex()
 
@@ -342,6 +345,92 @@ class BucketManager:
         ar_error = (reso[0] / reso[1]) - aspect_ratio
         return reso, resized_size, ar_error
 
+    def select_buckets(
+        self, image_widths, image_heights, chunk_size: int = 65536
+    ) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]], np.ndarray]:
+        r"""
+        vectorized version of `select_bucket` for many images at once. the results are identical to calling `select_bucket`
+        for each image in order, including the order in which new buckets are added.
+        images with the same size get the same bucket, so each distinct size is computed only once.
+        """
+        image_widths = np.asarray(image_widths, dtype=np.int64)
+        image_heights = np.asarray(image_heights, dtype=np.int64)
+        if len(image_widths) == 0:
+            return [], [], np.zeros((0,), dtype=np.float64)
+
+        # pack (width, height) into one integer for fast unique
+        unique_sizes, inverse = np.unique((image_widths << 32) | image_heights, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        w = unique_sizes >> 32
+        h = unique_sizes & 0xFFFFFFFF
+        aspect_ratio = w / h
+
+        if not self.no_upscale:
+            predefined = np.array(self.predefined_resos, dtype=np.int64).reshape(-1, 2)
+
+            # prefer the same resolution if it is predefined, otherwise the one with the smallest aspect ratio error
+            bucket_ids = np.empty(len(w), dtype=np.int64)
+            for i in range(0, len(w), chunk_size):
+                chunk = slice(i, i + chunk_size)
+                ar_errors = self.predefined_aspect_ratios[None, :] - aspect_ratio[chunk, None]
+                ids = np.abs(ar_errors).argmin(axis=1)
+                exact = (predefined[None, :, 0] == w[chunk, None]) & (predefined[None, :, 1] == h[chunk, None])
+                has_exact = exact.any(axis=1)
+                ids[has_exact] = exact[has_exact].argmax(axis=1)
+                bucket_ids[chunk] = ids
+
+            bucket_w = predefined[bucket_ids, 0]
+            bucket_h = predefined[bucket_ids, 1]
+            ar_reso = bucket_w / bucket_h
+            scale = np.where(aspect_ratio > ar_reso, bucket_h / h, bucket_w / w)
+            resized_w = (w * scale + 0.5).astype(np.int64)
+            resized_h = (h * scale + 0.5).astype(np.int64)
+        else:
+            resized_w = w.copy()
+            resized_h = h.copy()
+
+            large = w * h > self.max_area
+            if large.any():
+                ar = aspect_ratio[large]
+
+                def round_to_steps(x):
+                    x = (x + 0.5).astype(np.int64)
+                    return x - x % self.reso_steps
+
+                # same logic as select_bucket: round the long or short side to reso_steps, whichever has less aspect error
+                width = np.sqrt(self.max_area * ar)
+                height = self.max_area / width
+
+                b_width_rounded = round_to_steps(width)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    b_height_in_wr = round_to_steps(b_width_rounded / ar)
+                    ar_width_rounded = b_width_rounded / b_height_in_wr
+
+                    b_height_rounded = round_to_steps(height)
+                    b_width_in_hr = round_to_steps(b_height_rounded * ar)
+                    ar_height_rounded = b_width_in_hr / b_height_rounded
+
+                use_width = np.abs(ar_width_rounded - ar) < np.abs(ar_height_rounded - ar)
+                resized_w[large] = np.where(use_width, b_width_rounded, (b_height_rounded * ar + 0.5).astype(np.int64))
+                resized_h[large] = np.where(use_width, (b_width_rounded / ar + 0.5).astype(np.int64), b_height_rounded)
+
+            bucket_w = resized_w - resized_w % self.reso_steps
+            bucket_h = resized_h - resized_h % self.reso_steps
+
+        ar_errors = (bucket_w / bucket_h - aspect_ratio)[inverse]
+
+        # add new buckets in the order of the first image which uses it, same as select_bucket
+        unique_resos = list(zip(bucket_w.tolist(), bucket_h.tolist()))
+        _, first_indices = np.unique(((bucket_w << 32) | bucket_h)[inverse], return_index=True)
+        for index in np.sort(first_indices):
+            self.add_if_new_reso(unique_resos[inverse[index]])
+
+        unique_resized_sizes = list(zip(resized_w.tolist(), resized_h.tolist()))
+        inverse = inverse.tolist()
+        resos = [unique_resos[i] for i in inverse]
+        resized_sizes = [unique_resized_sizes[i] for i in inverse]
+        return resos, resized_sizes, ar_errors
+
     @staticmethod
     def get_crop_ltrb(bucket_reso: Tuple[int, int], image_size: Tuple[int, int]):
         # Stability AIの前処理に合わせてcrop left/topを計算する。crop rightはflipのaugmentationのために求める
@@ -733,6 +822,7 @@ class BaseDataset(torch.utils.data.Dataset):
         self.tokenize_strategy = None
         self.text_encoder_output_caching_strategy = None
         self.latents_caching_strategy = None
+        self.latent_arena: Optional[LatentArena] = None
 
     def set_current_strategies(self):
         self.tokenize_strategy = TokenizeStrategy.get_strategy()
@@ -1028,15 +1118,14 @@ class BaseDataset(torch.utils.data.Dataset):
                         "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
                     )
 
-            img_ar_errors = []
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, ar_error = self.bucket_manager.select_bucket(
-                    image_width, image_height
-                )
-
-                # logger.info(image_info.image_key, image_info.bucket_reso)
-                img_ar_errors.append(abs(ar_error))
+            image_infos = list(self.image_data.values())
+            resos, resized_sizes, ar_errors = self.bucket_manager.select_buckets(
+                [image_info.image_size[0] for image_info in image_infos],
+                [image_info.image_size[1] for image_info in image_infos],
+            )
+            for image_info, reso, resized_size in zip(image_infos, resos, resized_sizes):
+                image_info.bucket_reso, image_info.resized_size = reso, resized_size
+            img_ar_errors = np.abs(ar_errors)
 
             self.bucket_manager.sort()
         else:
@@ -1107,6 +1196,34 @@ class BaseDataset(torch.utils.data.Dataset):
             ]
         )
 
+    def is_latents_disk_cached(self, caching_strategy: LatentsCachingStrategy) -> bool:
+        r"""
+        True if the latents of all images are cached to disk, so `new_cache_latents` does not need the model
+        """
+        if not caching_strategy.cache_to_disk:
+            return False
+        for info in self.image_data.values():
+            if info.latents_npz is not None:  # fine tuning dataset
+                continue
+            subset = self.image_to_subset[info.image_key]
+            npz_path = caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size)
+            if not caching_strategy.is_disk_cached_latents_expected(info.bucket_reso, npz_path, subset.flip_aug, subset.alpha_mask):
+                return False
+        return True
+
+    def is_text_encoder_outputs_disk_cached(self, caching_strategy: TextEncoderOutputsCachingStrategy) -> bool:
+        r"""
+        True if the text encoder outputs of all images are cached to disk, so `new_cache_text_encoder_outputs` does not
+        need the models
+        """
+        if not caching_strategy.cache_to_disk:
+            return False
+        for info in self.image_data.values():
+            npz_path = caching_strategy.get_outputs_npz_path(info.absolute_path)
+            if not caching_strategy.is_disk_cached_outputs_expected(npz_path):
+                return False
+        return True
+
     def new_cache_latents(self, model: Any, accelerator: Accelerator):
         r"""
         a brand new method to cache latents. This method caches latents with caching strategy.
@@ -1211,6 +1328,15 @@ class BaseDataset(torch.utils.data.Dataset):
         finally:
             executor.shutdown()
 
+    def share_latents(self):
+        r"""
+        move cached latents to a shared-memory arena, so DataLoader workers attach to them without copying.
+        latents cached to disk are loaded once here instead of being read from npz files every epoch.
+        """
+        caching_strategy = self.latents_caching_strategy or LatentsCachingStrategy.get_strategy()
+        load_fn = caching_strategy.load_latents_from_disk if caching_strategy is not None else None
+        self.latent_arena = LatentArena.build(list(self.image_data.values()), load_fn)
+
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True, file_suffix=".npz"):
         # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
         logger.info("caching latents.")
@@ -1547,6 +1673,20 @@ class BaseDataset(torch.utils.data.Dataset):
     def __len__(self):
         return self._length
 
+    def get_cache_files(self, index) -> List[str]:
+        r"""
+        cache files (npz) read by __getitem__ for the batch of `index`, None for the images without a cache file
+        """
+        if self.caching_mode is not None:
+            return []
+        bucket = self.bucket_manager.buckets[self.buckets_indices[index].bucket_index]
+        bucket_batch_size = self.buckets_indices[index].bucket_batch_size
+        image_index = self.buckets_indices[index].batch_index * bucket_batch_size
+        batch_image_infos = [self.image_data[image_key] for image_key in bucket[image_index : image_index + bucket_batch_size]]
+        return [info.latents_npz for info in batch_image_infos if info.latents is None] + [
+            info.text_encoder_outputs_npz for info in batch_image_infos if info.text_encoder_outputs is None
+        ]
+
     def __getitem__(self, index):
         bucket = self.bucket_manager.buckets[self.buckets_indices[index].bucket_index]
         bucket_batch_size = self.buckets_indices[index].bucket_batch_size
@@ -1555,6 +1695,9 @@ class BaseDataset(torch.utils.data.Dataset):
         if self.caching_mode is not None:  # return batch for latents/text encoder outputs caching
             return self.get_item_for_caching(bucket, bucket_batch_size, image_index)
 
+        # start reading the cache files of this batch in parallel, they are consumed in order below
+        cache_io.prefetch(self.get_cache_files(index))
+
         loss_weights = []
         captions = []
         input_ids_list = []
@@ -1994,6 +2137,10 @@ class DreamBoothDataset(BaseDataset):
                             size_set_count += 1
                     logger.info(f"set image size from cache files: {size_set_count}/{len(img_paths)}")
 
+                # probe the remaining image sizes and read captions in parallel. image sizes are reused from the image info
+                # cache as long as the file size and mtime of the image are unchanged, so only new or changed images are probed
+                sizes, captions_by_path = self.scan_images(img_paths, sizes, info_cache_file, subset, read_caption)
+
             # We want to create a training and validation split. This should be improved in the future
             # to allow a clearer distinction between training and validation. This can be seen as a
             # short-term solution to limit what is necessary to implement validation datasets
@@ -2019,14 +2166,14 @@ class DreamBoothDataset(BaseDataset):
             logger.info(f"found directory {subset.image_dir} contains {len(img_paths)} image files")
 
             if use_cached_info_for_subset:
-                captions = [meta["caption"] for meta in metas.values()]
+                captions = [metas[img_path]["caption"] for img_path in img_paths]
                 missing_captions = [img_path for img_path, caption in zip(img_paths, captions) if caption is None or caption == ""]
             else:
                 # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
                 captions = []
                 missing_captions = []
-                for img_path in tqdm(img_paths, desc="read caption"):
-                    cap_for_img = read_caption(img_path, subset.caption_extension, subset.enable_wildcard)
+                for img_path in img_paths:
+                    cap_for_img = captions_by_path[img_path]
                     if cap_for_img is None and subset.class_tokens is None:
                         logger.warning(
                             f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
@@ -2056,16 +2203,6 @@ class DreamBoothDataset(BaseDataset):
                         break
                     logger.warning(missing_caption)
 
-            if not use_cached_info_for_subset and subset.cache_info:
-                logger.info(f"cache image info for / 画像情報をキャッシュします : {info_cache_file}")
-                sizes = [self.get_image_size(img_path) for img_path in tqdm(img_paths, desc="get image size")]
-                matas = {}
-                for img_path, caption, size in zip(img_paths, captions, sizes):
-                    matas[img_path] = {"caption": caption, "resolution": list(size)}
-                with open(info_cache_file, "w", encoding="utf-8") as f:
-                    json.dump(matas, f, ensure_ascii=False, indent=2)
-                logger.info(f"cache image info done for / 画像情報を出力しました : {info_cache_file}")
-
             # if sizes are not set, image size will be read in make_buckets
             return img_paths, captions, sizes
 
@@ -2141,6 +2278,71 @@ class DreamBoothDataset(BaseDataset):
 
         self.num_reg_images = num_reg_images
 
+    def scan_images(
+        self,
+        img_paths: List[str],
+        sizes: List[Optional[Tuple[int, int]]],
+        info_cache_file: str,
+        subset: DreamBoothSubset,
+        read_caption: Callable[[str, str, bool], Optional[str]],
+    ) -> Tuple[List[Optional[Tuple[int, int]]], Dict[str, Optional[str]]]:
+        r"""
+        get image sizes and captions of all images with a thread pool, and update the image info cache.
+        cache entries are keyed by (path, file size, mtime), so only new or changed images are probed.
+        the cache keeps the format of `cache_info`, so it can also be used with `cache_info=true`.
+        """
+        info_cache = {}
+        if os.path.isfile(info_cache_file):
+            try:
+                with open(info_cache_file, "r", encoding="utf-8") as f:
+                    info_cache = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"failed to read image info cache, ignored / 画像情報キャッシュの読み込みに失敗しました: {info_cache_file}, {e}")
+                info_cache = {}
+
+        def scan(i: int):
+            img_path = img_paths[i]
+            st = os.stat(img_path)
+            size = sizes[i]
+            if size is None:
+                entry = info_cache.get(img_path)
+                if (
+                    entry is not None
+                    and entry.get("size") == st.st_size
+                    and entry.get("mtime") == st.st_mtime_ns
+                    and entry.get("resolution") is not None
+                ):
+                    size = tuple(entry["resolution"])
+                else:
+                    size = self.get_image_size(img_path)
+
+            caption = read_caption(img_path, subset.caption_extension, subset.enable_wildcard)
+            cached_caption = caption if caption is not None else (subset.class_tokens or "")
+            entry = {"caption": cached_caption, "resolution": list(size), "size": st.st_size, "mtime": st.st_mtime_ns}
+            return size, caption, entry
+
+        with ThreadPoolExecutor() as executor:
+            results = list(tqdm(executor.map(scan, range(len(img_paths))), total=len(img_paths), desc="scan images"))
+
+        sizes = [size for size, _, _ in results]
+        captions_by_path = {img_path: caption for img_path, (_, caption, _) in zip(img_paths, results)}
+
+        new_info_cache = {img_path: entry for img_path, (_, _, entry) in zip(img_paths, results)}
+        if new_info_cache != info_cache:
+            # write to a temporary file and rename, other processes may read the cache at the same time
+            tmp_file = f"{info_cache_file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(new_info_cache, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_file, info_cache_file)
+                logger.info(f"cache image info done for / 画像情報を出力しました : {info_cache_file}")
+            except OSError as e:
+                logger.warning(f"failed to write image info cache / 画像情報キャッシュの書き込みに失敗しました: {info_cache_file}, {e}")
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+        return sizes, captions_by_path
+
 
 class FineTuningDataset(BaseDataset):
     def __init__(
@@ -2507,12 +2709,24 @@ class ControlNetDataset(BaseDataset):
     def new_cache_latents(self, model: Any, accelerator: Accelerator):
         return self.dreambooth_dataset_delegate.new_cache_latents(model, accelerator)
 
+    def share_latents(self):
+        return self.dreambooth_dataset_delegate.share_latents()
+
     def new_cache_text_encoder_outputs(self, models: List[Any], is_main_process: bool):
         return self.dreambooth_dataset_delegate.new_cache_text_encoder_outputs(models, is_main_process)
 
+    def is_latents_disk_cached(self, caching_strategy: LatentsCachingStrategy) -> bool:
+        return False  # conditioning images are not checked
+
+    def is_text_encoder_outputs_disk_cached(self, caching_strategy: TextEncoderOutputsCachingStrategy) -> bool:
+        return self.dreambooth_dataset_delegate.is_text_encoder_outputs_disk_cached(caching_strategy)
+
     def __len__(self):
         return self.dreambooth_dataset_delegate.__len__()
 
+    def get_cache_files(self, index) -> List[str]:
+        return self.dreambooth_dataset_delegate.get_cache_files(index)
+
     def __getitem__(self, index):
         example = self.dreambooth_dataset_delegate[index]
 
@@ -2584,6 +2798,58 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             self.num_train_images += dataset.num_train_images
             self.num_reg_images += dataset.num_reg_images
 
+        # readahead of the cache files in the order of the sampler, see set_readahead
+        self.readahead = 0
+        self.readahead_sampler = None
+        self.readahead_epoch = None
+        self.readahead_num_processes = 1
+        self.readahead_order = None  # (epoch, indices in the order of the sampler, index -> position)
+
+    def set_readahead(self, sampler: "SeekableRandomSampler", current_epoch, num_batches: int, num_processes: int = 1):
+        r"""
+        prefetch the cache files of the next `num_batches` batches which the sampler gives to the same DataLoader worker,
+        in addition to the current batch. `current_epoch` is the shared epoch value of the collator (1-based).
+        the batches of an epoch are dealt to the processes and then to the workers in turn, so the next batch of a worker
+        is num_processes * num_workers positions later in the order
+        """
+        self.readahead = num_batches
+        self.readahead_sampler = sampler
+        self.readahead_epoch = current_epoch
+        self.readahead_num_processes = num_processes
+
+    def get_cache_files(self, idx) -> List[str]:
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        sample_idx = idx - (self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0)
+        return self.datasets[dataset_idx].get_cache_files(sample_idx)
+
+    def prefetch_following(self, idx):
+        epoch = self.readahead_epoch.value
+        # the buckets are shuffled by the collator after the first batch of an epoch, the files are known after it
+        if epoch < 1 or any(dataset.current_epoch != epoch for dataset in self.datasets):
+            return
+        paths = self.get_cache_files(idx)
+        if len(paths) == 0:
+            return  # nothing is read from the disk
+
+        if self.readahead_order is None or self.readahead_order[0] != epoch:
+            order = self.readahead_sampler.indices(epoch - 1)  # the sampler is seeked with the 0-based epoch
+            self.readahead_order = (epoch, order, {index: position for position, index in enumerate(order)})
+        _, order, positions = self.readahead_order
+
+        # the reader drops the oldest prefetches beyond max_prefetch, they are the ones needed first
+        num_batches = min(self.readahead, cache_io.get_cache_reader().max_prefetch // len(paths) - 1)
+        worker_info = torch.utils.data.get_worker_info()
+        stride = self.readahead_num_processes * (worker_info.num_workers if worker_info is not None else 1)
+        position = positions[idx]
+        for index in order[position + stride : position + stride * (num_batches + 1) : stride]:
+            paths += self.get_cache_files(index)
+        cache_io.prefetch(paths)
+
+    def __getitem__(self, idx):
+        if self.readahead > 0:
+            self.prefetch_following(idx)
+        return super().__getitem__(idx)
+
     def add_replacement(self, str_from, str_to):
         for dataset in self.datasets:
             dataset.add_replacement(str_from, str_to)
@@ -2614,6 +2880,11 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             dataset.new_cache_latents(model, accelerator)
         accelerator.wait_for_everyone()
 
+    def share_latents(self):
+        for i, dataset in enumerate(self.datasets):
+            logger.info(f"[Dataset {i}]")
+            dataset.share_latents()
+
     def cache_text_encoder_outputs(
         self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
     ):
@@ -2650,6 +2921,12 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
     def is_latent_cacheable(self) -> bool:
         return all([dataset.is_latent_cacheable() for dataset in self.datasets])
 
+    def is_latents_disk_cached(self, caching_strategy: LatentsCachingStrategy) -> bool:
+        return all([dataset.is_latents_disk_cached(caching_strategy) for dataset in self.datasets])
+
+    def is_text_encoder_outputs_disk_cached(self, caching_strategy: TextEncoderOutputsCachingStrategy) -> bool:
+        return all([dataset.is_text_encoder_outputs_disk_cached(caching_strategy) for dataset in self.datasets])
+
     def is_text_encoder_output_cacheable(self) -> bool:
         return all([dataset.is_text_encoder_output_cacheable() for dataset in self.datasets])
 
@@ -2877,6 +3154,12 @@ class MinimalDataset(BaseDataset):
     def is_latent_cacheable(self) -> bool:
         return False
 
+    def is_latents_disk_cached(self, caching_strategy: LatentsCachingStrategy) -> bool:
+        return False
+
+    def is_text_encoder_outputs_disk_cached(self, caching_strategy: TextEncoderOutputsCachingStrategy) -> bool:
+        return False
+
     def __len__(self):
         raise NotImplementedError
 
@@ -2884,6 +3167,9 @@ class MinimalDataset(BaseDataset):
     def set_current_epoch(self, epoch):
         self.current_epoch = epoch
 
+    def get_cache_files(self, index) -> List[str]:
+        return []
+
     def __getitem__(self, idx):
         r"""
         The subclass may have image_data for debug_dataset, which is a dict of ImageInfo objects.
@@ -3205,12 +3491,7 @@ def default(val, d):
 def model_hash(filename):
     """Old model hash used by stable-diffusion-webui"""
     try:
-        with open(filename, "rb") as file:
-            m = hashlib.sha256()
-
-            file.seek(0x100000)
-            m.update(file.read(0x10000))
-            return m.hexdigest()[0:8]
+        return hash_index.get_file_hashes(filename)["legacy"]
     except FileNotFoundError:
         return "NOFILE"
     except IsADirectoryError:  # Linux?
@@ -3222,14 +3503,7 @@ def model_hash(filename):
 def calculate_sha256(filename):
     """New model hash used by stable-diffusion-webui"""
     try:
-        hash_sha256 = hashlib.sha256()
-        blksize = 1024 * 1024
-
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(blksize), b""):
-                hash_sha256.update(chunk)
-
-        return hash_sha256.hexdigest()
+        return hash_index.get_file_hashes(filename)["sha256"]
     except FileNotFoundError:
         return "NOFILE"
     except IsADirectoryError:  # Linux?
@@ -4336,6 +4610,11 @@ def verify_training_args(args: argparse.Namespace):
             "cache_latents_to_disk is enabled, so cache_latents is also enabled / cache_latents_to_diskが有効なため、cache_latentsを有効にします"
         )
 
+    if getattr(args, "shared_memory_latents", False) and not args.cache_latents:
+        logger.warning(
+            "shared_memory_latents requires cache_latents or cache_latents_to_disk, so it is ignored / shared_memory_latentsはcache_latentsまたはcache_latents_to_diskが必要なため無視されます"
+        )
+
     # noise_offset, perlin_noise, multires_noise_iterations cannot be enabled at the same time
     # # Listを使って数えてもいいけど並べてしまえ
     # if args.noise_offset is not None and args.multires_noise_iterations is not None:
@@ -4485,12 +4764,54 @@ def add_dataset_arguments(
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--shared_memory_latents",
+        action="store_true",
+        help="keep cached latents in shared memory, one contiguous tensor per latent shape, so DataLoader workers do not copy them."
+        " with cache_latents_to_disk, npz files are loaded once at startup instead of every epoch"
+        " / キャッシュしたlatentを共有メモリに置き、DataLoaderのワーカー間でコピーせずに共有する。"
+        "cache_latents_to_diskと併用した場合、npzファイルは毎エポックではなく起動時に一度だけ読み込まれる",
+    )
     parser.add_argument(
         "--skip_cache_check",
         action="store_true",
         help="skip the content validation of cache (latent and text encoder output). Cache file existence check is always performed, and cache processing is performed if the file does not exist"
         " / cacheの内容の検証をスキップする（latentとテキストエンコーダの出力）。キャッシュファイルの存在確認は常に行われ、ファイルがなければキャッシュ処理が行われる",
     )
+    parser.add_argument(
+        "--cache_read_timeout",
+        type=float,
+        default=30.0,
+        help="timeout in seconds for reading a cache file (latents / text encoder outputs) / キャッシュファイル（latent、テキストエンコーダの出力）の読み込みのタイムアウト秒数",
+    )
+    parser.add_argument(
+        "--cache_read_retries",
+        type=int,
+        default=2,
+        help="number of retries with exponential backoff when reading a cache file fails, for network volumes"
+        " / キャッシュファイルの読み込みに失敗したときの再試行回数（指数バックオフ、ネットワークボリューム向け）",
+    )
+    parser.add_argument(
+        "--cache_read_threads",
+        type=int,
+        default=4,
+        help="number of I/O threads per process for reading cache files / キャッシュファイル読み込みのプロセスあたりのI/Oスレッド数",
+    )
+    parser.add_argument(
+        "--cache_read_ahead",
+        type=int,
+        default=4,
+        help="number of the following batches of each DataLoader worker whose cache files are read ahead in the order of"
+        " the sampler, 0 to read only the current batch / DataLoaderのワーカーごとに、サンプラーの順序でキャッシュファイルを"
+        "先読みする後続のバッチ数。0で現在のバッチのみ読み込む",
+    )
+    parser.add_argument(
+        "--cache_read_log_every",
+        type=int,
+        default=0,
+        help="log the latency histogram of cache reads every N reads per process, 0 to disable"
+        " / キャッシュ読み込みのレイテンシのヒストグラムをプロセスごとにN回の読み込みごとに出力する、0で無効",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -4684,6 +5005,9 @@ def resume_from_local_or_hf_if_specified(accelerator, args):
 
     if not args.resume_from_huggingface:
         logger.info(f"resume training from local state: {args.resume}")
+        from library.async_checkpoint import recover_dir
+
+        recover_dir(args.resume.rstrip("/\\"))  # the state may have been replaced when the training was stopped
 
         # FIX: Manually set accelerator.step from checkpoint before loading
         # This works around accelerate 0.33.0's weights_only issue with random_states_0.pkl
@@ -5880,7 +6204,20 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
             save_and_remove_state_stepwise(args, accelerator, global_step)
 
 
-def save_and_remove_state_on_epoch_end(args: argparse.Namespace, accelerator, epoch_no, global_step=None):
+def save_state_dir(accelerator, state_dir: str, after: Callable[[], None], checkpoint_writer=None):
+    r"""
+    save the state to `state_dir` and call `after` (upload, removing old states). with `checkpoint_writer`
+    (library.async_checkpoint.AsyncCheckpointWriter), the state is moved to `state_dir` and `after` is called in its
+    worker thread
+    """
+    if checkpoint_writer is None:
+        accelerator.save_state(state_dir)
+        after()
+    else:
+        checkpoint_writer.save_state(accelerator, state_dir, after)
+
+
+def save_and_remove_state_on_epoch_end(args: argparse.Namespace, accelerator, epoch_no, global_step=None, checkpoint_writer=None):
     model_name = default_if_none(args.output_name, DEFAULT_EPOCH_NAME)
 
     logger.info("")
@@ -5893,21 +6230,24 @@ def save_and_remove_state_on_epoch_end(args: argparse.Namespace, accelerator, ep
         accelerator.step = global_step
 
     state_dir = os.path.join(args.output_dir, EPOCH_STATE_NAME.format(model_name, epoch_no))
-    accelerator.save_state(state_dir)
-    if args.save_state_to_huggingface:
-        logger.info("uploading state to huggingface.")
-        huggingface_util.upload(args, state_dir, "/" + EPOCH_STATE_NAME.format(model_name, epoch_no))
 
-    last_n_epochs = args.save_last_n_epochs_state if args.save_last_n_epochs_state else args.save_last_n_epochs
-    if last_n_epochs is not None:
-        remove_epoch_no = epoch_no - args.save_every_n_epochs * last_n_epochs
-        state_dir_old = os.path.join(args.output_dir, EPOCH_STATE_NAME.format(model_name, remove_epoch_no))
-        if os.path.exists(state_dir_old):
-            logger.info(f"removing old state: {state_dir_old}")
-            shutil.rmtree(state_dir_old)
+    def upload_and_remove_old_state():
+        if args.save_state_to_huggingface:
+            logger.info("uploading state to huggingface.")
+            huggingface_util.upload(args, state_dir, "/" + EPOCH_STATE_NAME.format(model_name, epoch_no))
+
+        last_n_epochs = args.save_last_n_epochs_state if args.save_last_n_epochs_state else args.save_last_n_epochs
+        if last_n_epochs is not None:
+            remove_epoch_no = epoch_no - args.save_every_n_epochs * last_n_epochs
+            state_dir_old = os.path.join(args.output_dir, EPOCH_STATE_NAME.format(model_name, remove_epoch_no))
+            if os.path.exists(state_dir_old):
+                logger.info(f"removing old state: {state_dir_old}")
+                shutil.rmtree(state_dir_old)
+
+    save_state_dir(accelerator, state_dir, upload_and_remove_old_state, checkpoint_writer)
 
 
-def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_no):
+def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_no, checkpoint_writer=None):
     model_name = default_if_none(args.output_name, DEFAULT_STEP_NAME)
 
     logger.info("")
@@ -5919,25 +6259,28 @@ def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_n
     accelerator.step = step_no
 
     state_dir = os.path.join(args.output_dir, STEP_STATE_NAME.format(model_name, step_no))
-    accelerator.save_state(state_dir)
-    if args.save_state_to_huggingface:
-        logger.info("uploading state to huggingface.")
-        huggingface_util.upload(args, state_dir, "/" + STEP_STATE_NAME.format(model_name, step_no))
-
-    last_n_steps = args.save_last_n_steps_state if args.save_last_n_steps_state else args.save_last_n_steps
-    if last_n_steps is not None:
-        # last_n_steps前のstep_noから、save_every_n_stepsの倍数のstep_noを計算して削除する
-        remove_step_no = step_no - last_n_steps - 1
-        remove_step_no = remove_step_no - (remove_step_no % args.save_every_n_steps)
-
-        if remove_step_no > 0:
-            state_dir_old = os.path.join(args.output_dir, STEP_STATE_NAME.format(model_name, remove_step_no))
-            if os.path.exists(state_dir_old):
-                logger.info(f"removing old state: {state_dir_old}")
-                shutil.rmtree(state_dir_old)
 
+    def upload_and_remove_old_state():
+        if args.save_state_to_huggingface:
+            logger.info("uploading state to huggingface.")
+            huggingface_util.upload(args, state_dir, "/" + STEP_STATE_NAME.format(model_name, step_no))
 
-def save_state_on_train_end(args: argparse.Namespace, accelerator, global_step=None):
+        last_n_steps = args.save_last_n_steps_state if args.save_last_n_steps_state else args.save_last_n_steps
+        if last_n_steps is not None:
+            # last_n_steps前のstep_noから、save_every_n_stepsの倍数のstep_noを計算して削除する
+            remove_step_no = step_no - last_n_steps - 1
+            remove_step_no = remove_step_no - (remove_step_no % args.save_every_n_steps)
+
+            if remove_step_no > 0:
+                state_dir_old = os.path.join(args.output_dir, STEP_STATE_NAME.format(model_name, remove_step_no))
+                if os.path.exists(state_dir_old):
+                    logger.info(f"removing old state: {state_dir_old}")
+                    shutil.rmtree(state_dir_old)
+
+    save_state_dir(accelerator, state_dir, upload_and_remove_old_state, checkpoint_writer)
+
+
+def save_state_on_train_end(args: argparse.Namespace, accelerator, global_step=None, checkpoint_writer=None):
     model_name = default_if_none(args.output_name, DEFAULT_LAST_OUTPUT_NAME)
 
     logger.info("")
@@ -5950,11 +6293,13 @@ def save_state_on_train_end(args: argparse.Namespace, accelerator, global_step=N
         accelerator.step = global_step
 
     state_dir = os.path.join(args.output_dir, LAST_STATE_NAME.format(model_name))
-    accelerator.save_state(state_dir)
 
-    if args.save_state_to_huggingface:
-        logger.info("uploading last state to huggingface.")
-        huggingface_util.upload(args, state_dir, "/" + LAST_STATE_NAME.format(model_name))
+    def upload_state():
+        if args.save_state_to_huggingface:
+            logger.info("uploading last state to huggingface.")
+            huggingface_util.upload(args, state_dir, "/" + LAST_STATE_NAME.format(model_name))
+
+    save_state_dir(accelerator, state_dir, upload_state, checkpoint_writer)
 
 
 def save_sd_model_on_train_end(
@@ -6619,25 +6964,114 @@ class collator_class:
         return examples[0]
 
 
+class SeekableRandomSampler(torch.utils.data.Sampler):
+    r"""
+    random sampler for the DataLoader whose order depends only on (seed, epoch). it can start at any position of any epoch
+    without loading the skipped batches, so resuming does not replay the data before the resumed step.
+    """
+
+    def __init__(self, data_source, seed: int):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def seek(self, epoch: int, start_index: int = 0):
+        # start_index is applied only to the next iteration
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def indices(self, epoch: int) -> List[int]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(len(self.data_source), generator=generator).tolist()
+
+    def __iter__(self):
+        start_index, self.start_index = self.start_index, 0
+        yield from self.indices(self.epoch)[start_index:]
+
+    def __len__(self):
+        # always the full length, because the number of steps per epoch is computed from it
+        return len(self.data_source)
+
+    def state_dict(self) -> Dict[str, int]:
+        return {"seed": self.seed, "num_samples": len(self.data_source)}
+
+    def load_state_dict(self, state: Dict[str, int]) -> bool:
+        r"""
+        returns False if the state does not match the dataset, in which case the order of the resumed run is not reproducible
+        """
+        if state.get("num_samples") != len(self.data_source):
+            logger.warning(
+                f"number of batches in the dataset has changed since the state was saved, data order is not restored"
+                f" / stateの保存時からデータセットのバッチ数が変わったため、データの順序は復元されません: {state.get('num_samples')} -> {len(self.data_source)}"
+            )
+            return False
+        self.seed = state["seed"]
+        return True
+
+
 class LossRecorder:
     def __init__(self):
-        self.loss_list: List[float] = []
+        self.loss_list: List[Optional[float]] = []  # None for the steps skipped when resuming in the middle of an epoch
         self.loss_total: float = 0.0
+        self.num_losses: int = 0
 
     def add(self, *, epoch: int, step: int, loss: float) -> None:
         if epoch == 0:
             self.loss_list.append(loss)
+            self.num_losses += 1
         else:
             while len(self.loss_list) <= step:
-                self.loss_list.append(0.0)
-            self.loss_total -= self.loss_list[step]
+                self.loss_list.append(None)
+            if self.loss_list[step] is None:
+                self.num_losses += 1
+            else:
+                self.loss_total -= self.loss_list[step]
             self.loss_list[step] = loss
         self.loss_total += loss
 
     @property
     def moving_average(self) -> float:
-        losses = len(self.loss_list)
-        if losses == 0:
+        if self.num_losses == 0:
             return 0
-        return self.loss_total / losses
+        return self.loss_total / self.num_losses
+
+
+
+class DeferredMetrics:
+    r"""
+    keeps the metrics of each step as device tensors, and converts them to floats every `sync_every` steps with one host
+    sync, instead of calling `.item()` for each value in each step. values in nested dicts (e.g. step logs) are also converted
+    """
 
+    def __init__(self, sync_every: int = 1):
+        self.sync_every = max(1, sync_every)
+        self.pending: List[Dict[str, Any]] = []
+
+    def add(self, **entry) -> None:
+        self.pending.append(entry)
+
+    def should_flush(self) -> bool:
+        return len(self.pending) >= self.sync_every
+
+    def flush(self) -> List[Dict[str, Any]]:
+        entries, self.pending = self.pending, []
+
+        # (container, key, tensor) of all tensors in the entries
+        targets = []
+        for entry in entries:
+            for container in [entry] + [v for v in entry.values() if isinstance(v, dict)]:
+                for key, value in container.items():
+                    if isinstance(value, torch.Tensor):
+                        targets.append((container, key, value))
+
+        by_device: Dict[torch.device, List[int]] = {}
+        for i, (_, _, value) in enumerate(targets):
+            by_device.setdefault(value.device, []).append(i)
+        for indices in by_device.values():
+            values = torch.stack([targets[i][2].detach().float().reshape(()) for i in indices]).tolist()  # one sync per device
+            for i, value in zip(indices, values):
+                container, key, _ = targets[i]
+                container[key] = value
+        return entries
@@ -3,6 +3,7 @@ import sys
 import threading
 from typing import *
 import json
+import hashlib
 import struct
 
 import torch
@@ -190,9 +191,21 @@ def str_to_dtype(s: Optional[str], default_dtype: Optional[torch.dtype] = None)
         raise ValueError(f"Unsupported dtype: {s}")
 
 
-def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None):
+# byte range of a safetensors file hashed for sshs_legacy_hash, see train_util.addnet_hash_legacy
+LEGACY_HASH_START = 0x100000
+LEGACY_HASH_END = 0x110000
+
+
+def mem_eff_save_file(
+    tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None, add_model_hashes: bool = False
+) -> Optional[Tuple[str, str]]:
     """
-    memory efficient save file
+    memory efficient save file. the tensors are serialized once, one at a time, and written in a background thread
+    while the next one is copied to CPU.
+
+    with `add_model_hashes`, sshs_model_hash and sshs_legacy_hash of the written file are computed while writing and
+    stored in the metadata (placeholders of the same length are written first, and the header is rewritten at the end).
+    returns the hashes, or None without `add_model_hashes`
     """
 
     _TYPES = {
@@ -223,12 +236,17 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
                 validated[key] = value
         return validated
 
-    print(f"Using memory efficient save file: {filename}")
+    logger.info(f"Using memory efficient save file: {filename}")
+
+    metadata = validate_metadata(metadata) if metadata else {}
+    if add_model_hashes:
+        metadata["sshs_model_hash"] = "0" * 64
+        metadata["sshs_legacy_hash"] = "0" * 8
 
     header = {}
     offset = 0
     if metadata:
-        header["__metadata__"] = validate_metadata(metadata)
+        header["__metadata__"] = metadata
     for k, v in tensors.items():
         if v.numel() == 0:  # empty tensor
             header[k] = {"dtype": _TYPES[v.dtype], "shape": list(v.shape), "data_offsets": [offset, offset]}
@@ -237,40 +255,90 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
             header[k] = {"dtype": _TYPES[v.dtype], "shape": list(v.shape), "data_offsets": [offset, offset + size]}
             offset += size
 
-    hjson = json.dumps(header).encode("utf-8")
-    hjson += b" " * (-(len(hjson) + 8) % _ALIGN)
-
-    with open(filename, "wb") as f:
-        f.write(struct.pack("<Q", len(hjson)))
-        f.write(hjson)
-
+    def serialize_header() -> bytes:
+        hjson = json.dumps(header).encode("utf-8")
+        hjson += b" " * (-(len(hjson) + 8) % _ALIGN)
+        return struct.pack("<Q", len(hjson)) + hjson
+
+    header_bytes = serialize_header()
+    model_hash = hashlib.sha256()  # data after the header
+    legacy_window = bytearray(header_bytes[LEGACY_HASH_START:LEGACY_HASH_END])  # the header has the placeholders
+    position = len(header_bytes)
+
+    def write(data: np.ndarray):
+        nonlocal position
+        view = memoryview(data)
+        f.write(view)
+        if add_model_hashes:
+            model_hash.update(view)
+            start, end = max(position, LEGACY_HASH_START), min(position + len(view), LEGACY_HASH_END)
+            if start < end:
+                legacy_window.extend(view[start - position : end - position])
+        position += len(view)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with open(filename, "wb") as f, ThreadPoolExecutor(1) as executor:
+        f.write(header_bytes)
+
+        pending = []  # one tensor is written while the next one is prepared
         for k, v in tensors.items():
             if v.numel() == 0:
                 continue
-            if v.is_cuda:
-                # Direct GPU to disk save
-                with torch.cuda.device(v.device):
-                    if v.dim() == 0:  # if scalar, need to add a dimension to work with view
-                        v = v.unsqueeze(0)
-                    tensor_bytes = v.contiguous().view(torch.uint8)
-                    tensor_bytes.cpu().numpy().tofile(f)
-            else:
-                # CPU tensor save
-                if v.dim() == 0:  # if scalar, need to add a dimension to work with view
-                    v = v.unsqueeze(0)
-                v.contiguous().view(torch.uint8).numpy().tofile(f)
+            # flatten to bytes, a scalar needs a dimension to work with view. a GPU tensor is copied to CPU here
+            tensor_bytes = v.detach().contiguous().view(-1).view(torch.uint8).cpu()
+            pending.append(executor.submit(write, tensor_bytes.numpy()))
+            if len(pending) > 1:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+        if not add_model_hashes:
+            return None
+
+        metadata["sshs_model_hash"] = model_hash.hexdigest()
+        metadata["sshs_legacy_hash"] = hashlib.sha256(legacy_window).hexdigest()[0:8]
+        final_header_bytes = serialize_header()
+        assert len(final_header_bytes) == len(header_bytes), "header size is changed by the hashes"
+        f.seek(0)
+        f.write(final_header_bytes)
+    return metadata["sshs_model_hash"], metadata["sshs_legacy_hash"]
 
 
 class MemoryEfficientSafeOpen:
-    def __init__(self, filename):
+    r"""
+    safetensors reader which loads one tensor at a time. each tensor is read directly into its own memory with one copy,
+    or is a view of the mapped file with `use_mmap`
+
+    Args:
+        use_mmap: map the file once and return views of the mapping instead of reading. the mapping is copy-on-write,
+            writing to a view does not change the file. the mapping is kept until the views are released. the file
+            must not be overwritten while the views are used
+    """
+
+    def __init__(self, filename, use_mmap: bool = False):
         self.filename = filename
         self.file = open(filename, "rb")
         self.header, self.header_size = self._read_header()
+        self.data_start = self.header_size + 8
+        self.mmap = None
+        if use_mmap:
+            import mmap
+
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # views exist, the mapping is closed when they are released
         self.file.close()
 
     def keys(self):
@@ -287,29 +355,130 @@ class MemoryEfficientSafeOpen:
         offset_start, offset_end = metadata["data_offsets"]
 
         if offset_start == offset_end:
-            tensor_bytes = None
+            byte_tensor = torch.empty(0, dtype=torch.uint8)
+        elif self.mmap is not None:
+            # torch.frombuffer keeps a reference to the object but not a buffer export, so the slice of a memoryview is
+            # passed: it holds the export, and closing the mapping fails with BufferError while the tensor is alive
+            start = self.data_start + offset_start
+            byte_tensor = torch.frombuffer(memoryview(self.mmap)[start : start + offset_end - offset_start], dtype=torch.uint8)
         else:
-            # adjust offset by header size
-            self.file.seek(self.header_size + 8 + offset_start)
-            tensor_bytes = self.file.read(offset_end - offset_start)
+            byte_tensor = torch.empty(offset_end - offset_start, dtype=torch.uint8)
+            self._read_into(self.file, self.data_start + offset_start, byte_tensor)
+
+        return self._deserialize_tensor(byte_tensor, metadata)
+
+    def iter_tensors(
+        self,
+        keys: Optional[List[str]] = None,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: Optional[torch.dtype] = None,
+        readahead: int = 0,
+    ) -> Iterator[Tuple[str, torch.Tensor]]:
+        r"""
+        yields (key, tensor) in the order of the file, moved to `device` and cast to `dtype` if given
+
+        Args:
+            readahead: number of the following tensors which are read in background threads while the current one is
+                used. with `use_mmap`, the kernel is asked to read them ahead instead
+            device: with a CUDA device, tensors are read into reused pinned buffers and copied to the device
+                asynchronously, without a pageable copy in host memory
+        """
+        keys = self.keys() if keys is None else keys
+        keys = sorted(keys, key=lambda k: self.header[k]["data_offsets"][0])
+        to_cuda = device is not None and torch.device(device).type == "cuda" and self.mmap is None
+
+        if not to_cuda and (readahead <= 0 or self.mmap is not None):
+            for i, key in enumerate(keys):
+                if self.mmap is not None and readahead > 0:
+                    self._advise_willneed(keys[i + 1 : i + 1 + readahead])
+                tensor = self.get_tensor(key)
+                yield key, tensor.to(device, dtype=dtype) if device is not None or dtype is not None else tensor
+            return
 
-        return self._deserialize_tensor(tensor_bytes, metadata)
+        from concurrent.futures import ThreadPoolExecutor
+
+        local = threading.local()
+        files = []
+
+        def read(key, buffer):
+            if not hasattr(local, "file"):  # each thread seeks its own file
+                local.file = open(self.filename, "rb")
+                files.append(local.file)
+            offset_start, offset_end = self.header[key]["data_offsets"]
+            if buffer is None:
+                buffer = torch.empty(offset_end - offset_start, dtype=torch.uint8)
+            else:
+                buffer = buffer[: offset_end - offset_start]
+            if offset_end > offset_start:
+                self._read_into(local.file, self.data_start + offset_start, buffer)
+            return buffer
+
+        # pinned buffers for the tensors being read and the tensor being copied, reused after the copy is done
+        staging = []
+        if to_cuda:
+            max_size = max([self.header[k]["data_offsets"][1] - self.header[k]["data_offsets"][0] for k in keys], default=0)
+            staging = [(torch.empty(max_size, dtype=torch.uint8, pin_memory=True), None) for _ in range(max(1, readahead) + 1)]
+
+        executor = ThreadPoolExecutor(max(1, readahead))
+        pending = []  # (key, future, staging buffer)
+        try:
+            next_index = 0
+            while next_index < len(keys) or len(pending) > 0:
+                while next_index < len(keys) and len(pending) < max(1, readahead):
+                    buffer = None
+                    if to_cuda:
+                        buffer, event = staging.pop(0)
+                        if event is not None:
+                            event.synchronize()  # the previous copy from this buffer is done
+                    key = keys[next_index]
+                    pending.append((key, executor.submit(read, key, buffer), buffer))
+                    next_index += 1
+
+                key, future, buffer = pending.pop(0)
+                byte_tensor = future.result()
+                if to_cuda:
+                    byte_tensor = byte_tensor.to(device, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record()
+                    staging.append((buffer, event))
+                tensor = self._deserialize_tensor(byte_tensor, self.header[key])
+                yield key, tensor.to(device, dtype=dtype) if device is not None or dtype is not None else tensor
+        finally:
+            executor.shutdown(wait=True)
+            for file in files:
+                file.close()
+
+    def _advise_willneed(self, keys: List[str]):
+        import mmap
+
+        if not hasattr(self.mmap, "madvise") or not hasattr(mmap, "MADV_WILLNEED") or len(keys) == 0:
+            return
+        start = self.data_start + self.header[keys[0]]["data_offsets"][0]
+        end = self.data_start + self.header[keys[-1]]["data_offsets"][1]
+        aligned_start = start - start % mmap.PAGESIZE
+        if end > aligned_start:
+            self.mmap.madvise(mmap.MADV_WILLNEED, aligned_start, end - aligned_start)
+
+    @staticmethod
+    def _read_into(file, offset: int, byte_tensor: torch.Tensor):
+        file.seek(offset)
+        view = memoryview(byte_tensor.numpy())
+        read = 0
+        while read < len(view):
+            n = file.readinto(view[read:])
+            if not n:
+                raise EOFError(f"unexpected end of file: {file.name}")
+            read += n
 
     def _read_header(self):
         header_size = struct.unpack("<Q", self.file.read(8))[0]
         header_json = self.file.read(header_size).decode("utf-8")
         return json.loads(header_json), header_size
 
-    def _deserialize_tensor(self, tensor_bytes, metadata):
+    def _deserialize_tensor(self, byte_tensor, metadata):
         dtype = self._get_torch_dtype(metadata["dtype"])
         shape = metadata["shape"]
 
-        if tensor_bytes is None:
-            byte_tensor = torch.empty(0, dtype=torch.uint8)
-        else:
-            tensor_bytes = bytearray(tensor_bytes)  # make it writable
-            byte_tensor = torch.frombuffer(tensor_bytes, dtype=torch.uint8)
-
         # process float8 types
         if metadata["dtype"] in ["F8_E5M2", "F8_E4M3"]:
             return self._convert_float8(byte_tensor, metadata["dtype"], shape)
@@ -351,6 +520,10 @@ class MemoryEfficientSafeOpen:
             raise ValueError(f"Unsupported float8 type: {dtype_str} (upgrade PyTorch to support float8 types)")
 
 
+# tensors read ahead by load_safetensors(disable_mmap=True)
+SAFETENSORS_READAHEAD = 4
+
+
 def load_safetensors(
     path: str, device: Union[str, torch.device], disable_mmap: bool = False, dtype: Optional[torch.dtype] = torch.float32
 ) -> dict[str, torch.Tensor]:
@@ -360,8 +533,8 @@ def load_safetensors(
         # logger.info(f"Loading without mmap (experimental)")
         state_dict = {}
         with MemoryEfficientSafeOpen(path) as f:
-            for key in f.keys():
-                state_dict[key] = f.get_tensor(key).to(device, dtype=dtype)
+            for key, tensor in f.iter_tensors(device=device, dtype=dtype, readahead=SAFETENSORS_READAHEAD):
+                state_dict[key] = tensor
         return state_dict
     else:
         try:
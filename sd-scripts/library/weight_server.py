@@ -0,0 +1,290 @@
+# shared memory copies of the base model files for back-to-back training runs on one machine
+#
+# tools/weight_server.py copies the requested safetensors files once to a tmpfs directory (/dev/shm). a training process
+# with --use_weight_server maps the copies with copy-on-write views instead of reading the files from the disk, so the
+# weights are shared by the processes and are not copied to private memory. tensors which are cast to another dtype
+# while loading are still copied.
+# the server and the training processes communicate through files in the directory: a process writes a request for each
+# model it loads, and the server copies the requested models and records the time of their use. the least recently
+# used copies which are not mapped by any process are removed when the available host memory is below the reserve or
+# the copies exceed the capacity. a model which is not copied yet is loaded from its source, the copy is used from the
+# next run.
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Optional, Set
+
+import torch
+
+from library.model_loading import get_available_memory
+from library.utils import MemoryEfficientSafeOpen, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+PID_FILE = "server.pid"
+SOURCES_FILE = "sources.json"  # entry name -> source path, to remove the older copies of a source after a restart
+REQUESTS_DIR = "requests"
+ENTRY_SUFFIX = ".safetensors"
+
+
+def get_shm_dir() -> str:
+    return os.environ.get("SD_SCRIPTS_WEIGHT_SHM_DIR", "/dev/shm/sd-scripts-weights")
+
+
+def get_entry_name(path: str) -> str:
+    r"""
+    <name>.<hash of the absolute path, size and mtime>.safetensors, a changed source gets a new name
+    """
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    name = os.path.splitext(os.path.basename(path))[0]
+    return f"{name}.{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}{ENTRY_SUFFIX}"
+
+
+def is_server_running(shm_dir: Optional[str] = None) -> bool:
+    shm_dir = shm_dir or get_shm_dir()
+    try:
+        with open(os.path.join(shm_dir, PID_FILE), "r", encoding="utf-8") as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def is_shared(path: Optional[str]) -> bool:
+    r"""
+    True if the path is a copy in the shared memory directory
+    """
+    if path is None:
+        return False
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(get_shm_dir())
+
+
+def resolve(path: str) -> str:
+    r"""
+    returns the shared copy of the model file if the server has it, otherwise `path`. the use of the model is sent to the
+    server, which copies a new model for the next run
+    """
+    shm_dir = get_shm_dir()
+    if not is_server_running(shm_dir):
+        logger.warning(f"weight server is not running: {shm_dir} / ウェイトサーバーが起動していません: {shm_dir}")
+        return path
+
+    name = get_entry_name(path)
+    request_path = os.path.join(shm_dir, REQUESTS_DIR, name + ".json")
+    tmp_path = f"{request_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"path": os.path.abspath(path), "time": time.time()}, f)
+        os.replace(tmp_path, request_path)
+    except OSError as e:
+        logger.warning(f"failed to send a request to the weight server: {e} / ウェイトサーバーへの要求に失敗しました")
+
+    shared_path = os.path.join(shm_dir, name)
+    if os.path.exists(shared_path):
+        logger.info(f"use shared weights: {shared_path} / 共有メモリのウェイトを使用します: {shared_path}")
+        return shared_path
+    logger.info(f"{path} is not in shared memory yet, requested / {path} はまだ共有メモリにないため、要求しました")
+    return path
+
+
+def attach(path: str, dtype: Optional[torch.dtype] = None) -> Dict[str, torch.Tensor]:
+    r"""
+    state dict of views of the shared copy, tensors are copied only if they are cast to `dtype`. the views keep the
+    mapping after the file is closed, it is unmapped when the last view is released
+    """
+    with MemoryEfficientSafeOpen(path, use_mmap=True) as f:
+        return {key: tensor for key, tensor in f.iter_tensors(dtype=dtype)}
+
+
+def get_mapped_files(shm_dir: str) -> Set[str]:
+    r"""
+    names of the files in `shm_dir` which are mapped by a process, from /proc/<pid>/maps of the visible processes
+    """
+    prefix = os.path.abspath(shm_dir) + os.sep
+    names = set()
+    for maps_path in glob.glob("/proc/[0-9]*/maps"):
+        try:
+            with open(maps_path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    fields = line.split(maxsplit=5)
+                    if len(fields) == 6 and fields[5].startswith(prefix):
+                        path = fields[5].rstrip("\n")
+                        if path.endswith(" (deleted)"):
+                            path = path[: -len(" (deleted)")]
+                        names.add(os.path.basename(path))
+        except OSError:
+            continue  # the process has exited or is not ours
+    return names
+
+
+class WeightServer:
+    r"""
+    keeps copies of the requested model files in `shm_dir`
+
+    Args:
+        capacity: maximum bytes of the copies, None for no limit
+        reserve: bytes of available host memory kept free, copies are removed or not made below it
+    """
+
+    def __init__(self, shm_dir: str, capacity: Optional[int] = None, reserve: int = 0):
+        self.shm_dir = shm_dir
+        self.requests_dir = os.path.join(shm_dir, REQUESTS_DIR)
+        self.capacity = capacity
+        self.reserve = reserve
+        self.last_used: Dict[str, float] = {}  # entry name -> time of the last request
+        self.sources: Dict[str, str] = {}  # entry name -> source path
+
+    def start(self):
+        if is_server_running(self.shm_dir):
+            raise RuntimeError(f"weight server is already running: {self.shm_dir} / ウェイトサーバーは既に起動しています")
+        os.makedirs(self.requests_dir, exist_ok=True)
+        with open(os.path.join(self.shm_dir, PID_FILE), "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+
+        for path in glob.glob(os.path.join(self.shm_dir, "*.tmp")):
+            os.remove(path)  # an interrupted copy
+        for path in glob.glob(os.path.join(self.shm_dir, "*" + ENTRY_SUFFIX)):
+            self.last_used[os.path.basename(path)] = os.path.getmtime(path)
+        try:
+            with open(os.path.join(self.shm_dir, SOURCES_FILE), "r", encoding="utf-8") as f:
+                sources = json.load(f)
+            self.sources = {name: source for name, source in sources.items() if name in self.last_used}
+        except (OSError, json.JSONDecodeError):
+            self.sources = {}
+        logger.info(
+            f"weight server started: {self.shm_dir}, {len(self.last_used)} models, {self.get_used_size() / 1024**3:.1f} GB"
+            f" / ウェイトサーバーを開始しました"
+        )
+
+    def stop(self):
+        pid_path = os.path.join(self.shm_dir, PID_FILE)
+        if os.path.exists(pid_path):
+            os.remove(pid_path)
+
+    def get_used_size(self) -> int:
+        size = 0
+        for name in list(self.last_used):
+            path = os.path.join(self.shm_dir, name)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+            else:
+                self.remove(name)  # removed by hand
+        return size
+
+    def process_requests(self):
+        r"""
+        records the use of the requested models and copies the models which are not in shared memory
+        """
+        request_paths = sorted(glob.glob(os.path.join(self.requests_dir, "*.json")), key=os.path.getmtime)
+        for request_path in request_paths:
+            try:
+                with open(request_path, "r", encoding="utf-8") as f:
+                    request = json.load(f)
+                os.remove(request_path)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"invalid request {request_path}: {e} / 無効な要求です: {request_path}")
+                continue
+
+            name = os.path.basename(request_path)[: -len(".json")]
+            if name in self.last_used:
+                self.last_used[name] = max(self.last_used[name], request["time"])
+            elif os.path.isfile(request["path"]) and get_entry_name(request["path"]) == name:
+                self.add(request["path"])  # otherwise the source is removed or changed since the request
+
+    def add(self, path: str) -> Optional[str]:
+        r"""
+        copies the model file to shared memory if it fits, returns the shared path or None
+        """
+        name = get_entry_name(path)
+        shared_path = os.path.join(self.shm_dir, name)
+        if name in self.last_used:
+            self.last_used[name] = time.time()
+            return shared_path
+
+        # older copies of the same source are not used anymore
+        source = os.path.abspath(path)
+        for old_name in [n for n, s in self.sources.items() if s == source]:
+            self.remove(old_name)
+
+        size = os.path.getsize(path)
+        if not self.evict(size):
+            logger.warning(
+                f"not enough memory to share {path} ({size / 1024**3:.1f} GB) / メモリが不足しているため共有できません: {path}"
+            )
+            return None
+
+        logger.info(f"copy {path} to shared memory ({size / 1024**3:.1f} GB) / 共有メモリにコピーします: {path}")
+        start_time = time.perf_counter()
+        tmp_path = f"{shared_path}.tmp"
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.chmod(tmp_path, 0o444)  # the training processes attach read-only
+            os.replace(tmp_path, shared_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"copied in {elapsed:.1f}s ({size / max(elapsed, 1e-6) / 1024**3:.2f} GB/s): {shared_path}")
+
+        self.last_used[name] = time.time()
+        self.sources[name] = source
+        self._save_sources()
+        return shared_path
+
+    def remove(self, name: str):
+        logger.info(f"remove shared weights: {name} / 共有メモリのウェイトを削除します: {name}")
+        path = os.path.join(self.shm_dir, name)
+        if os.path.exists(path):
+            os.remove(path)  # the processes which map the file keep their mapping
+        self.last_used.pop(name, None)
+        if self.sources.pop(name, None) is not None:
+            self._save_sources()
+
+    def _save_sources(self):
+        sources_path = os.path.join(self.shm_dir, SOURCES_FILE)
+        tmp_path = f"{sources_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.sources, f)
+        os.replace(tmp_path, sources_path)
+
+    def evict(self, needed: int = 0) -> bool:
+        r"""
+        removes the least recently used copies until `needed` bytes more fit the capacity and the reserve. copies mapped
+        by a process are kept, removing them frees no memory until they are unmapped. returns False if it does not fit
+        """
+
+        def fits():
+            if self.capacity is not None and self.get_used_size() + needed > self.capacity:
+                return False
+            available = get_available_memory()
+            return available is None or available - needed >= self.reserve
+
+        if fits():
+            return True
+        mapped = get_mapped_files(self.shm_dir)
+        for name in sorted(self.last_used, key=self.last_used.get):
+            if name in mapped:
+                continue
+            self.remove(name)
+            if fits():
+                return True
+        return False
+
+    def serve(self, interval: float = 1.0):
+        r"""
+        processes the requests and keeps the memory reserve until interrupted, call after `start`
+        """
+        while True:
+            self.process_requests()
+            self.evict()
+            time.sleep(interval)
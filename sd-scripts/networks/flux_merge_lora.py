@@ -60,6 +60,7 @@ def merge_to_flux_model(
     merge_dtype,
     save_dtype,
     mem_eff_load_save=False,
+    use_mmap=False,
 ):
     # create module map without loading state_dict
     lora_name_to_module_key = {}
@@ -100,17 +101,17 @@ def merge_to_flux_model(
     t5xxl_state_dict = {}
     if mem_eff_load_save:
         if flux_path is not None:
-            with MemoryEfficientSafeOpen(flux_path) as flux_file:
+            with MemoryEfficientSafeOpen(flux_path, use_mmap) as flux_file:
                 for key in tqdm(flux_file.keys()):
                     flux_state_dict[key] = flux_file.get_tensor(key).to(loading_device)  # dtype is not changed
 
         if clip_l_path is not None:
-            with MemoryEfficientSafeOpen(clip_l_path) as clip_l_file:
+            with MemoryEfficientSafeOpen(clip_l_path, use_mmap) as clip_l_file:
                 for key in tqdm(clip_l_file.keys()):
                     clip_l_state_dict[key] = clip_l_file.get_tensor(key).to(loading_device)
 
         if t5xxl_path is not None:
-            with MemoryEfficientSafeOpen(t5xxl_path) as t5xxl_file:
+            with MemoryEfficientSafeOpen(t5xxl_path, use_mmap) as t5xxl_file:
                 for key in tqdm(t5xxl_file.keys()):
                     t5xxl_state_dict[key] = t5xxl_file.get_tensor(key).to(loading_device)
     else:
@@ -192,12 +193,12 @@ def merge_to_flux_model(
 
 
 def merge_to_flux_model_diffusers(
-    loading_device, working_device, flux_model, models, ratios, merge_dtype, save_dtype, mem_eff_load_save=False
+    loading_device, working_device, flux_model, models, ratios, merge_dtype, save_dtype, mem_eff_load_save=False, use_mmap=False
 ):
     logger.info(f"loading keys from FLUX.1 model: {flux_model}")
     if mem_eff_load_save:
         flux_state_dict = {}
-        with MemoryEfficientSafeOpen(flux_model) as flux_file:
+        with MemoryEfficientSafeOpen(flux_model, use_mmap) as flux_file:
             for key in tqdm(flux_file.keys()):
                 flux_state_dict[key] = flux_file.get_tensor(key).to(loading_device)  # dtype is not changed
     else:
@@ -576,6 +577,12 @@ def merge(args):
         os.makedirs(dest_dir)
 
     if args.flux_model is not None or args.clip_l is not None or args.t5xxl is not None:
+        # with mem_eff_load_save on CPU, the models are mapped and the weights which are not merged are saved from the
+        # mapping without a copy in memory. a model which is overwritten by the result must be read instead
+        sources = [os.path.abspath(path) for path in [args.flux_model, args.clip_l, args.t5xxl] if path is not None]
+        destinations = [os.path.abspath(path) for path in [args.save_to, args.clip_l_save_to, args.t5xxl_save_to] if path]
+        use_mmap = args.loading_device == "cpu" and not any(path in sources for path in destinations)
+
         if not args.diffusers:
             assert (args.clip_l is None and args.clip_l_save_to is None) or (
                 args.clip_l is not None and args.clip_l_save_to is not None
@@ -594,6 +601,7 @@ def merge(args):
                 merge_dtype,
                 save_dtype,
                 args.mem_eff_load_save,
+                use_mmap,
             )
         else:
             assert (
@@ -608,6 +616,7 @@ def merge(args):
                 merge_dtype,
                 save_dtype,
                 args.mem_eff_load_save,
+                use_mmap,
             )
             clip_l_state_dict = None
             t5xxl_state_dict = None
@@ -48,11 +48,14 @@ class LoRAModule(torch.nn.Module):
         split_dims: Optional[List[int]] = None,
         ggpo_beta: Optional[float] = None,
         ggpo_sigma: Optional[float] = None,
+        ggpo_rank: Optional[int] = None,
     ):
         """
         if alpha == 0 or None, alpha is rank (no scaling).
 
         split_dims is used to mimic the split qkv of FLUX as same as Diffusers
+
+        ggpo_rank: rank of the random perturbation of GGPO. None is a full-size Gaussian noise for each forward
         """
         super().__init__()
         self.lora_name = lora_name
@@ -109,6 +112,7 @@ class LoRAModule(torch.nn.Module):
 
         self.ggpo_sigma = ggpo_sigma
         self.ggpo_beta = ggpo_beta
+        self.ggpo_rank = ggpo_rank
 
         if self.ggpo_beta is not None and self.ggpo_sigma is not None:
             self.combined_weight_norms = None
@@ -160,37 +164,65 @@ class LoRAModule(torch.nn.Module):
                 with torch.no_grad():
                     perturbation_scale = (self.ggpo_sigma * torch.sqrt(self.combined_weight_norms ** 2)) + (self.ggpo_beta * (self.grad_norms ** 2))
                     perturbation_scale_factor = (perturbation_scale * self.perturbation_norm_factor).to(self.device)
-                    perturbation = torch.randn(self.org_module_shape,  dtype=self.dtype, device=self.device)
-                    perturbation.mul_(perturbation_scale_factor)
-                    perturbation_output = x @ perturbation.T  # Result: (batch × n)
+                    if self.ggpo_rank is None:
+                        perturbation = torch.randn(self.org_module_shape,  dtype=self.dtype, device=self.device)
+                        perturbation.mul_(perturbation_scale_factor)
+                        perturbation_output = x @ perturbation.T  # Result: (batch × n)
+                    else:
+                        perturbation_output = self.low_rank_perturbation(x, perturbation_scale_factor)
                 return org_forwarded + (self.multiplier * scale * lx) + perturbation_output
             else:
                 return org_forwarded + lx * self.multiplier * scale
         else:
-            lxs = [lora_down(x) for lora_down in self.lora_down]
+            # fused execution of the splits: one matmul with the concatenated down weights, and one with the block diagonal
+            # up weights. the weights are kept in the separate Linears, so the state dict is the same as before
+            lx = torch.nn.functional.linear(x, self.fused_down_weight())
 
             # normal dropout
             if self.dropout is not None and self.training:
-                lxs = [torch.nn.functional.dropout(lx, p=self.dropout) for lx in lxs]
+                lx = torch.nn.functional.dropout(lx, p=self.dropout)
 
             # rank dropout
             if self.rank_dropout is not None and self.training:
-                masks = [torch.rand((lx.size(0), self.lora_dim), device=lx.device) > self.rank_dropout for lx in lxs]
-                for i in range(len(lxs)):
-                    if len(lx.size()) == 3:
-                        masks[i] = masks[i].unsqueeze(1)
-                    elif len(lx.size()) == 4:
-                        masks[i] = masks[i].unsqueeze(-1).unsqueeze(-1)
-                    lxs[i] = lxs[i] * masks[i]
+                mask = torch.rand((lx.size(0), lx.size(-1)), device=lx.device) > self.rank_dropout
+                if len(lx.size()) == 3:
+                    mask = mask.unsqueeze(1)
+                lx = lx * mask
 
                 # scaling for rank dropout: treat as if the rank is changed
                 scale = self.scale * (1.0 / (1.0 - self.rank_dropout))  # redundant for readability
             else:
                 scale = self.scale
 
-            lxs = [lora_up(lx) for lora_up, lx in zip(self.lora_up, lxs)]
+            lx = torch.nn.functional.linear(lx, self.fused_up_weight())
+
+            return org_forwarded + lx * self.multiplier * scale
+
+    def fused_down_weight(self) -> Tensor:
+        r"""
+        down weights of the splits concatenated to [num_splits * lora_dim, in_dim]
+        """
+        return torch.cat([lora_down.weight for lora_down in self.lora_down], dim=0)
+
+    def fused_up_weight(self) -> Tensor:
+        r"""
+        up weights of the splits as a block diagonal [sum(split_dims), num_splits * lora_dim], same layout as the merged
+        weights in the state dict. lora_dim is small, so the zero blocks cost less than launching a matmul per split
+        """
+        return torch.block_diag(*[lora_up.weight for lora_up in self.lora_up])
 
-            return org_forwarded + torch.cat(lxs, dim=-1) * self.multiplier * scale
+    @torch.no_grad()
+    def low_rank_perturbation(self, x: Tensor, perturbation_scale_factor: Tensor) -> Tensor:
+        r"""
+        `x @ (scale * N).T` with N = A @ B / sqrt(rank), A (out, rank) and B (rank, in) Gaussian. each element of N has
+        unit variance as the full-size noise, so the expected noise scale of the output is the same, but the noise is
+        (out + in) * rank numbers and the matmuls are O((out + in) * rank) instead of O(out * in)
+        """
+        out_dim, in_dim = self.org_module_shape
+        noise_down = torch.randn((self.ggpo_rank, in_dim), dtype=x.dtype, device=x.device)
+        noise_up = torch.randn((out_dim, self.ggpo_rank), dtype=x.dtype, device=x.device)
+        noise_up.mul_(perturbation_scale_factor.to(x.dtype) / math.sqrt(self.ggpo_rank))
+        return (x @ noise_down.T) @ noise_up.T
 
     @torch.no_grad()
     def initialize_norm_cache(self, org_module_weight: Tensor):
@@ -420,9 +452,9 @@ class LoRAInfModule(LoRAModule):
             lx = self.lora_up(lx)
             return self.org_forward(x) + lx * self.multiplier * self.scale
         else:
-            lxs = [lora_down(x) for lora_down in self.lora_down]
-            lxs = [lora_up(lx) for lora_up, lx in zip(self.lora_up, lxs)]
-            return self.org_forward(x) + torch.cat(lxs, dim=-1) * self.multiplier * self.scale
+            lx = torch.nn.functional.linear(x, self.fused_down_weight())
+            lx = torch.nn.functional.linear(lx, self.fused_up_weight())
+            return self.org_forward(x) + lx * self.multiplier * self.scale
 
     def forward(self, x):
         if not self.enabled:
@@ -564,6 +596,12 @@ def create_network(
     if ggpo_sigma is not None:
         ggpo_sigma = float(ggpo_sigma)
 
+    # rank of the low-rank GGPO perturbation, None for the full-size perturbation
+    ggpo_rank = kwargs.get("ggpo_rank", None)
+    if ggpo_rank is not None:
+        ggpo_rank = int(ggpo_rank)
+        assert ggpo_rank > 0, "ggpo_rank must be positive / ggpo_rankは正の値である必要があります"
+
 
     # train T5XXL
     train_t5xxl = kwargs.get("train_t5xxl", False)
@@ -596,6 +634,7 @@ def create_network(
         train_single_block_indices=train_single_block_indices,
         ggpo_beta=ggpo_beta,
         ggpo_sigma=ggpo_sigma,
+        ggpo_rank=ggpo_rank,
         verbose=verbose,
     )
 
@@ -677,6 +716,43 @@ def create_network_from_weights(multiplier, file, ae, text_encoders, flux, weigh
     return network, weights_sd
 
 
+def _group_by_shape(pairs: List[Tuple[Tensor, Tensor]]) -> List[List[int]]:
+    r"""
+    indices of (up, down) weight pairs grouped by shapes, dtype and device, to compute the norms of each group with batched kernels
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for i, (up, down) in enumerate(pairs):
+        groups.setdefault((up.shape, down.shape, up.dtype, up.device), []).append(i)
+    return list(groups.values())
+
+
+def _batched_row_norms_sq(up: Tensor, down: Tensor) -> Tensor:
+    r"""
+    squared row norms of `up @ down` for stacked (G, out, r) and (G, r, in) weights, without the (G, out, in) product:
+    |u_i D|^2 = u_i (D D^T) u_i^T. returns (G, out, 1)
+    """
+    gram = torch.bmm(down, down.transpose(1, 2))
+    return (torch.bmm(up, gram) * up).sum(dim=2, keepdim=True).clamp_(min=0)
+
+
+def _batched_grad_row_norms_sq(up: Tensor, down: Tensor, up_grad: Tensor, down_grad: Tensor) -> Tensor:
+    r"""
+    squared row norms of `up @ down_grad + up_grad @ down` (the approximated gradient of the merged weight), expanded
+    in the same way as `_batched_row_norms_sq`. returns (G, out, 1)
+    """
+    sq = (torch.bmm(up, torch.bmm(down_grad, down_grad.transpose(1, 2))) * up).sum(dim=2, keepdim=True)
+    sq += 2 * (torch.bmm(up, torch.bmm(down_grad, down.transpose(1, 2))) * up_grad).sum(dim=2, keepdim=True)
+    sq += (torch.bmm(up_grad, torch.bmm(down, down.transpose(1, 2))) * up_grad).sum(dim=2, keepdim=True)
+    return sq.clamp_(min=0)
+
+
+def _batched_frobenius_norms_sq(up: Tensor, down: Tensor) -> Tensor:
+    r"""
+    squared Frobenius norms of `up @ down` for stacked weights: |U D|^2 = sum((U^T U) * (D D^T)). returns (G,)
+    """
+    return (torch.bmm(up.transpose(1, 2), up) * torch.bmm(down, down.transpose(1, 2))).sum(dim=(1, 2)).clamp_(min=0)
+
+
 class LoRANetwork(torch.nn.Module):
     # FLUX_TARGET_REPLACE_MODULE = ["DoubleStreamBlock", "SingleStreamBlock"]
     FLUX_TARGET_REPLACE_MODULE_DOUBLE = ["DoubleStreamBlock"]
@@ -710,6 +786,7 @@ class LoRANetwork(torch.nn.Module):
         train_single_block_indices: Optional[List[bool]] = None,
         ggpo_beta: Optional[float] = None,
         ggpo_sigma: Optional[float] = None,
+        ggpo_rank: Optional[int] = None,
         verbose: Optional[bool] = False,
     ) -> None:
         super().__init__()
@@ -751,6 +828,8 @@ class LoRANetwork(torch.nn.Module):
 
         if ggpo_beta is not None and ggpo_sigma is not None:
             logger.info(f"LoRA-GGPO training sigma: {ggpo_sigma} beta: {ggpo_beta}")
+            if ggpo_rank is not None:
+                logger.info(f"LoRA-GGPO low-rank perturbation, rank: {ggpo_rank}")
 
         if self.split_qkv:
             logger.info(f"split qkv for LoRA")
@@ -879,6 +958,7 @@ class LoRANetwork(torch.nn.Module):
                                 split_dims=split_dims,
                                 ggpo_beta=ggpo_beta,
                                 ggpo_sigma=ggpo_sigma,
+                                ggpo_rank=ggpo_rank,
                             )
                             loras.append(lora)
 
@@ -938,6 +1018,10 @@ class LoRANetwork(torch.nn.Module):
             assert lora.lora_name not in names, f"duplicated lora name: {lora.lora_name}"
             names.add(lora.lora_name)
 
+        # GGPO norms are computed for all modules at once by update_norms / update_grad_norms, and cached until the next call
+        self._norm_layouts = {}
+        self._norm_cache: Dict[str, Tensor] = {}
+
     def set_multiplier(self, multiplier):
         self.multiplier = multiplier
         for lora in self.text_encoder_loras + self.unet_loras:
@@ -947,34 +1031,112 @@ class LoRANetwork(torch.nn.Module):
         for lora in self.text_encoder_loras + self.unet_loras:
             lora.enabled = is_enabled
 
-    def update_norms(self):
+    def _ggpo_loras(self, with_grads: bool = False) -> List[LoRAModule]:
+        loras = []
         for lora in self.text_encoder_loras + self.unet_loras:
-            lora.update_norms()
+            # GGPO perturbation is applied only in the forward without split_dims
+            if lora.ggpo_sigma is None or lora.ggpo_beta is None or not lora.training or lora.split_dims is not None:
+                continue
+            if with_grads and (lora.lora_up.weight.grad is None or lora.lora_down.weight.grad is None):
+                continue
+            loras.append(lora)
+        return loras
+
+    def _norm_layout(self, loras: List[LoRAModule]) -> dict:
+        r"""
+        shape groups of `loras` and the constants of each group, cached while the set of modules is the same
+        """
+        key = tuple(id(lora) for lora in loras)
+        if key not in self._norm_layouts:
+            device = loras[0].lora_up.weight.device
+            groups = _group_by_shape([(lora.lora_up.weight, lora.lora_down.weight) for lora in loras])
+            order = torch.tensor([i for group in groups for i in group])
+            inverse = torch.empty_like(order)
+            inverse[order] = torch.arange(len(order))
+            self._norm_layouts[key] = {
+                "groups": groups,
+                "inverse": inverse.to(device),  # from the group order to the order of `loras`
+                "estimates": [
+                    torch.stack([loras[i].org_weight_norm_estimate.float() for i in group]).to(device).view(-1, 1, 1)
+                    for group in groups
+                ],
+                "scales": [
+                    torch.tensor([abs(float(loras[i].scale)) for i in group], device=device).view(-1, 1, 1) for group in groups
+                ],
+            }
+        return self._norm_layouts[key]
 
+    @torch.no_grad()
+    def update_norms(self):
+        r"""
+        same as `LoRAModule.update_norms` for all GGPO modules, with batched kernels for each shape group. as in the module
+        method, the norms are of `up @ down` without the scale
+        """
+        self._norm_cache.pop("weight_norms", None)
+        self._norm_cache.pop("combined_weight_norms", None)
+        loras = self._ggpo_loras()
+        if len(loras) == 0:
+            return
+
+        layout = self._norm_layout(loras)
+        weight_means = []
+        combined_means = []
+        for group, estimates in zip(layout["groups"], layout["estimates"]):
+            group_loras = [loras[i] for i in group]
+            up = torch.stack([lora.lora_up.weight for lora in group_loras]).float()
+            down = torch.stack([lora.lora_down.weight for lora in group_loras]).float()
+            norms_sq = _batched_row_norms_sq(up, down)
+            weight_norms = norms_sq.sqrt()
+            combined_weight_norms = (estimates**2 + norms_sq).sqrt()
+
+            dtype = group_loras[0].lora_up.weight.dtype
+            for lora, w, c in zip(group_loras, weight_norms.to(dtype).unbind(0), combined_weight_norms.to(dtype).unbind(0)):
+                lora.weight_norms = w
+                lora.combined_weight_norms = c
+            weight_means.append(weight_norms.mean(dim=1))
+            combined_means.append(combined_weight_norms.mean(dim=1))
+
+        self._norm_cache["weight_norms"] = torch.cat(weight_means)[layout["inverse"]]
+        self._norm_cache["combined_weight_norms"] = torch.cat(combined_means)[layout["inverse"]]
+
+    @torch.no_grad()
     def update_grad_norms(self):
-        for lora in self.text_encoder_loras + self.unet_loras:
-            lora.update_grad_norms()
+        r"""
+        same as `LoRAModule.update_grad_norms` for all GGPO modules which have the gradients, with batched kernels
+        """
+        self._norm_cache.pop("grad_norms", None)
+        loras = self._ggpo_loras(with_grads=True)
+        if len(loras) == 0:
+            return
+
+        layout = self._norm_layout(loras)
+        grad_means = []
+        for group, scales in zip(layout["groups"], layout["scales"]):
+            group_loras = [loras[i] for i in group]
+            up = torch.stack([lora.lora_up.weight for lora in group_loras]).float()
+            down = torch.stack([lora.lora_down.weight for lora in group_loras]).float()
+            up_grad = torch.stack([lora.lora_up.weight.grad for lora in group_loras]).float()
+            down_grad = torch.stack([lora.lora_down.weight.grad for lora in group_loras]).float()
+            grad_norms = _batched_grad_row_norms_sq(up, down, up_grad, down_grad).sqrt() * scales
+
+            dtype = group_loras[0].lora_up.weight.dtype
+            for lora, g in zip(group_loras, grad_norms.to(dtype).unbind(0)):
+                lora.grad_norms = g
+            grad_means.append(grad_norms.mean(dim=1))
+
+        self._norm_cache["grad_norms"] = torch.cat(grad_means)[layout["inverse"]]
 
     def grad_norms(self) -> Tensor | None:
-        grad_norms = []
-        for lora in self.text_encoder_loras + self.unet_loras:
-            if hasattr(lora, "grad_norms") and lora.grad_norms is not None:
-                grad_norms.append(lora.grad_norms.mean(dim=0))
-        return torch.stack(grad_norms) if len(grad_norms) > 0 else None
+        r"""
+        mean gradient norm of each GGPO module, (num_modules, 1), from the last `update_grad_norms`
+        """
+        return self._norm_cache.get("grad_norms")
 
     def weight_norms(self) -> Tensor | None:
-        weight_norms = []
-        for lora in self.text_encoder_loras + self.unet_loras:
-            if hasattr(lora, "weight_norms") and lora.weight_norms is not None:
-                weight_norms.append(lora.weight_norms.mean(dim=0))
-        return torch.stack(weight_norms) if len(weight_norms) > 0 else None
+        return self._norm_cache.get("weight_norms")
 
     def combined_weight_norms(self) -> Tensor | None:
-        combined_weight_norms = []
-        for lora in self.text_encoder_loras + self.unet_loras:
-            if hasattr(lora, "combined_weight_norms") and lora.combined_weight_norms is not None:
-                combined_weight_norms.append(lora.combined_weight_norms.mean(dim=0))
-        return torch.stack(combined_weight_norms) if len(combined_weight_norms) > 0 else None
+        return self._norm_cache.get("combined_weight_norms")
 
 
     def load_weights(self, file):
@@ -1243,23 +1405,20 @@ class LoRANetwork(torch.nn.Module):
         state_dict = self.state_dict()
 
         if dtype is not None:
-            for key in list(state_dict.keys()):
-                v = state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
-                state_dict[key] = v
+            from library import flat_params
+
+            # weights in the flat buffers (--flat_network_params) are copied to CPU at once
+            state_dict = flat_params.copy_state_dict_to_cpu(state_dict, dtype, getattr(self, "flat_buffers", None))
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            from library import train_util
+            from library.utils import mem_eff_save_file
 
-            # Precalculate model hashes to save time on indexing
+            # model hashes to save time on indexing, computed while writing
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
+            model_hash, legacy_hash = mem_eff_save_file(state_dict, file, metadata, add_model_hashes=True)
             metadata["sshs_model_hash"] = model_hash
             metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -1300,45 +1459,59 @@ class LoRANetwork(torch.nn.Module):
             org_module._lora_restored = False
             lora.enabled = False
 
+    @torch.no_grad()
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
-        norms = []
-        keys_scaled = 0
-
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
+        r"""
+        scales down the modules whose norm of `up @ down * scale` is larger than `max_norm_value`. the norms of Linear
+        modules are computed for each shape group with batched kernels, and the weights are scaled with one multi-tensor
+        kernel. keys_scaled, the mean and the max norm are returned as device tensors, so no host sync is needed here
+        """
+        linear_pairs = []
+        conv_pairs = []
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if lora.split_dims is None:
+                pairs = [(lora.lora_up.weight, lora.lora_down.weight)]
+            else:
+                pairs = [(lora_up.weight, lora_down.weight) for lora_up, lora_down in zip(lora.lora_up, lora.lora_down)]
+            for up, down in pairs:
+                (linear_pairs if up.dim() == 2 else conv_pairs).append((up, down, lora.alpha))
+        if len(linear_pairs) + len(conv_pairs) == 0:
+            return 0, 0.0, 0.0
 
+        weights = []
+        norms = []
+        for group in _group_by_shape([(up, down) for up, down, _ in linear_pairs]):
+            group_pairs = [linear_pairs[i] for i in group]
+            up = torch.stack([up for up, _, _ in group_pairs]).to(device, torch.float32)
+            down = torch.stack([down for _, down, _ in group_pairs]).to(device, torch.float32)
+            scale = torch.stack([alpha.float() for _, _, alpha in group_pairs]).to(device) / down.shape[1]
+            norms.append(_batched_frobenius_norms_sq(up, down).sqrt() * scale)
+            weights.extend(group_pairs)
+
+        # Conv2d modules are not batched
+        conv_norms = []
+        for up_weight, down_weight, alpha in conv_pairs:
+            up, down, alpha = up_weight.to(device), down_weight.to(device), alpha.to(device)
             if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
                 updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
             elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
                 updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
             else:
                 updown = up @ down
-
-            updown *= scale
-
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+            conv_norms.append((updown * (alpha / down.shape[0])).norm().float())
+            weights.append((up_weight, down_weight, alpha))
+        if len(conv_norms) > 0:
+            norms.append(torch.stack(conv_norms))
+        norms = torch.cat(norms)
+
+        clamped = norms.clamp(min=max_norm_value / 2)
+        ratios = clamped.clamp(max=max_norm_value) / clamped
+        sqrt_ratios = list(ratios.sqrt().unbind(0))
+
+        # modules with ratio 1 are multiplied by 1, which does not change the weights
+        torch._foreach_mul_([up for up, _, _ in weights], sqrt_ratios)
+        torch._foreach_mul_([down for _, down, _ in weights], sqrt_ratios)
+
+        scaled_norms = norms * ratios
+        keys_scaled = (ratios != 1).sum()
+        return keys_scaled, scaled_norms.mean(), scaled_norms.max()
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+import torch
+
+from library.async_checkpoint import AsyncCheckpointWriter, publish_dir, recover_dir
+
+
+class DummyAccelerator:
+    def save_state(self, output_dir):
+        with open(os.path.join(output_dir, "state.txt"), "w") as f:
+            f.write("state")
+
+
+def test_weights_are_snapshotted_and_written(tmp_path):
+    weight = torch.ones(4, 4)
+    file = str(tmp_path / "model.pt")
+    removed = []
+
+    writer = AsyncCheckpointWriter(max_pending=1)
+    writer.save_weights(file, {"weight": weight}, torch.float16, {"ss_steps": "1"}, after=lambda: removed.append(file))
+    weight.add_(1)  # training continues, the snapshot must not change
+    writer.close()
+
+    saved = torch.load(file)
+    assert saved["weight"].dtype == torch.float16
+    assert torch.equal(saved["weight"], torch.ones(4, 4, dtype=torch.float16))
+    assert not os.path.exists(file + ".tmp")
+    assert removed == [file]
+
+
+def test_state_is_moved_from_staging(tmp_path):
+    state_dir = str(tmp_path / "out" / "last-state")
+    os.makedirs(os.path.dirname(state_dir))
+
+    writer = AsyncCheckpointWriter(staging_dir=str(tmp_path / "staging"))
+    writer.save_state(DummyAccelerator(), state_dir)
+    writer.close()
+
+    with open(os.path.join(state_dir, "state.txt")) as f:
+        assert f.read() == "state"
+    assert os.listdir(tmp_path / "staging") == []
+
+
+def test_previous_state_is_kept_until_replaced(tmp_path):
+    state_dir = str(tmp_path / "last-state")
+    for name, content in (("last-state", "old"), ("new", "new")):
+        os.makedirs(tmp_path / name)
+        (tmp_path / name / "state.txt").write_text(content)
+
+    publish_dir(str(tmp_path / "new"), state_dir)
+
+    assert (tmp_path / "last-state" / "state.txt").read_text() == "new"
+    assert sorted(os.listdir(tmp_path)) == ["last-state"]
+
+
+def test_interrupted_publish_is_recovered(tmp_path):
+    state_dir = str(tmp_path / "last-state")
+
+    # killed after the previous state was renamed aside
+    os.makedirs(state_dir + ".old")
+    (tmp_path / "last-state.old" / "state.txt").write_text("old")
+    recover_dir(state_dir)
+    assert (tmp_path / "last-state" / "state.txt").read_text() == "old"
+    assert not os.path.exists(state_dir + ".old")
+
+    # killed after the new state was put in place
+    os.makedirs(state_dir + ".old")
+    recover_dir(state_dir)
+    assert (tmp_path / "last-state" / "state.txt").read_text() == "old"
+    assert not os.path.exists(state_dir + ".old")
+
+
+def test_worker_error_is_raised_on_next_call(tmp_path):
+    def fail():
+        raise OSError("disk full")
+
+    writer = AsyncCheckpointWriter()
+    writer.submit("broken", fail)
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    writer.close()
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from library import model_util
+from library.train_util import BucketManager
+
+
+def make_bucket_manager(no_upscale):
+    bucket_manager = BucketManager(no_upscale, (1024, 1024), 256, 2048, 64)
+    if not no_upscale:
+        bucket_manager.set_predefined_resos(model_util.make_bucket_resolutions((1024, 1024), 256, 2048, 64))
+    return bucket_manager
+
+
+@pytest.mark.parametrize("no_upscale", [False, True])
+def test_select_buckets_matches_select_bucket(no_upscale):
+    rng = np.random.default_rng(0)
+    widths = rng.integers(64, 4096, 2000)
+    heights = rng.integers(64, 4096, 2000)
+    widths[:10] = 1024  # exact predefined resolution
+    heights[:10] = 1024
+
+    expected_manager = make_bucket_manager(no_upscale)
+    expected = [expected_manager.select_bucket(w, h) for w, h in zip(widths.tolist(), heights.tolist())]
+
+    bucket_manager = make_bucket_manager(no_upscale)
+    resos, resized_sizes, ar_errors = bucket_manager.select_buckets(widths, heights)
+
+    assert resos == [e[0] for e in expected]
+    assert resized_sizes == [e[1] for e in expected]
+    assert np.array_equal(ar_errors, np.array([e[2] for e in expected]))
+    assert bucket_manager.resos == expected_manager.resos
+
+
+def test_select_buckets_empty():
+    resos, resized_sizes, ar_errors = make_bucket_manager(False).select_buckets([], [])
+    assert resos == [] and resized_sizes == [] and len(ar_errors) == 0
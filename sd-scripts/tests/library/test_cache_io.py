@@ -0,0 +1,55 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from library.cache_io import CacheReader, LatencyHistogram
+
+
+def test_load_npz_and_prefetch(tmp_path):
+    path = str(tmp_path / "a.npz")
+    np.savez(path, latents=np.arange(6, dtype=np.float32).reshape(2, 3))
+
+    reader = CacheReader(max_workers=2, timeout=5.0)
+    reader.prefetch([path, None])
+    npz = reader.load_npz(path)
+    assert np.array_equal(npz["latents"], np.arange(6, dtype=np.float32).reshape(2, 3))
+
+    stats = reader.stats()
+    assert stats["reads"] == 1
+    assert stats["prefetch_hits"] == 1
+    reader.shutdown()
+
+
+def test_missing_file_is_not_retried(tmp_path):
+    reader = CacheReader(max_workers=1, timeout=5.0, retries=3, backoff=0.01)
+    with pytest.raises(FileNotFoundError):
+        reader.read(str(tmp_path / "missing.npz"))
+    assert reader.stats()["errors"] == 1
+    assert reader.stats()["retries"] == 0
+    reader.shutdown()
+
+
+def test_read_times_out_without_signals(tmp_path):
+    release = threading.Event()
+    reader = CacheReader(max_workers=1, timeout=0.2)
+    reader._read_file = lambda path, deadline: release.wait(5.0) and b""
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        reader.read(str(tmp_path / "slow.npz"))
+    assert time.monotonic() - start < 2.0
+    assert reader.stats()["timeouts"] == 1
+
+    release.set()
+    reader.shutdown()
+
+
+def test_histogram_percentile():
+    histogram = LatencyHistogram()
+    for ms in [0.5] * 90 + [100.0] * 10:
+        histogram.add(ms)
+    assert histogram.count == 100
+    assert histogram.percentile(50) == 1.0
+    assert histogram.percentile(95) == 128.0
@@ -0,0 +1,93 @@
+import json
+
+import torch
+
+from library import compile_utils, flux_models, flux_utils, step_profiler
+from library.step_profiler import StepProfiler
+
+
+def create_tiny_flux():
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=2.0,
+        num_heads=2,
+        depth=2,
+        depth_single_blocks=2,
+        axes_dim=[8, 12, 12],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    return flux_models.Flux(params).eval()
+
+
+def forward(flux, batch_size, txt_len, h, w):
+    torch.manual_seed(1)
+    txt_ids, img_ids = flux_utils.get_position_ids(batch_size, txt_len, h, w, "cpu")
+    with torch.no_grad():
+        return flux(
+            img=torch.randn(batch_size, h * w, 64),
+            img_ids=img_ids,
+            txt=torch.randn(batch_size, txt_len, 32),
+            txt_ids=txt_ids,
+            timesteps=torch.full((batch_size,), 0.5),
+            y=torch.randn(batch_size, 32),
+            guidance=torch.full((batch_size,), 3.5),
+        )
+
+
+def test_compiled_blocks_match_eager(tmp_path):
+    torch.manual_seed(0)
+    flux = create_tiny_flux()
+    expected = [forward(flux, 1, 4, 2, 2), forward(flux, 1, 4, 2, 3)]
+
+    torch._dynamo.reset()
+    num_compiles = compile_utils.get_num_compiles()
+    summary_path = tmp_path / "summary.jsonl"
+    step_profiler.set_profiler(StepProfiler(summary_path=str(summary_path)))
+    try:
+        flux.compile_blocks(backend="eager")
+        assert all(isinstance(block._forward, compile_utils.CompiledForward) for block in flux.double_blocks)
+
+        profiler = step_profiler.get_profiler()
+        profiler.begin_step(1)
+        outputs = [forward(flux, 1, 4, 2, 2), forward(flux, 1, 4, 2, 3), forward(flux, 1, 4, 2, 2)]
+        profiler.end_step()
+        profiler.close()
+    finally:
+        step_profiler.set_profiler(StepProfiler.disabled())
+
+    for output, reference in zip(outputs, expected + expected[:1]):
+        torch.testing.assert_close(output, reference)
+
+    # one compile for each block class and shape, the blocks of the same class share the graph
+    summary = json.loads(summary_path.read_text().splitlines()[0])
+    assert summary["phases"]["compile"]["count"] == 4
+    assert compile_utils.get_num_compiles() - num_compiles == 4
+
+
+def test_dynamic_blocks_compile_once():
+    torch.manual_seed(0)
+    flux = create_tiny_flux()
+    expected = forward(flux, 1, 4, 2, 3)
+
+    torch._dynamo.reset()
+    num_compiles = compile_utils.get_num_compiles()
+    flux.compile_blocks(backend="eager", dynamic=True)
+    forward(flux, 1, 4, 2, 2)
+    num_first_compiles = compile_utils.get_num_compiles() - num_compiles
+    torch.testing.assert_close(forward(flux, 1, 4, 2, 3), expected)
+    assert num_first_compiles == 2  # one for each block class
+    assert compile_utils.get_num_compiles() - num_compiles == num_first_compiles  # the other shape does not recompile
+
+
+def test_cache_size_limit_covers_the_blocks():
+    flux = create_tiny_flux()
+    blocks = list(flux.double_blocks) + list(flux.single_blocks)
+    limit = compile_utils.get_cache_size_limit(blocks, 10, dynamic=False, inlined=True)
+    assert limit == compile_utils.NUM_GRAD_MODES * (10 + compile_utils.EXTRA_SHAPES)
+    assert compile_utils.get_cache_size_limit(blocks, 10, dynamic=False, inlined=False) == limit * 2
+    assert compile_utils.get_cache_size_limit(blocks, 10, dynamic=True, inlined=True) == compile_utils.NUM_GRAD_MODES
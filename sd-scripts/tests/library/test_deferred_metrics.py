@@ -0,0 +1,46 @@
+import torch
+
+from library.train_util import DeferredMetrics, LossRecorder
+
+
+def test_flush_converts_nested_tensors():
+    metrics = DeferredMetrics(sync_every=2)
+    metrics.add(loss=torch.tensor(1.5), step=0, logs={"norm/avg_key_norm": torch.tensor(0.25), "lr/unet": 1e-4})
+    assert not metrics.should_flush()
+    metrics.add(loss=torch.tensor(2.5), step=1, logs=None)
+    assert metrics.should_flush()
+
+    entries = metrics.flush()
+    assert [entry["loss"] for entry in entries] == [1.5, 2.5]
+    assert entries[0]["logs"] == {"norm/avg_key_norm": 0.25, "lr/unet": 1e-4}
+    assert isinstance(entries[0]["loss"], float)
+    assert metrics.pending == []
+
+
+def test_deferred_losses_give_same_average():
+    losses = [0.5, 0.25, 0.75, 1.0, 0.125]
+    expected = LossRecorder()
+    for step, loss in enumerate(losses):
+        expected.add(epoch=0, step=step, loss=loss)
+
+    recorder = LossRecorder()
+    metrics = DeferredMetrics(sync_every=3)
+    for step, loss in enumerate(losses):
+        metrics.add(loss=torch.tensor(loss), epoch=0, step=step)
+        if metrics.should_flush() or step == len(losses) - 1:
+            for entry in metrics.flush():
+                recorder.add(epoch=entry["epoch"], step=entry["step"], loss=entry["loss"])
+    assert recorder.moving_average == expected.moving_average
+
+
+def test_skipped_steps_are_not_averaged():
+    recorder = LossRecorder()
+    # resumed in the middle of the second epoch, the first two batches were skipped
+    recorder.add(epoch=1, step=2, loss=1.0)
+    recorder.add(epoch=1, step=3, loss=3.0)
+    assert recorder.moving_average == 2.0
+
+    # the next epoch fills the skipped slots and replaces the others
+    for step, loss in enumerate([4.0, 4.0, 4.0, 4.0]):
+        recorder.add(epoch=2, step=step, loss=loss)
+    assert recorder.moving_average == 4.0
@@ -0,0 +1,63 @@
+import torch
+
+from library import flat_params
+
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(8, 4, bias=False), torch.nn.Linear(4, 8))
+
+
+def test_params_become_views_of_the_buffer():
+    model = make_model()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+
+    groups, buffers = flat_params.flatten_param_groups([{"params": list(model.parameters()), "lr": 1e-3}])
+
+    assert len(buffers) == 1
+    assert groups[0]["lr"] == 1e-3
+    assert groups[0]["params"] == [buffers[0].flat_param]
+    assert buffers[0].is_intact()
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, expected[key])
+        assert buffers[0].contains(value)
+
+
+def test_gradients_and_optimizer_step_go_through_the_buffer():
+    model = make_model()
+    reference = make_model()
+    groups, buffers = flat_params.flatten_param_groups([{"params": list(model.parameters())}])
+    optimizer = torch.optim.AdamW(groups, lr=1e-2)
+    reference_optimizer = torch.optim.AdamW(reference.parameters(), lr=1e-2)
+
+    x = torch.randn(3, 8)
+    for _ in range(2):
+        optimizer.zero_grad(set_to_none=False)
+        model(x).square().mean().backward()
+        optimizer.step()
+
+        reference_optimizer.zero_grad()
+        reference(x).square().mean().backward()
+        reference_optimizer.step()
+
+    assert buffers[0].is_intact()
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p, q, atol=1e-6)
+        assert torch.allclose(p.grad, q.grad, atol=1e-6)
+
+
+def test_copy_state_dict_to_cpu_matches_per_key_copy():
+    model = make_model()
+    model.register_buffer("scale", torch.ones(2))  # not a parameter, copied per key
+    _, buffers = flat_params.flatten_param_groups([list(model.parameters())])
+
+    state_dict = model.state_dict()
+    copied = flat_params.copy_state_dict_to_cpu(state_dict, torch.float16, buffers)
+
+    assert copied.keys() == state_dict.keys()
+    for key, value in state_dict.items():
+        assert copied[key].dtype == torch.float16
+        assert torch.equal(copied[key], value.detach().clone().to("cpu").to(torch.float16))
+        assert not buffers[0].contains(copied[key])
+    # each value owns its storage, safetensors rejects shared tensors
+    assert len({v.untyped_storage().data_ptr() for v in copied.values()}) == len(copied)
@@ -0,0 +1,169 @@
+import torch
+
+from library import flux_models, flux_utils
+from library.flux_models import EmbedND, PositionIdsCache
+
+
+def create_tiny_flux():
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=2.0,
+        num_heads=2,
+        depth=1,
+        depth_single_blocks=1,
+        axes_dim=[8, 12, 12],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    return flux_models.Flux(params).eval()
+
+
+def test_cached_ids_match_uncached_ids():
+    cache = PositionIdsCache()
+    txt_ids, img_ids = cache.get_ids(2, 5, 3, 4, "cpu")
+
+    torch.testing.assert_close(img_ids, flux_utils.prepare_img_ids(2, 3, 4), rtol=0, atol=0)
+    torch.testing.assert_close(txt_ids, torch.zeros(2, 5, 3), rtol=0, atol=0)
+
+    # same tensors for the same shapes, other tensors for other shapes
+    assert cache.get_ids(2, 5, 3, 4, "cpu")[1] is img_ids
+    assert cache.get_ids(2, 5, 4, 3, "cpu")[1] is not img_ids
+    assert cache.get_ids(2, 5, 3, 4, "cpu", torch.bfloat16)[1].dtype == torch.bfloat16
+
+
+def test_cache_is_bounded():
+    cache = PositionIdsCache(max_entries=2)
+    _, first = cache.get_ids(1, 4, 2, 2, "cpu")
+    cache.get_ids(1, 4, 2, 3, "cpu")
+    cache.get_ids(1, 4, 2, 4, "cpu")
+
+    assert len(cache.entries) == 2
+    assert len(cache.keys) == 2
+    assert cache.get_ids(1, 4, 2, 2, "cpu")[1] is not first  # evicted and rebuilt
+
+
+def test_cached_pe_matches_uncached_pe():
+    cache = PositionIdsCache()
+    pe_embedder = EmbedND(dim=32, theta=10_000, axes_dim=[8, 12, 12])
+    txt_ids, img_ids = cache.get_ids(2, 5, 3, 4, "cpu")
+
+    pe = cache.get_pe(pe_embedder, txt_ids, img_ids)
+    expected = pe_embedder(torch.cat((torch.zeros(2, 5, 3), flux_utils.prepare_img_ids(2, 3, 4)), dim=1))
+    torch.testing.assert_close(pe, expected, rtol=0, atol=0)
+    assert cache.get_pe(pe_embedder, txt_ids, img_ids) is pe
+
+    # ids which are not from the cache are computed every time
+    other = cache.get_pe(pe_embedder, txt_ids.clone(), img_ids.clone())
+    assert other is not pe
+    torch.testing.assert_close(other, expected, rtol=0, atol=0)
+
+
+def test_ids_with_batch_size():
+    cache = PositionIdsCache()
+    txt_ids, img_ids = cache.get_ids(2, 5, 3, 4, "cpu")
+
+    double_txt_ids, double_img_ids = cache.get_ids_with_batch_size(txt_ids, img_ids, 4)
+    assert double_img_ids is cache.get_ids(4, 5, 3, 4, "cpu")[1]
+    torch.testing.assert_close(double_img_ids, torch.cat([img_ids, img_ids]), rtol=0, atol=0)
+    torch.testing.assert_close(double_txt_ids, torch.cat([txt_ids, txt_ids]), rtol=0, atol=0)
+
+    # not cached ids are concatenated
+    uncached_txt_ids, uncached_img_ids = cache.get_ids_with_batch_size(txt_ids.clone(), img_ids.clone(), 4)
+    torch.testing.assert_close(uncached_img_ids, double_img_ids, rtol=0, atol=0)
+    torch.testing.assert_close(uncached_txt_ids, double_txt_ids, rtol=0, atol=0)
+
+
+def test_flux_forward_with_cached_ids():
+    torch.manual_seed(0)
+    flux = create_tiny_flux()
+    batch_size, txt_len, h, w = 2, 6, 4, 4
+    img = torch.randn(batch_size, h * w, 64)
+    txt = torch.randn(batch_size, txt_len, 32)
+    y = torch.randn(batch_size, 32)
+    timesteps = torch.full((batch_size,), 0.5)
+    guidance = torch.full((batch_size,), 3.5)
+
+    txt_ids, img_ids = flux_utils.get_position_ids(batch_size, txt_len, h, w, "cpu")
+    with torch.no_grad():
+        cached = flux(img=img, img_ids=img_ids, txt=txt, txt_ids=txt_ids, timesteps=timesteps, y=y, guidance=guidance)
+        cached_again = flux(img=img, img_ids=img_ids, txt=txt, txt_ids=txt_ids, timesteps=timesteps, y=y, guidance=guidance)
+        uncached = flux(
+            img=img,
+            img_ids=flux_utils.prepare_img_ids(batch_size, h, w),
+            txt=txt,
+            txt_ids=torch.zeros(batch_size, txt_len, 3),
+            timesteps=timesteps,
+            y=y,
+            guidance=guidance,
+        )
+    torch.testing.assert_close(cached, uncached)
+    torch.testing.assert_close(cached_again, uncached)
+
+
+def test_gradient_checkpointing_policies():
+    from library.flux_models import parse_gradient_checkpointing_policy, select_gradient_checkpointing_blocks
+
+    assert select_gradient_checkpointing_blocks("all", 5) == [0, 1, 2, 3, 4]
+    assert select_gradient_checkpointing_blocks("every:2", 5) == [0, 2, 4]
+    assert select_gradient_checkpointing_blocks("first:3", 5) == [0, 1, 2]
+    assert select_gradient_checkpointing_blocks("first:9", 5) == [0, 1, 2, 3, 4]
+
+    # the smallest blocks are not checkpointed while they fit in the budget
+    mib = 1024**2
+    sizes = [400 * mib, 100 * mib, 300 * mib, 100 * mib, 200 * mib]
+    assert select_gradient_checkpointing_blocks(f"budget:{400 / 1024}", 5, sizes) == [0, 2]
+    assert select_gradient_checkpointing_blocks("budget:0.001", 5, sizes) == [0, 1, 2, 3, 4]
+    assert select_gradient_checkpointing_blocks("budget:100", 5, sizes) == []
+
+    assert parse_gradient_checkpointing_policy("budget:2.5") == ("budget", 2.5)
+    for invalid in ["", "some", "all:1", "every", "every:0", "first:x", "budget:-1"]:
+        try:
+            parse_gradient_checkpointing_policy(invalid)
+        except ValueError:
+            continue
+        assert False, invalid
+
+
+def test_partial_gradient_checkpointing_matches_full():
+    torch.manual_seed(0)
+    flux = create_tiny_flux()
+    flux.double_blocks.append(flux_models.DoubleStreamBlock(64, 2, mlp_ratio=2.0, qkv_bias=True))
+    flux.single_blocks.append(flux_models.SingleStreamBlock(64, 2, mlp_ratio=2.0))
+    flux.train()
+
+    batch_size, txt_len, h, w = 2, 6, 4, 4
+    img = torch.randn(batch_size, h * w, 64)
+    txt = torch.randn(batch_size, txt_len, 32)
+    y = torch.randn(batch_size, 32)
+    timesteps = torch.full((batch_size,), 0.5)
+    guidance = torch.full((batch_size,), 3.5)
+    txt_ids, img_ids = flux_utils.get_position_ids(batch_size, txt_len, h, w, "cpu")
+
+    def grads(blocks):
+        flux.zero_grad()
+        flux.enable_gradient_checkpointing(blocks=blocks)
+        out = flux(img=img, img_ids=img_ids, txt=txt, txt_ids=txt_ids, timesteps=timesteps, y=y, guidance=guidance)
+        out.square().mean().backward()
+        return [p.grad.clone() for p in flux.parameters() if p.grad is not None]
+
+    full = grads(None)
+    partial = grads([0, 3])
+    assert [b.gradient_checkpointing for b in flux.double_blocks + flux.single_blocks] == [True, False, False, True]
+    assert len(full) == len(partial)
+    for a, b in zip(full, partial):
+        torch.testing.assert_close(a, b)
+
+
+def test_measure_block_activation_sizes():
+    flux = create_tiny_flux()
+    flux.requires_grad_(False)  # as with LoRA, the saved activations do not depend on it
+
+    small = flux.measure_block_activation_sizes(4, 2, 2, torch.float32)
+    large = flux.measure_block_activation_sizes(8, 4, 4, torch.float32)
+    assert len(small) == 2
+    assert all(size > 0 for size in small)
+    assert all(l > s for s, l in zip(small, large))
@@ -218,3 +218,154 @@ def test_different_timestep_count(args, device):
     assert timesteps.shape == (2,)
     # Check that timesteps are within the proper range
     assert torch.all(timesteps < 500)
+
+
+def test_group_sample_prompts():
+    from library.flux_train_utils import group_sample_prompts
+
+    prompts = [
+        {"enum": 0, "width": 512, "height": 512},
+        {"enum": 1, "width": 768, "height": 512},
+        {"enum": 2, "width": 520, "height": 520},  # rounded to 512x512
+        {"enum": 3, "width": 512, "height": 512, "sample_steps": 4},
+        {"enum": 4, "width": 512, "height": 512},
+        {"enum": 5, "width": 512, "height": 512, "controlnet_image": "cn.png"},
+    ]
+    batches = group_sample_prompts(prompts, 2)
+    assert [[p["enum"] for p in batch] for batch in batches] == [[0, 2], [4], [1], [3], [5]]
+    assert [[p["enum"] for p in batch] for batch in group_sample_prompts(prompts, 1)] == [[i] for i in range(6)]
+
+
+@pytest.mark.parametrize("cfg_scale", [None, 2.0])
+def test_batched_denoise_matches_per_prompt(cfg_scale):
+    from library import flux_models, flux_utils
+    from library.flux_train_utils import denoise, get_schedule
+
+    torch.manual_seed(0)
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=2.0,
+        num_heads=2,
+        depth=1,
+        depth_single_blocks=1,
+        axes_dim=[8, 12, 12],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    flux = flux_models.Flux(params).eval()
+
+    batch_size, seq_len, h, w = 3, 8, 4, 4
+    noise = torch.cat([torch.randn(1, h * w, 64, generator=torch.Generator().manual_seed(seed)) for seed in range(batch_size)])
+    t5_out = torch.randn(batch_size, seq_len, 32)
+    l_pooled = torch.randn(batch_size, 32)
+    txt_ids = torch.zeros(batch_size, seq_len, 3)
+    img_ids = flux_utils.prepare_img_ids(batch_size, h, w)
+    timesteps = get_schedule(2, h * w)
+
+    def cond(i):
+        if cfg_scale is None:
+            return None
+        return (cfg_scale, torch.zeros_like(l_pooled[i : i + 1]), torch.zeros_like(t5_out[i : i + 1]), None)
+
+    with torch.no_grad():
+        batched = denoise(
+            flux,
+            noise,
+            img_ids,
+            t5_out,
+            txt_ids,
+            l_pooled,
+            timesteps,
+            neg_cond=None if cfg_scale is None else (cfg_scale, torch.zeros_like(l_pooled), torch.zeros_like(t5_out), None),
+        )
+        single = torch.cat(
+            [
+                denoise(
+                    flux,
+                    noise[i : i + 1],
+                    img_ids[i : i + 1],
+                    t5_out[i : i + 1],
+                    txt_ids[i : i + 1],
+                    l_pooled[i : i + 1],
+                    timesteps,
+                    neg_cond=cond(i),
+                )
+                for i in range(batch_size)
+            ]
+        )
+    torch.testing.assert_close(batched, single)
+
+
+def test_trimmed_t5_length():
+    from library.flux_train_utils import get_trimmed_t5_length, trim_t5_outputs
+
+    mask = torch.zeros(2, 512)
+    mask[0, :70] = 1
+    mask[1, :10] = 1
+    neg_mask = torch.zeros(2, 512)
+    neg_mask[:, :130] = 1
+
+    assert get_trimmed_t5_length([mask], 64) == 128
+    assert get_trimmed_t5_length([mask, neg_mask], 64) == 192
+    assert get_trimmed_t5_length([torch.zeros(1, 512)], 64) == 64
+    assert get_trimmed_t5_length([torch.ones(1, 500)], 64) == 500  # not longer than the padded length
+    assert get_trimmed_t5_length([None], 64) is None
+
+    t5_out, trimmed_mask, none = trim_t5_outputs(128, torch.randn(2, 512, 32), mask, None)
+    assert t5_out.shape == (2, 128, 32) and trimmed_mask.shape == (2, 128) and none is None
+
+
+def test_trimmed_t5_outputs_match_padded_outputs():
+    from library import flux_models, flux_utils
+    from library.flux_train_utils import get_trimmed_t5_length, trim_t5_outputs
+
+    torch.manual_seed(0)
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=2.0,
+        num_heads=2,
+        depth=1,
+        depth_single_blocks=1,
+        axes_dim=[8, 12, 12],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    flux = flux_models.Flux(params).eval()
+
+    batch_size, seq_len, h, w = 2, 32, 4, 4
+    img = torch.randn(batch_size, h * w, 64)
+    t5_out = torch.randn(batch_size, seq_len, 32)
+    t5_attn_mask = torch.zeros(batch_size, seq_len, dtype=torch.long)
+    t5_attn_mask[0, :5] = 1
+    t5_attn_mask[1, :11] = 1
+    y = torch.randn(batch_size, 32)
+    timesteps = torch.full((batch_size,), 0.5)
+    guidance = torch.full((batch_size,), 3.5)
+
+    def forward(t5_out, t5_attn_mask):
+        txt_ids, img_ids = flux_utils.get_position_ids(batch_size, t5_out.shape[1], h, w, "cpu")
+        return flux(
+            img=img,
+            img_ids=img_ids,
+            txt=t5_out,
+            txt_ids=txt_ids,
+            timesteps=timesteps,
+            y=y,
+            guidance=guidance,
+            txt_attention_mask=t5_attn_mask,
+        )
+
+    length = get_trimmed_t5_length([t5_attn_mask], 8)
+    assert length == 16
+    with torch.no_grad():
+        padded = forward(t5_out, t5_attn_mask)
+        trimmed = forward(*trim_t5_outputs(length, t5_out, t5_attn_mask))
+    torch.testing.assert_close(trimmed, padded)
@@ -0,0 +1,62 @@
+import os
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from library import fp8_model_cache
+
+
+def make_model_file(path, seed=0):
+    torch.manual_seed(seed)
+    state_dict = {
+        "linear.weight": torch.randn(8, 4, dtype=torch.bfloat16),
+        "linear.bias": torch.randn(8, dtype=torch.float32),
+        "norm.scale": torch.randn(4, dtype=torch.float16),
+        "step": torch.tensor(3, dtype=torch.int64),
+        "empty": torch.zeros(0, dtype=torch.bfloat16),
+    }
+    save_file(state_dict, str(path))
+    return state_dict
+
+
+def test_cached_model_matches_cast_model(tmp_path):
+    source = tmp_path / "model.safetensors"
+    state_dict = make_model_file(source)
+    cache_dir = tmp_path / "cache"
+
+    cache_path = fp8_model_cache.get_fp8_model_path(str(cache_dir), str(source))
+    assert cache_path != str(source) and os.path.exists(cache_path)
+    assert fp8_model_cache.is_fp8_file(cache_path)
+    assert not fp8_model_cache.is_fp8_file(str(source))
+
+    cached = load_file(cache_path)
+    assert cached.keys() == state_dict.keys()
+    for key, value in state_dict.items():
+        expected = value.to(torch.float8_e4m3fn) if value.dtype.is_floating_point else value
+        assert cached[key].dtype == expected.dtype
+        assert cached[key].shape == expected.shape
+        assert torch.equal(cached[key].float(), expected.float())
+
+    # the cache is used, and an fp8 file is used as is
+    assert fp8_model_cache.get_fp8_model_path(str(cache_dir), str(source)) == cache_path
+    assert fp8_model_cache.get_fp8_model_path(str(cache_dir), cache_path) == cache_path
+    assert not [name for name in os.listdir(cache_dir) if name.endswith(".tmp")]
+
+
+def test_changed_source_renews_cache(tmp_path):
+    source = tmp_path / "model.safetensors"
+    make_model_file(source)
+    cache_dir = tmp_path / "cache"
+    old_cache_path = fp8_model_cache.get_fp8_model_path(str(cache_dir), str(source))
+
+    make_model_file(source, seed=1)
+    new_cache_path = fp8_model_cache.get_fp8_model_path(str(cache_dir), str(source))
+    assert new_cache_path != old_cache_path
+    assert os.listdir(cache_dir) == [os.path.basename(new_cache_path)]  # the old cache is removed
+
+    # another model with the same file name has its own cache
+    other = tmp_path / "other" / "model.safetensors"
+    other.parent.mkdir()
+    make_model_file(other, seed=1)
+    assert fp8_model_cache.get_fp8_model_path(str(cache_dir), str(other)) != new_cache_path
+    assert len(os.listdir(cache_dir)) == 2
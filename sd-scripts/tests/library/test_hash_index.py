@@ -0,0 +1,66 @@
+import os
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from library import hash_index, train_util
+
+
+@pytest.fixture
+def index_path(tmp_path, monkeypatch):
+    path = tmp_path / "cache" / "hash_index.jsonl"
+    monkeypatch.setenv("SD_SCRIPTS_HASH_INDEX", str(path))
+    monkeypatch.setattr(hash_index, "_entries", {})
+    monkeypatch.setattr(hash_index, "_index_mtime_ns", None)
+    return path
+
+
+def create_model(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    save_file({"weight": torch.randn(512, 1024)}, path)  # 2 MiB, the legacy hash window is in the data
+    return path
+
+
+def test_hashes_match_train_util(tmp_path, index_path):
+    path = create_model(tmp_path)
+    hashes = hash_index.get_file_hashes(path)
+
+    with open(path, "rb") as f:
+        assert hashes["addnet"] == train_util.addnet_hash_safetensors(f)
+        assert hashes["legacy"] == train_util.addnet_hash_legacy(f)
+    assert train_util.model_hash(path) == hashes["legacy"]
+    assert train_util.calculate_sha256(path) == hashes["sha256"]
+    assert train_util.model_hash(str(tmp_path / "missing.safetensors")) == "NOFILE"
+
+
+def test_hashes_are_reused_across_processes(tmp_path, index_path, monkeypatch):
+    path = create_model(tmp_path)
+    hashes = hash_index.get_file_hashes(path)
+    assert index_path.exists()
+
+    # a new process reads the index and does not hash the file again
+    monkeypatch.setattr(hash_index, "_entries", {})
+    monkeypatch.setattr(hash_index, "_index_mtime_ns", None)
+
+    def fail(path):
+        raise AssertionError("hashed again")
+
+    monkeypatch.setattr(hash_index, "compute_file_hashes", fail)
+    assert hash_index.get_file_hashes(path) == hashes
+
+
+def test_changed_file_is_hashed_again(tmp_path, index_path):
+    path = create_model(tmp_path)
+    hashes = hash_index.get_file_hashes(path)
+
+    save_file({"weight": torch.randn(512, 1024)}, path)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # for file systems with coarse mtime
+    assert hash_index.get_file_hashes(path)["sha256"] != hashes["sha256"]
+
+
+def test_update_in_background(tmp_path, index_path):
+    path = create_model(tmp_path)
+    hash_index.update_in_background(path).join()
+    assert os.path.abspath(path) in index_path.read_text()
@@ -0,0 +1,76 @@
+import json
+import os
+from types import SimpleNamespace
+
+from PIL import Image
+
+from library.train_util import DreamBoothDataset, glob_images
+
+
+def create_images(image_dir, sizes):
+    for i, size in enumerate(sizes):
+        Image.new("RGB", size).save(os.path.join(image_dir, f"{i}.png"))
+
+
+def scan(image_dir):
+    dataset = DreamBoothDataset.__new__(DreamBoothDataset)  # scan_images uses no dataset state
+    subset = SimpleNamespace(caption_extension=".txt", enable_wildcard=False, class_tokens="sks")
+    img_paths = glob_images(str(image_dir), "*")
+    info_cache_file = os.path.join(image_dir, DreamBoothDataset.IMAGE_INFO_CACHE_FILE)
+    sizes, _ = dataset.scan_images(img_paths, [None] * len(img_paths), info_cache_file, subset, lambda *args: None)
+    return dict(zip(img_paths, sizes))
+
+
+def record_probes(monkeypatch):
+    probed = []
+    get_image_size = DreamBoothDataset.get_image_size
+
+    def probe(self, image_path):
+        probed.append(image_path)
+        return get_image_size(self, image_path)
+
+    monkeypatch.setattr(DreamBoothDataset, "get_image_size", probe)
+    return probed
+
+
+def test_first_scan_writes_cache(tmp_path):
+    create_images(tmp_path, [(64, 32), (32, 48)])
+
+    sizes = scan(tmp_path)
+
+    with open(tmp_path / DreamBoothDataset.IMAGE_INFO_CACHE_FILE, encoding="utf-8") as f:
+        info_cache = json.load(f)
+    assert set(info_cache) == set(sizes)
+    for img_path, size in sizes.items():
+        assert tuple(info_cache[img_path]["resolution"]) == tuple(size)
+        assert info_cache[img_path]["caption"] == "sks"
+        assert info_cache[img_path]["mtime"] == os.stat(img_path).st_mtime_ns
+
+
+def test_second_scan_reuses_cache(tmp_path, monkeypatch):
+    create_images(tmp_path, [(64, 32), (32, 48)])
+    first = scan(tmp_path)
+
+    probed = record_probes(monkeypatch)
+    second = scan(tmp_path)
+
+    assert probed == []
+    assert {path: tuple(size) for path, size in second.items()} == {path: tuple(size) for path, size in first.items()}
+
+
+def test_changed_image_is_probed_again(tmp_path, monkeypatch):
+    create_images(tmp_path, [(64, 32), (32, 48), (16, 16)])
+    scan(tmp_path)
+    touched, resized = str(tmp_path / "0.png"), str(tmp_path / "1.png")
+
+    probed = record_probes(monkeypatch)
+    st = os.stat(touched)
+    os.utime(touched, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert sorted(scan(tmp_path)) == sorted([touched, resized, str(tmp_path / "2.png")])
+    assert probed == [touched]
+
+    probed.clear()
+    Image.new("RGB", (80, 40)).save(resized)
+    sizes = scan(tmp_path)
+    assert probed == [resized]
+    assert tuple(sizes[resized]) == (80, 40)
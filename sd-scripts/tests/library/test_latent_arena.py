@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+
+from library.latent_arena import LatentArena, LATENTS, LATENTS_FLIPPED
+
+
+class DummyInfo:
+    def __init__(self, image_key, latents=None, latents_npz=None, bucket_reso=(64, 64)):
+        self.image_key = image_key
+        self.latents = latents
+        self.latents_flipped = None
+        self.latents_npz = latents_npz
+        self.latents_original_size = None
+        self.latents_crop_ltrb = None
+        self.alpha_mask = None
+        self.bucket_reso = bucket_reso
+
+
+def test_build_groups_by_shape_and_rebinds_views():
+    a = torch.randn(4, 8, 8)
+    b = torch.randn(4, 8, 8)
+    c = torch.randn(4, 8, 16)
+    infos = [DummyInfo("a", a.clone()), DummyInfo("b", b.clone()), DummyInfo("c", c.clone()), DummyInfo("d")]
+
+    arena = LatentArena.build(infos)
+
+    assert len(arena) == 3
+    assert len(arena.tensors) == 2
+    assert torch.equal(infos[0].latents, a)
+    assert torch.equal(infos[1].latents, b)
+    assert torch.equal(infos[2].latents, c)
+    assert infos[3].latents is None
+
+    # same-shaped latents are views of one shared storage
+    assert infos[0].latents.is_shared()
+    assert infos[0].latents.untyped_storage().data_ptr() == infos[1].latents.untyped_storage().data_ptr()
+    assert torch.equal(arena.get("b", LATENTS), b)
+    assert arena.get("b", LATENTS_FLIPPED) is None
+
+
+def test_build_loads_from_disk_once():
+    latents = np.random.randn(4, 8, 8).astype(np.float32)
+    flipped = np.random.randn(4, 8, 8).astype(np.float32)
+    calls = []
+
+    def load(npz_path, bucket_reso):
+        calls.append(npz_path)
+        return latents, (64, 64), (0, 0, 64, 64), flipped, None
+
+    infos = [DummyInfo("a", latents_npz="a.npz")]
+    LatentArena.build(infos, load)
+
+    assert calls == ["a.npz"]
+    assert torch.equal(infos[0].latents, torch.from_numpy(latents))
+    assert torch.equal(infos[0].latents_flipped, torch.from_numpy(flipped))
+    assert infos[0].latents_original_size == (64, 64)
+    assert infos[0].latents_crop_ltrb == (0, 0, 64, 64)
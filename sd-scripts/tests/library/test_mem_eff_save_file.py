@@ -0,0 +1,47 @@
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library import train_util
+from library.utils import mem_eff_save_file
+
+
+def create_tensors():
+    torch.manual_seed(0)
+    return {
+        "lora_down.weight": torch.randn(16, 512 * 64),  # 2 MiB, the legacy hash window is in the data
+        "lora_up.weight": torch.randn(64, 16).to(torch.bfloat16),
+        "alpha": torch.tensor(8.0),
+        "mask": torch.tensor([True, False]),
+        "empty": torch.zeros(0),
+    }
+
+
+def test_round_trip(tmp_path):
+    tensors = create_tensors()
+    path = str(tmp_path / "lora.safetensors")
+    assert mem_eff_save_file(tensors, path, {"ss_network_dim": "16"}) is None
+
+    loaded = load_file(path)
+    assert loaded.keys() == tensors.keys()
+    for key, tensor in tensors.items():
+        assert loaded[key].dtype == tensor.dtype
+        assert torch.equal(loaded[key], tensor)
+    with safe_open(path, framework="pt") as f:
+        assert f.metadata() == {"ss_network_dim": "16"}
+
+
+def test_model_hashes_match_the_file(tmp_path):
+    tensors = create_tensors()
+    path = str(tmp_path / "lora.safetensors")
+    metadata = {"ss_network_dim": "16", "sshs_model_hash": "stale"}
+    model_hash, legacy_hash = mem_eff_save_file(tensors, path, metadata, add_model_hashes=True)
+
+    with open(path, "rb") as f:
+        assert model_hash == train_util.addnet_hash_safetensors(f)
+        assert legacy_hash == train_util.addnet_hash_legacy(f)
+    with safe_open(path, framework="pt") as f:
+        assert f.metadata()["sshs_model_hash"] == model_hash
+        assert f.metadata()["sshs_legacy_hash"] == legacy_hash
+        assert f.metadata()["ss_network_dim"] == "16"
+    assert metadata["sshs_model_hash"] == "stale"  # the argument is not changed
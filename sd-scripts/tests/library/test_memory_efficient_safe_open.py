@@ -0,0 +1,85 @@
+import pytest
+import torch
+from safetensors.torch import load_file, save_file
+
+from library.utils import MemoryEfficientSafeOpen, load_safetensors
+
+
+def create_file(tmp_path):
+    tensors = {
+        "f32": torch.randn(3, 5),
+        "bf16": torch.randn(7, 2).to(torch.bfloat16),
+        "f16": torch.randn(4).to(torch.float16),
+        "i64": torch.arange(6).reshape(2, 3),
+        "bool": torch.tensor([True, False, True]),
+        "scalar": torch.tensor(1.5),
+        "empty": torch.zeros(0, 4),
+        "fp8": torch.randn(4, 4).to(torch.float8_e4m3fn),
+    }
+    path = str(tmp_path / "model.safetensors")
+    save_file(tensors, path)
+    return path, load_file(path)
+
+
+def assert_equal(actual, expected):
+    assert actual.dtype == expected.dtype
+    assert actual.shape == expected.shape
+    assert torch.equal(actual.to(torch.float32), expected.to(torch.float32))
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_get_tensor(tmp_path, use_mmap):
+    path, expected = create_file(tmp_path)
+    with MemoryEfficientSafeOpen(path, use_mmap) as f:
+        assert sorted(f.keys()) == sorted(expected.keys())
+        tensors = {key: f.get_tensor(key) for key in f.keys()}
+
+    # the views are valid after the file is closed
+    for key, tensor in tensors.items():
+        assert_equal(tensor, expected[key])
+
+
+def test_mmap_views_are_copy_on_write(tmp_path):
+    path, expected = create_file(tmp_path)
+    with MemoryEfficientSafeOpen(path, use_mmap=True) as f:
+        tensor = f.get_tensor("f32")
+        tensor += 1.0
+        torch.testing.assert_close(tensor, expected["f32"] + 1.0)
+        torch.testing.assert_close(f.get_tensor("f32"), expected["f32"] + 1.0)  # the same mapping
+
+    assert_equal(load_file(path)["f32"], expected["f32"])  # the file is not changed
+
+
+@pytest.mark.parametrize("use_mmap,readahead", [(False, 0), (False, 3), (True, 2)])
+def test_iter_tensors(tmp_path, use_mmap, readahead):
+    path, expected = create_file(tmp_path)
+    with MemoryEfficientSafeOpen(path, use_mmap) as f:
+        offsets = [f.header[key]["data_offsets"][0] for key in f.keys()]
+        items = list(f.iter_tensors(readahead=readahead))
+
+    assert [f.header[key]["data_offsets"][0] for key, _ in items] == sorted(offsets)
+    for key, tensor in items:
+        assert_equal(tensor, expected[key])
+
+
+def test_load_safetensors_without_mmap(tmp_path):
+    _, expected = create_file(tmp_path)
+    del expected["fp8"]
+    path = str(tmp_path / "model_without_fp8.safetensors")
+    save_file(expected, path)
+
+    state_dict = load_safetensors(path, "cpu", disable_mmap=True, dtype=torch.float32)
+    assert state_dict.keys() == expected.keys()
+    for key, tensor in state_dict.items():
+        torch.testing.assert_close(tensor, expected[key].to(torch.float32))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_iter_tensors_pinned_upload(tmp_path):
+    path, expected = create_file(tmp_path)
+    with MemoryEfficientSafeOpen(path) as f:
+        items = list(f.iter_tensors(device="cuda", readahead=2))
+
+    for key, tensor in items:
+        assert tensor.device.type == "cuda"
+        assert_equal(tensor.cpu(), expected[key])
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import torch
+from safetensors.torch import save_file
+
+from library import model_loading
+
+
+def create_loader(memory_budget, sizes, delay=0.2):
+    running = []
+    max_running = [0]
+    lock = threading.Lock()
+
+    def make_load(name):
+        def load():
+            with lock:
+                running.append(name)
+                max_running[0] = max(max_running[0], len(running))
+            time.sleep(delay)
+            with lock:
+                running.remove(name)
+            return name.upper()
+
+        return load
+
+    loader = model_loading.ModelLoader(memory_budget)
+    for name, size in sizes.items():
+        loader.add(name, make_load(name), size)
+    return loader, max_running
+
+
+def test_loads_concurrently():
+    loader, max_running = create_loader(None, {"flux": 0, "clip_l": 0, "t5xxl": 0, "ae": 0})
+    start = time.perf_counter()
+    models = loader.run()
+    elapsed = time.perf_counter() - start
+
+    assert models == {"flux": "FLUX", "clip_l": "CLIP_L", "t5xxl": "T5XXL", "ae": "AE"}
+    assert max_running[0] == 4
+    assert elapsed < 0.6
+    assert sorted([record.name for record in loader.records]) == ["ae", "clip_l", "flux", "t5xxl"]
+    assert "flux" in loader.format_timeline()
+
+
+def test_memory_budget():
+    # t5xxl does not fit with flux, it waits for flux and then loads alone
+    loader, max_running = create_loader(100, {"flux": 60, "t5xxl": 50, "clip_l": 5, "ae": 5})
+    loader.run()
+    records = {record.name: record for record in loader.records}
+    assert records["t5xxl"].start >= records["flux"].end
+
+    # 0 loads one model at a time
+    loader, max_running = create_loader(0, {"flux": 60, "t5xxl": 50, "clip_l": 5, "ae": 5}, delay=0.05)
+    loader.run()
+    assert max_running[0] == 1
+
+
+def test_estimate_loaded_size(tmp_path):
+    path = str(tmp_path / "model.safetensors")
+    save_file({"weight": torch.zeros(4, 8, dtype=torch.float32), "index": torch.zeros(3, dtype=torch.int64)}, path)
+
+    assert model_loading.estimate_loaded_size([path]) == 4 * 8 * 4 + 3 * 8
+    assert model_loading.estimate_loaded_size([path], torch.bfloat16) == (4 * 8 + 3) * 2  # load_safetensors casts all
+    assert model_loading.estimate_loaded_size([None, str(tmp_path / "missing.safetensors")]) == 0
@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import torch
+
+from library import cache_io
+from library.train_util import DatasetGroup, SeekableRandomSampler
+
+
+def test_order_depends_only_on_seed_and_epoch():
+    data = list(range(100))
+    a = SeekableRandomSampler(data, seed=42)
+    b = SeekableRandomSampler(data, seed=42)
+
+    a.seek(3)
+    b.seek(3)
+    assert list(a) == list(b)
+    assert sorted(a) == data
+
+    a.seek(4)
+    assert list(a) != list(b)
+
+
+def test_seek_starts_mid_epoch_once():
+    data = list(range(50))
+    sampler = SeekableRandomSampler(data, seed=0)
+    full = sampler.indices(2)
+
+    sampler.seek(2, 17)
+    assert list(sampler) == full[17:]
+    assert len(sampler) == len(data)
+
+    # start index applies to a single iteration only
+    assert list(sampler) == full
+
+
+def test_state_dict_restores_seed():
+    data = list(range(10))
+    saved = SeekableRandomSampler(data, seed=123)
+    restored = SeekableRandomSampler(data, seed=0)
+
+    assert restored.load_state_dict(saved.state_dict())
+    assert restored.indices(1) == saved.indices(1)
+
+    assert not SeekableRandomSampler(list(range(11)), seed=0).load_state_dict(saved.state_dict())
+
+
+class FakeDataset(torch.utils.data.Dataset):
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+        self.image_data = {}
+        self.num_train_images = length
+        self.num_reg_images = 0
+        self.current_epoch = 0
+
+    def __len__(self):
+        return self.length
+
+    def get_cache_files(self, index):
+        return [f"{self.name}_{index}.npz"]
+
+
+def test_readahead_follows_the_sampler_order(monkeypatch):
+    prefetched = []
+    monkeypatch.setattr(cache_io, "prefetch", lambda paths: prefetched.append(list(paths)))
+    monkeypatch.setattr(cache_io, "get_cache_reader", lambda: SimpleNamespace(max_prefetch=64))
+
+    group = DatasetGroup([FakeDataset("a", 30), FakeDataset("b", 20)])
+    sampler = SeekableRandomSampler(group, seed=1)
+    epoch = SimpleNamespace(value=3)
+    group.set_readahead(sampler, epoch, num_batches=2, num_processes=2)
+
+    order = sampler.indices(2)
+    group.prefetch_following(order[5])
+    assert prefetched == []  # the buckets of the datasets are not shuffled for the epoch yet
+
+    for dataset in group.datasets:
+        dataset.current_epoch = 3
+    group.prefetch_following(order[5])
+    # the same process takes every second batch in the main process, the current batch and the next two of them
+    assert prefetched[-1] == [group.get_cache_files(index)[0] for index in (order[5], order[7], order[9])]
+    assert group.get_cache_files(35) == ["b_5.npz"]
+
+
+def test_readahead_is_bounded_by_max_prefetch(monkeypatch):
+    prefetched = []
+    monkeypatch.setattr(cache_io, "prefetch", lambda paths: prefetched.append(list(paths)))
+    monkeypatch.setattr(cache_io, "get_cache_reader", lambda: SimpleNamespace(max_prefetch=3))
+
+    group = DatasetGroup([FakeDataset("a", 30)])
+    group.datasets[0].current_epoch = 1
+    sampler = SeekableRandomSampler(group, seed=0)
+    group.set_readahead(sampler, SimpleNamespace(value=1), num_batches=8)
+
+    group.prefetch_following(sampler.indices(0)[0])
+    assert len(prefetched[-1]) == 3
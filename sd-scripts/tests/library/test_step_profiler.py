@@ -0,0 +1,63 @@
+import json
+import time
+
+from library.step_profiler import StepProfiler
+
+
+def test_trace_and_summary(tmp_path):
+    trace_path = tmp_path / "profile" / "trace.json"
+    summary_path = tmp_path / "profile" / "summary.jsonl"
+    profiler = StepProfiler(str(trace_path), str(summary_path), summary_every=2)
+
+    for _ in range(3):
+        profiler.begin_step(num_samples=4)
+        profiler.set_step_attrs(bucket="64x64")
+        with profiler.span("forward"):
+            pass
+        profiler.begin("backward")
+        profiler.end("backward")
+        profiler.end_step()
+    profiler.close()
+
+    events = json.loads(trace_path.read_text())
+    names = [event["name"] for event in events]
+    assert names.count("step") == 3
+    assert names.count("forward") == 3
+    assert names.count("data_wait") == 2
+    assert all(event["ph"] == "X" for event in events)
+
+    summaries = [json.loads(line) for line in summary_path.read_text().splitlines()]
+    assert [summary["steps"] for summary in summaries] == [2, 1]  # the last partial window is flushed on close
+    assert set(summaries[0]["phases"]) >= {"step", "forward", "backward"}
+    assert summaries[0]["step_attrs"] == {"bucket": {"64x64": 2}}
+    assert summaries[0]["step_ms_by_attr"]["bucket"]["64x64"]["count"] == 2
+    assert summaries[1]["step_ms_by_attr"]["bucket"]["64x64"]["count"] == 1
+    assert summaries[0]["samples_per_s"] > 0
+
+
+def test_disabled_profiler_records_nothing(tmp_path):
+    profiler = StepProfiler.disabled()
+    profiler.begin_step(1)
+    with profiler.span("forward"):
+        pass
+    profiler.end_step()
+    profiler.close()
+    assert profiler.window_durations == {}
+
+
+def test_epoch_end_phases_are_not_data_wait(tmp_path):
+    trace_path = tmp_path / "trace.json"
+    profiler = StepProfiler(str(trace_path))
+
+    for _ in range(2):
+        profiler.begin_epoch()
+        profiler.begin_step(1)
+        profiler.end_step()
+        with profiler.span("epoch_save"):
+            time.sleep(0.05)
+    profiler.close()
+
+    events = json.loads(trace_path.read_text())
+    data_waits = [event["dur"] for event in events if event["name"] == "data_wait"]
+    assert len(data_waits) == 2
+    assert all(duration < 50_000 for duration in data_waits)  # microseconds
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from library import weight_server
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    shm_dir = str(tmp_path / "shm")
+    monkeypatch.setenv("SD_SCRIPTS_WEIGHT_SHM_DIR", shm_dir)
+    monkeypatch.setattr(weight_server, "get_available_memory", lambda: None)
+    server = weight_server.WeightServer(shm_dir)
+    server.start()
+    yield server
+    server.stop()
+
+
+def create_model(tmp_path, name, numel=1024):
+    path = str(tmp_path / f"{name}.safetensors")
+    save_file({"weight": torch.randn(numel), "bias": torch.randn(4).to(torch.bfloat16)}, path)
+    return path
+
+
+def test_resolve_without_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("SD_SCRIPTS_WEIGHT_SHM_DIR", str(tmp_path / "shm"))
+    path = create_model(tmp_path, "model")
+    assert weight_server.resolve(path) == path
+
+
+def test_requested_model_is_shared_from_the_next_run(tmp_path, server):
+    path = create_model(tmp_path, "model")
+    assert weight_server.resolve(path) == path  # not copied yet
+    server.process_requests()
+
+    shared_path = weight_server.resolve(path)
+    assert shared_path != path and weight_server.is_shared(shared_path)
+    assert not weight_server.is_shared(path)
+
+    expected = weight_server.attach(path)
+    state_dict = weight_server.attach(shared_path)
+    assert state_dict.keys() == expected.keys()
+    for key, tensor in state_dict.items():
+        assert tensor.dtype == expected[key].dtype
+        assert torch.equal(tensor, expected[key])
+
+    # a changed source is copied again and the old copy is removed
+    save_file({"weight": torch.zeros(8)}, path)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1_000_000_000))
+    assert weight_server.resolve(path) == path
+    server.process_requests()
+    assert not os.path.exists(shared_path)
+    assert torch.equal(weight_server.attach(weight_server.resolve(path))["weight"], torch.zeros(8))
+
+
+def test_least_recently_used_unmapped_copy_is_evicted(tmp_path, server):
+    paths = [create_model(tmp_path, f"model{i}", 64 * 1024) for i in range(3)]
+    size = os.path.getsize(paths[0])
+    server.capacity = 2 * size
+
+    shared = [server.add(path) for path in paths[:2]]
+    attached = weight_server.attach(shared[0])  # mapped, so it is kept though it is older
+    assert server.add(paths[2]) is not None
+    assert os.path.exists(shared[0]) and not os.path.exists(shared[1])
+
+    server.capacity = size
+    del attached
+    assert server.evict()
+    assert not os.path.exists(shared[0])
+
+
+def test_older_copy_is_removed_after_restart(tmp_path, server):
+    path = create_model(tmp_path, "model")
+    shared_path = server.add(path)
+    server.stop()
+
+    restarted = weight_server.WeightServer(server.shm_dir)
+    restarted.start()
+    try:
+        save_file({"weight": torch.zeros(8)}, path)
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1_000_000_000))
+        assert restarted.add(path) != shared_path
+        assert not os.path.exists(shared_path)
+    finally:
+        restarted.stop()
@@ -0,0 +1,144 @@
+import pytest
+import torch
+
+from networks.lora_flux import LoRAModule
+
+
+def reference_split_forward(module: LoRAModule, x: torch.Tensor) -> torch.Tensor:
+    # per split execution, as before the fused implementation
+    lxs = [lora_down(x) for lora_down in module.lora_down]
+    lxs = [lora_up(lx) for lora_up, lx in zip(module.lora_up, lxs)]
+    return module.org_forward(x) + torch.cat(lxs, dim=-1) * module.multiplier * module.scale
+
+
+@pytest.mark.parametrize("split_dims", [[48, 48, 48], [48, 48, 48, 96]])
+def test_fused_split_dims_forward_matches_per_split(split_dims):
+    torch.manual_seed(0)
+    in_dim = 64
+    org_linear = torch.nn.Linear(in_dim, sum(split_dims))
+    module = LoRAModule("lora_unet_test", org_linear, multiplier=0.8, lora_dim=4, alpha=2, split_dims=split_dims)
+    for lora_up in module.lora_up:
+        torch.nn.init.normal_(lora_up.weight)  # zero by default
+    module.apply_to()
+
+    x = torch.randn(2, 10, in_dim, requires_grad=True)
+    out = org_linear(x)  # forward is replaced by LoRAModule.forward
+    reference = reference_split_forward(module, x)
+    torch.testing.assert_close(out, reference)
+
+    # gradients of the input and the split weights are the same
+    grad = torch.randn_like(out)
+    params = list(module.parameters())
+    fused_grads = torch.autograd.grad(out, [x] + params, grad)
+    reference_grads = torch.autograd.grad(reference, [x] + params, grad)
+    for fused_grad, reference_grad in zip(fused_grads, reference_grads):
+        torch.testing.assert_close(fused_grad, reference_grad)
+
+    # state dict layout is unchanged
+    keys = set(module.state_dict().keys())
+    expected_keys = {"alpha"} | {f"lora_down.{i}.weight" for i in range(len(split_dims))}
+    expected_keys |= {f"lora_up.{i}.weight" for i in range(len(split_dims))}
+    assert keys == expected_keys
+
+
+def create_tiny_network(**kwargs):
+    import flux_sample_worker
+    import networks.lora_flux as lora_flux
+
+    torch.manual_seed(0)
+    flux, ae = flux_sample_worker.create_tiny_models(torch.float32)
+    network = lora_flux.create_network(1.0, 4, 2, ae, [], flux, **kwargs)
+    network.apply_to([], flux, apply_text_encoder=False, apply_unet=True)
+    for lora in network.unet_loras:
+        for lora_up in lora.lora_up if lora.split_dims is not None else [lora.lora_up]:
+            torch.nn.init.normal_(lora_up.weight)  # zero by default
+    return network
+
+
+def test_batched_ggpo_norms_match_per_module_norms():
+    network = create_tiny_network(ggpo_sigma="0.03", ggpo_beta="0.01")
+    network.train()
+    for p in network.parameters():
+        p.grad = torch.randn_like(p)
+
+    network.update_grad_norms()
+    network.update_norms()
+
+    loras = network.unet_loras
+    weight_means, combined_means, grad_means = [], [], []
+    for lora in loras:
+        up, down = lora.lora_up.weight, lora.lora_down.weight
+        weight_norms = torch.norm(up @ down, dim=1, keepdim=True)
+        combined = torch.sqrt(lora.org_weight_norm_estimate**2 + torch.sum((up @ down) ** 2, dim=1, keepdim=True))
+        grad_norms = torch.norm(lora.scale * (up @ down.grad + up.grad @ down), dim=1, keepdim=True)
+        torch.testing.assert_close(lora.weight_norms, weight_norms, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(lora.combined_weight_norms, combined, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(lora.grad_norms, grad_norms, rtol=1e-4, atol=1e-4)
+        weight_means.append(weight_norms.mean(dim=0))
+        combined_means.append(combined.mean(dim=0))
+        grad_means.append(grad_norms.mean(dim=0))
+
+    # network level norms keep the order of the modules, and are cached until the next update
+    torch.testing.assert_close(network.weight_norms(), torch.stack(weight_means), rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(network.combined_weight_norms(), torch.stack(combined_means), rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(network.grad_norms(), torch.stack(grad_means), rtol=1e-4, atol=1e-4)
+    assert network.weight_norms() is network.weight_norms()
+
+
+def reference_max_norm_regularization(state_dict, max_norm_value):
+    # per key implementation, as before the batched one
+    keys_scaled = 0
+    norms = []
+    for key in [k for k in state_dict.keys() if "lora_down" in k and "weight" in k]:
+        up_key = key.replace("lora_down", "lora_up")
+        down, up = state_dict[key], state_dict[up_key]
+        scale = state_dict[key.replace("lora_down.weight", "alpha")] / down.shape[0]
+        updown = (up @ down) * scale
+        norm = updown.norm().clamp(min=max_norm_value / 2)
+        ratio = torch.clamp(norm, max=max_norm_value) / norm
+        if ratio != 1:
+            keys_scaled += 1
+            state_dict[up_key] *= ratio**0.5
+            state_dict[key] *= ratio**0.5
+        norms.append((updown.norm() * ratio).item())
+    return keys_scaled, sum(norms) / len(norms), max(norms)
+
+
+def test_batched_max_norm_regularization_matches_per_key():
+    network = create_tiny_network()
+    state_dict = {k: v.clone() for k, v in network.state_dict().items()}
+    norms = [(lora.lora_up.weight @ lora.lora_down.weight).norm().item() * lora.scale for lora in network.unet_loras]
+    norms = sorted(norms)
+    max_norm_value = (norms[len(norms) // 2] + norms[len(norms) // 2 + 1]) / 2  # about a half of the modules are scaled
+    expected = reference_max_norm_regularization(state_dict, max_norm_value)
+
+    keys_scaled, mean_norm, max_norm = network.apply_max_norm_regularization(max_norm_value, torch.device("cpu"))
+
+    assert 0 < int(keys_scaled) == expected[0] < len(network.unet_loras)
+    assert float(mean_norm) == pytest.approx(expected[1], rel=1e-4)
+    assert float(max_norm) == pytest.approx(expected[2], rel=1e-4)
+    for key, value in network.state_dict().items():
+        torch.testing.assert_close(value, state_dict[key], rtol=1e-4, atol=1e-5)
+
+
+def test_low_rank_ggpo_perturbation_has_the_same_noise_scale():
+    torch.manual_seed(0)
+    org_linear = torch.nn.Linear(32, 64)
+    module = LoRAModule("lora_unet_test", org_linear, lora_dim=4, alpha=4, ggpo_sigma=0.03, ggpo_beta=0.01, ggpo_rank=4)
+    x = torch.randn(3, 32)
+    scale_factor = torch.linspace(0.5, 2.0, 64).view(-1, 1)
+
+    samples = torch.stack([module.low_rank_perturbation(x, scale_factor) for _ in range(2000)])
+    assert samples.shape == (2000, 3, 64)
+
+    # the full-size perturbation x @ (scale * N).T has the variance |x|^2 * scale^2 for each element
+    expected = x.square().sum(dim=1, keepdim=True) * scale_factor.view(1, -1) ** 2
+    ratio = samples.var(dim=0) / expected
+    assert ratio.mean().item() == pytest.approx(1.0, rel=0.05)
+
+    # forward with the perturbation
+    module.apply_to()
+    module.train()
+    module.combined_weight_norms = torch.ones(64, 1)
+    module.grad_norms = torch.ones(64, 1)
+    assert org_linear(x).shape == (3, 64)
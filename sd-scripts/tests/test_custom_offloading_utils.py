@@ -1,7 +1,7 @@
 import pytest
 import torch
 import torch.nn as nn
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 
 from library.custom_offloading_utils import (
     synchronize_device, 
@@ -140,9 +140,11 @@ def offloader():
 def test_offloader_init(offloader):
     assert offloader.num_blocks == 4
     assert offloader.blocks_to_swap == 2
-    assert hasattr(offloader, 'thread_pool')
-    assert offloader.futures == {}
+    assert not hasattr(offloader, 'thread_pool')  # no host threads
+    assert offloader.events == {}
+    assert offloader.cpu_buffers == {}
     assert offloader.cuda_available == (offloader.device.type == 'cuda')
+    assert (offloader.stream is not None) == offloader.cuda_available
 
 
 @patch('library.custom_offloading_utils.swap_weight_devices_cuda')
@@ -154,7 +156,7 @@ def test_swap_weight_devices(mock_no_cuda, mock_cuda, offloader: Offloader):
     # Force test for CUDA device
     offloader.cuda_available = True
     offloader.swap_weight_devices(block_to_cpu, block_to_cuda)
-    mock_cuda.assert_called_once_with(offloader.device, block_to_cpu, block_to_cuda)
+    mock_cuda.assert_called_once_with(offloader.device, block_to_cpu, block_to_cuda, offloader.stream, offloader.cpu_buffers)
     mock_no_cuda.assert_not_called()
     
     # Reset mocks
@@ -164,43 +166,39 @@ def test_swap_weight_devices(mock_no_cuda, mock_cuda, offloader: Offloader):
     # Force test for non-CUDA device
     offloader.cuda_available = False
     offloader.swap_weight_devices(block_to_cpu, block_to_cuda)
-    mock_no_cuda.assert_called_once_with(offloader.device, block_to_cpu, block_to_cuda)
+    mock_no_cuda.assert_called_once_with(offloader.device, block_to_cpu, block_to_cuda, offloader.cpu_buffers)
     mock_cuda.assert_not_called()
 
 
-@patch('library.custom_offloading_utils.Offloader.swap_weight_devices')
-def test_submit_move_blocks(mock_swap, offloader):
-    blocks = [SimpleModel() for _ in range(4)]
-    block_idx_to_cpu = 0
-    block_idx_to_cuda = 2
-    
-    # Mock the thread pool to execute synchronously
-    future = MagicMock()
-    future.result.return_value = (block_idx_to_cpu, block_idx_to_cuda)
-    offloader.thread_pool.submit = MagicMock(return_value=future)
-    
-    offloader._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda)
-    
-    # Check that the future is stored with the correct key
-    assert block_idx_to_cuda in offloader.futures
+def test_submit_move_blocks_swaps_weights_on_cpu():
+    offloader = Offloader(num_blocks=4, blocks_to_swap=2, device=torch.device('cpu'))
+    blocks = [TransformerBlock(i) for i in range(4)]
+    weights = [{k: v.clone() for k, v in block.state_dict().items()} for block in blocks]
+    storage_of_block_0 = blocks[0].linear1.weight.data_ptr()
+
+    offloader._submit_move_blocks(blocks, 0, 2)
+
+    # the weights keep their values, and block 2 reuses the memory of block 0
+    assert 2 in offloader.events
+    for block, expected in zip(blocks, weights):
+        for k, v in block.state_dict().items():
+            assert torch.equal(v, expected[k])
+    assert blocks[2].linear1.weight.data_ptr() == storage_of_block_0
+    assert offloader.cpu_buffers[blocks[0].linear1].data_ptr() == blocks[0].linear1.weight.data_ptr()
 
 
 def test_wait_blocks_move(offloader):
     block_idx = 2
     
-    # Test with no future for the block
+    # Test with no event for the block
     offloader._wait_blocks_move(block_idx)  # Should not raise
     
-    # Create a fake future and test waiting
-    future = MagicMock()
-    future.result.return_value = (0, block_idx)
-    offloader.futures[block_idx] = future
-    
+    # synchronous swap without an event
+    offloader.events[block_idx] = None
     offloader._wait_blocks_move(block_idx)
     
-    # Check that the future was removed
-    assert block_idx not in offloader.futures
-    future.result.assert_called_once()
+    # Check that the event was removed
+    assert block_idx not in offloader.events
 
 
 # ModelOffloader Tests
@@ -220,8 +218,7 @@ def model_offloader():
 def test_model_offloader_init(model_offloader):
     assert model_offloader.num_blocks == 4
     assert model_offloader.blocks_to_swap == 2
-    assert hasattr(model_offloader, 'thread_pool')
-    assert model_offloader.futures == {}
+    assert model_offloader.events == {}
     assert len(model_offloader.remove_handles) > 0  # Should have registered hooks
 
 
@@ -288,8 +285,12 @@ def test_prepare_block_devices_before_forward(mock_clean, mock_sync, mock_weight
     with patch.object(nn.Module, 'to'):
         model_offloader.prepare_block_devices_before_forward(blocks)
         
-        # Check that weighs_to_device was called for each block
-        assert mock_weights_to_device.call_count == 4
+        # Check that weighs_to_device was called for each resident block
+        assert mock_weights_to_device.call_count == 2
+        
+        # the weights of the swapped blocks are in the CPU buffers
+        for block in blocks[2:]:
+            assert model_offloader.cpu_buffers[block.linear1].data_ptr() == block.linear1.weight.data_ptr()
         
         # Check that synchronize_device and clean_memory_on_device were called
         mock_sync.assert_called_once_with(model_offloader.device)
@@ -375,6 +376,46 @@ def test_offloading_integration():
     assert not torch.isnan(x).any()
 
 
+@pytest.mark.parametrize("frozen", [False, True])
+def test_offloading_forward_backward_on_cpu(frozen):
+    # the swap path without CUDA, with the same schedule of forward and backward as on CUDA
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    model = SimpleModel(6)
+    reference = SimpleModel(6)
+    reference.load_state_dict(model.state_dict())
+    for m in (model, reference):
+        m.requires_grad_(not frozen)
+    weights = {k: v.clone() for k, v in model.state_dict().items()}
+
+    offloader = ModelOffloader(blocks=model.blocks, blocks_to_swap=2, device=device)
+    offloader.prepare_block_devices_before_forward(model.blocks)
+
+    for _ in range(2):  # the second step uses the CPU buffers of the first one
+        x = torch.randn(3, 10, requires_grad=True)
+        h = x
+        for i, block in enumerate(model.blocks):
+            offloader.wait_for_block(i)
+            h = block(h)
+            offloader.submit_move_blocks(model.blocks, i)
+        h.square().sum().backward()
+
+        x_ref = x.detach().clone().requires_grad_(True)
+        h_ref = reference(x_ref)
+        h_ref.square().sum().backward()
+
+        torch.testing.assert_close(h, h_ref)
+        torch.testing.assert_close(x.grad, x_ref.grad)
+        assert offloader.events == {}
+
+        # each block has its own weights after the backward
+        for k, v in model.state_dict().items():
+            assert torch.equal(v, weights[k])
+        if not frozen:
+            for p, q in zip(model.parameters(), reference.parameters()):
+                torch.testing.assert_close(p.grad, q.grad)
+
+
 # Error handling tests
 def test_offloader_assertion_error():
     with pytest.raises(AssertionError):
@@ -0,0 +1,44 @@
+import os
+
+import torch
+
+import flux_sample_worker
+import networks.lora_flux as lora_flux
+
+
+def test_tiny_worker_renders_new_checkpoints(tmp_path):
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    prompts_file = tmp_path / "prompts.txt"
+    prompts_file.write_text("a cat --w 64 --h 64 --s 2 --d 1\n")
+
+    # LoRA checkpoint for the tiny model
+    flux, ae = flux_sample_worker.create_tiny_models(torch.float32)
+    network = lora_flux.create_network(1.0, 4, 4, ae, [], flux)
+    network.apply_to([], flux, apply_text_encoder=False, apply_unet=True)
+    network.save_weights(str(output_dir / "tiny-000001.safetensors"), torch.float32, {"ss_steps": "10", "ss_epoch": "1"})
+    (output_dir / "other.safetensors").write_bytes(b"")  # not a checkpoint of this training
+
+    parser = flux_sample_worker.setup_parser()
+    args = parser.parse_args(
+        [
+            "--output_dir", str(output_dir),
+            "--output_name", "tiny",
+            "--sample_prompts", str(prompts_file),
+            "--cpu",
+            "--tiny_random_model",
+            "--poll_interval", "0",
+            "--nice", "0",
+            "--once",
+        ]
+    )
+    flux_sample_worker.main(args)
+
+    images = [f for f in os.listdir(output_dir / "sample") if f.endswith(".png")]
+    assert len(images) == 1
+    assert images[0].startswith("tiny_e000001_00_")
+    assert os.path.exists(output_dir / "sample" / flux_sample_worker.WORKER_STATE_FILE)
+
+    # already rendered checkpoints are skipped by a restarted worker
+    flux_sample_worker.main(args)
+    assert len([f for f in os.listdir(output_dir / "sample") if f.endswith(".png")]) == 1
@@ -0,0 +1,83 @@
+# benchmark of BucketManager.select_bucket (per image) and BucketManager.select_buckets (vectorized)
+# on a synthetic image size distribution
+
+import argparse
+import time
+
+import numpy as np
+
+from library import model_util
+from library.train_util import BucketManager
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_image_sizes(num_images: int, seed: int):
+    # mix of common camera / screen sizes and random sizes, roughly like a scraped dataset
+    rng = np.random.default_rng(seed)
+    common = np.array(
+        [(512, 512), (768, 768), (1024, 1024), (1920, 1080), (1080, 1920), (4032, 3024), (3024, 4032), (1200, 800), (800, 1200)]
+    )
+    num_common = num_images // 2
+    picked = common[rng.integers(0, len(common), num_common)]
+
+    num_random = num_images - num_common
+    area = np.exp(rng.normal(np.log(1024 * 1024), 0.8, num_random))
+    aspect = np.exp(rng.normal(0.0, 0.4, num_random))
+    widths = np.clip(np.sqrt(area * aspect), 64, 8192).astype(np.int64)
+    heights = np.clip(np.sqrt(area / aspect), 64, 8192).astype(np.int64)
+
+    sizes = np.concatenate([picked, np.stack([widths, heights], axis=1)])
+    rng.shuffle(sizes)
+    return sizes[:, 0], sizes[:, 1]
+
+
+def make_bucket_manager(no_upscale: bool, resolution: int) -> BucketManager:
+    bucket_manager = BucketManager(no_upscale, (resolution, resolution), 256, 2048, 64)
+    if not no_upscale:
+        bucket_manager.set_predefined_resos(model_util.make_bucket_resolutions((resolution, resolution), 256, 2048, 64))
+    return bucket_manager
+
+
+def main(args):
+    widths, heights = make_image_sizes(args.num_images, args.seed)
+    logger.info(f"{len(widths)} images, {len(set(zip(widths.tolist(), heights.tolist())))} distinct sizes")
+
+    for no_upscale in [False, True]:
+        bucket_manager = make_bucket_manager(no_upscale, args.resolution)
+        start = time.perf_counter()
+        expected = [bucket_manager.select_bucket(w, h) for w, h in zip(widths.tolist(), heights.tolist())]
+        elapsed_loop = time.perf_counter() - start
+
+        bucket_manager_vec = make_bucket_manager(no_upscale, args.resolution)
+        start = time.perf_counter()
+        resos, resized_sizes, ar_errors = bucket_manager_vec.select_buckets(widths, heights)
+        elapsed_vec = time.perf_counter() - start
+
+        assert resos == [e[0] for e in expected], "bucket resolutions differ"
+        assert resized_sizes == [e[1] for e in expected], "resized sizes differ"
+        assert np.array_equal(ar_errors, np.array([e[2] for e in expected])), "aspect ratio errors differ"
+        assert bucket_manager.resos == bucket_manager_vec.resos, "bucket order differs"
+
+        logger.info(
+            f"no_upscale={no_upscale}: select_bucket {elapsed_loop:.3f}s, select_buckets {elapsed_vec:.3f}s"
+            f" ({elapsed_loop / max(elapsed_vec, 1e-9):.1f}x), {len(bucket_manager_vec.resos)} buckets"
+        )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_images", type=int, default=1_000_000, help="number of synthetic images")
+    parser.add_argument("--resolution", type=int, default=1024, help="max bucket resolution (square)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
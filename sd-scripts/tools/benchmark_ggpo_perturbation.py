@@ -0,0 +1,92 @@
+# benchmark of the GGPO perturbation of a LoRA'd Linear: no perturbation, the full-size perturbation (randn of the
+# weight shape for each forward) and the low-rank perturbation (ggpo_rank). reports the forward/backward time and, on
+# CUDA, the peak memory. the default shape is the largest projection of FLUX (3072 -> 12288)
+
+import argparse
+import time
+from typing import Optional
+
+import torch
+
+from library.custom_offloading_utils import synchronize_device
+from library.device_utils import clean_memory_on_device, get_preferred_device
+from library.utils import setup_logging
+from networks.lora_flux import LoRAModule
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def create_module(args, device: torch.device, dtype: torch.dtype, ggpo: bool, ggpo_rank: Optional[int]) -> torch.nn.Linear:
+    org_linear = torch.nn.Linear(args.in_dim, args.out_dim).to(device, dtype)
+    org_linear.requires_grad_(False)
+    kwargs = dict(ggpo_sigma=0.03, ggpo_beta=0.01, ggpo_rank=ggpo_rank) if ggpo else {}
+    module = LoRAModule("lora_unet_benchmark", org_linear, lora_dim=args.network_dim, alpha=args.network_dim, **kwargs)
+    module.to(device, dtype)
+    module.apply_to()
+    module.train()
+    if ggpo:
+        out_dim = args.out_dim
+        module.combined_weight_norms = torch.ones(out_dim, 1, device=device, dtype=dtype)
+        module.grad_norms = torch.full((out_dim, 1), 0.1, device=device, dtype=dtype)
+    return org_linear
+
+
+def measure(org_linear: torch.nn.Linear, x: torch.Tensor, num_steps: int):
+    device = x.device
+    org_linear(x).float().square().mean().backward()  # warm up
+    synchronize_device(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        org_linear(x).float().square().mean().backward()
+    synchronize_device(device)
+    elapsed = (time.perf_counter() - start) / num_steps
+    peak = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else None
+    return elapsed, peak
+
+
+def main(args):
+    device = torch.device(args.device) if args.device is not None else get_preferred_device()
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.dtype]
+    x = torch.randn(args.batch_size, args.seq_len, args.in_dim, device=device, dtype=dtype)
+
+    modes = [("no GGPO", False, None), ("full-size", True, None)] + [(f"rank {r}", True, r) for r in args.ggpo_ranks]
+    logger.info(f"Linear {args.in_dim} -> {args.out_dim}, x {tuple(x.shape)}, {dtype}, device {device}")
+    for name, ggpo, ggpo_rank in modes:
+        org_linear = create_module(args, device, dtype, ggpo, ggpo_rank)
+        elapsed, peak = measure(org_linear, x, args.num_steps)
+        if not ggpo:
+            noise = 0
+        elif ggpo_rank is None:
+            noise = args.out_dim * args.in_dim
+        else:
+            noise = (args.out_dim + args.in_dim) * ggpo_rank
+        memory = f", peak memory {peak / 1024**2:.1f} MiB" if peak is not None else ""
+        logger.info(f"  {name}: {elapsed * 1000:.2f} ms/step, noise elements per forward {noise}{memory}")
+
+        del org_linear
+        clean_memory_on_device(device)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default=None, help="device, default is the preferred device")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=["fp32", "fp16", "bf16"], help="dtype")
+    parser.add_argument("--num_steps", type=int, default=10, help="number of steps")
+    parser.add_argument("--in_dim", type=int, default=3072, help="input features of the Linear")
+    parser.add_argument("--out_dim", type=int, default=12288, help="output features of the Linear")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument("--seq_len", type=int, default=256, help="number of tokens")
+    parser.add_argument("--network_dim", type=int, default=16, help="rank of LoRA")
+    parser.add_argument("--ggpo_ranks", type=int, nargs="+", default=[1, 4, 16], help="ranks of the low-rank perturbation")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,127 @@
+# benchmark of the per-step norm overhead of a FLUX LoRA: GGPO norms (update_grad_norms / update_norms and the network
+# norms for the logs) and max norm regularization (--scale_weight_norms), per module loop vs the batched implementation
+# of LoRANetwork. the FLUX model has the real number of blocks with a small hidden size, so it runs on CPU
+
+import argparse
+import time
+
+import torch
+
+import networks.lora_flux as lora_flux
+from library import flux_models
+from library.custom_offloading_utils import synchronize_device
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def create_network(args, device: torch.device) -> lora_flux.LoRANetwork:
+    params = flux_models.FluxParams(
+        in_channels=64,
+        vec_in_dim=64,
+        context_in_dim=64,
+        hidden_size=args.hidden_size,
+        mlp_ratio=4.0,
+        num_heads=args.hidden_size // 128,
+        depth=args.depth,
+        depth_single_blocks=args.depth_single_blocks,
+        axes_dim=[16, 56, 56],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    flux = flux_models.Flux(params)
+    network = lora_flux.create_network(1.0, args.network_dim, args.network_dim, None, [], flux, ggpo_sigma="0.03", ggpo_beta="0.01")
+    network.apply_to([], flux, apply_text_encoder=False, apply_unet=True)
+    network.to(device)
+    network.train()
+    for p in network.parameters():
+        torch.nn.init.normal_(p, std=0.01)
+        p.grad = torch.randn_like(p) * 0.01
+    return network
+
+
+def legacy_ggpo_norms(network: lora_flux.LoRANetwork):
+    # per module loop, as before the batched implementation
+    loras = network.text_encoder_loras + network.unet_loras
+    for lora in loras:
+        lora.update_grad_norms()
+        lora.update_norms()
+    weight_norms = torch.stack([lora.weight_norms.mean(dim=0) for lora in loras])
+    grad_norms = torch.stack([lora.grad_norms.mean(dim=0) for lora in loras])
+    combined_weight_norms = torch.stack([lora.combined_weight_norms.mean(dim=0) for lora in loras])
+    return weight_norms.mean(), grad_norms.mean(), combined_weight_norms.mean(), weight_norms.max()
+
+
+def batched_ggpo_norms(network: lora_flux.LoRANetwork):
+    network.update_grad_norms()
+    network.update_norms()
+    weight_norms = network.weight_norms()
+    return weight_norms.mean(), network.grad_norms().mean(), network.combined_weight_norms().mean(), weight_norms.max()
+
+
+def legacy_max_norm_regularization(network: lora_flux.LoRANetwork, max_norm_value: float, device: torch.device):
+    # per key loop with a host sync for each module, as before the batched implementation
+    state_dict = network.state_dict()
+    keys_scaled = 0
+    norms = []
+    for down_key in [k for k in state_dict.keys() if "lora_down" in k and "weight" in k]:
+        up_key = down_key.replace("lora_down", "lora_up")
+        down = state_dict[down_key].to(device)
+        up = state_dict[up_key].to(device)
+        alpha = state_dict[down_key.replace("lora_down.weight", "alpha")].to(device)
+        updown = (up @ down) * (alpha / down.shape[0])
+        norm = updown.norm().clamp(min=max_norm_value / 2)
+        ratio = torch.clamp(norm, max=max_norm_value).cpu() / norm.cpu()
+        if ratio != 1:
+            keys_scaled += 1
+            state_dict[up_key] *= ratio**0.5
+            state_dict[down_key] *= ratio**0.5
+        norms.append((updown.norm() * ratio).item())
+    return keys_scaled, sum(norms) / len(norms), max(norms)
+
+
+def measure(fn, device: torch.device, num_steps: int) -> float:
+    fn()  # warm up
+    synchronize_device(device)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        fn()
+    synchronize_device(device)
+    return (time.perf_counter() - start) / num_steps
+
+
+def main(args):
+    device = torch.device(args.device)
+    network = create_network(args, device)
+    num_modules = len(network.unet_loras)
+    logger.info(f"{num_modules} LoRA modules, hidden size {args.hidden_size}, dim {args.network_dim}, device {device}")
+
+    legacy = measure(lambda: legacy_ggpo_norms(network), device, args.num_steps)
+    batched = measure(lambda: batched_ggpo_norms(network), device, args.num_steps)
+    logger.info(f"GGPO norms: per module {legacy * 1000:.2f} ms/step, batched {batched * 1000:.2f} ms/step ({legacy / batched:.2f}x)")
+
+    # a large max norm, so that the weights are not changed during the measurement
+    legacy = measure(lambda: legacy_max_norm_regularization(network, 1e6, device), device, args.num_steps)
+    batched = measure(lambda: network.apply_max_norm_regularization(1e6, device), device, args.num_steps)
+    logger.info(f"max norm regularization: per key {legacy * 1000:.2f} ms/step, batched {batched * 1000:.2f} ms/step ({legacy / batched:.2f}x)")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu", help="device")
+    parser.add_argument("--num_steps", type=int, default=20, help="number of steps")
+    parser.add_argument("--hidden_size", type=int, default=256, help="hidden size of FLUX, multiple of 128 (3072 for FLUX.1)")
+    parser.add_argument("--depth", type=int, default=19, help="number of double blocks")
+    parser.add_argument("--depth_single_blocks", type=int, default=38, help="number of single blocks")
+    parser.add_argument("--network_dim", type=int, default=16, help="rank of LoRA")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
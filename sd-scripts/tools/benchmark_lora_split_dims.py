@@ -0,0 +1,65 @@
+# benchmark of the split_dims LoRA forward/backward of networks.lora_flux: per split Linears (previous implementation)
+# and the fused implementation (one matmul for the down projections, one block diagonal matmul for the up projections)
+
+import argparse
+import time
+
+import torch
+
+from library.utils import setup_logging
+from networks.lora_flux import LoRAModule
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def per_split_forward(module: LoRAModule, x: torch.Tensor) -> torch.Tensor:
+    lxs = [lora_down(x) for lora_down in module.lora_down]
+    lxs = [lora_up(lx) for lora_up, lx in zip(module.lora_up, lxs)]
+    return module.org_forward(x) + torch.cat(lxs, dim=-1) * module.multiplier * module.scale
+
+
+def measure(fn, x: torch.Tensor, num_iters: int) -> float:
+    for _ in range(3):  # warm up
+        fn(x).sum().backward()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn(x).sum().backward()
+    return (time.perf_counter() - start) / num_iters
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    hidden = args.hidden_size
+    for name, split_dims in [("double blocks qkv", [hidden] * 3), ("single blocks linear1", [hidden] * 3 + [hidden * 4])]:
+        org_linear = torch.nn.Linear(hidden, sum(split_dims)).requires_grad_(False)
+        module = LoRAModule("lora_unet_bench", org_linear, lora_dim=args.rank, alpha=args.rank, split_dims=split_dims)
+        module.apply_to()
+        x = torch.randn(args.batch_size, args.seq_len, hidden, requires_grad=True)
+
+        torch.testing.assert_close(org_linear(x), per_split_forward(module, x))
+        elapsed_split = measure(lambda x: per_split_forward(module, x), x, args.num_iters)
+        elapsed_fused = measure(org_linear, x, args.num_iters)
+        logger.info(
+            f"{name} {split_dims}, rank {args.rank}: per split {elapsed_split * 1000:.2f}ms, fused {elapsed_fused * 1000:.2f}ms"
+            f" ({elapsed_split / max(elapsed_fused, 1e-9):.2f}x)"
+        )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=768, help="hidden size, 3072 for FLUX.1")
+    parser.add_argument("--rank", type=int, default=16, help="LoRA rank")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument("--seq_len", type=int, default=256, help="number of tokens")
+    parser.add_argument("--num_iters", type=int, default=20, help="number of iterations")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
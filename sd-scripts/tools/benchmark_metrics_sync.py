@@ -0,0 +1,90 @@
+# benchmark of per-step `.item()` (host sync for each metric) and train_util.DeferredMetrics (one sync every N steps)
+# on a synthetic training step. the gain is the time the host can queue the next step's kernels while the device is busy,
+# so run it on a GPU; on CPU both are almost the same
+
+import argparse
+import time
+
+import torch
+
+from library.custom_offloading_utils import synchronize_device
+from library.device_utils import get_preferred_device
+from library.train_util import DeferredMetrics
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_step(device: torch.device, dim: int, num_layers: int, num_norms: int):
+    weights = [torch.randn(dim, dim, device=device) * (1.0 / dim**0.5) for _ in range(num_layers)]
+    lora_weights = [torch.randn(16, dim, device=device) for _ in range(num_norms)]
+    x = torch.randn(dim, dim, device=device)
+
+    def step():
+        # forward-like work, followed by the metrics which are logged every step
+        h = x
+        for w in weights:
+            h = torch.tanh(h @ w)
+        loss = h.square().mean()
+        norms = torch.stack([w.norm() for w in lora_weights])
+        return loss, norms.mean(), norms.max()
+
+    return step
+
+
+def run_item(step, num_steps: int) -> float:
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        loss, mean_norm, max_norm = step()
+        loss.item(), mean_norm.item(), max_norm.item()
+    return time.perf_counter() - start
+
+
+def run_deferred(step, num_steps: int, sync_every: int) -> float:
+    metrics = DeferredMetrics(sync_every)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        loss, mean_norm, max_norm = step()
+        metrics.add(loss=loss, logs={"mean_norm": mean_norm, "max_norm": max_norm})
+        if metrics.should_flush():
+            metrics.flush()
+    metrics.flush()
+    return time.perf_counter() - start
+
+
+def main(args):
+    device = torch.device(args.device) if args.device is not None else get_preferred_device()
+    step = make_step(device, args.dim, args.num_layers, args.num_norms)
+
+    # warm up
+    run_item(step, 10)
+    synchronize_device(device)
+
+    elapsed_item = run_item(step, args.num_steps)
+    synchronize_device(device)
+    logger.info(f"device={device}, steps={args.num_steps}: .item() every step {elapsed_item:.3f}s")
+
+    for sync_every in args.sync_every:
+        elapsed = run_deferred(step, args.num_steps, sync_every)
+        synchronize_device(device)
+        logger.info(f"  sync every {sync_every} steps: {elapsed:.3f}s ({elapsed_item / max(elapsed, 1e-9):.2f}x)")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default=None, help="device, default is the preferred device")
+    parser.add_argument("--num_steps", type=int, default=500, help="number of steps")
+    parser.add_argument("--dim", type=int, default=1024, help="size of the synthetic layers")
+    parser.add_argument("--num_layers", type=int, default=8, help="number of synthetic layers per step")
+    parser.add_argument("--num_norms", type=int, default=64, help="number of LoRA modules for the norms")
+    parser.add_argument("--sync_every", type=int, nargs="+", default=[1, 10, 50], help="values of --metrics_sync_every")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
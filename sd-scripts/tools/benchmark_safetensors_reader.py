@@ -0,0 +1,110 @@
+# benchmark of the safetensors readers: the previous MemoryEfficientSafeOpen (seek, read and a copy to a bytearray for
+# each tensor), the current one (read into the tensor, with readahead, or mmap views), and safetensors.safe_open.
+# every tensor is loaded, moved to the device and summed, so lazily mapped pages are read, too.
+# the page cache makes the second read of a file faster: use --drop_caches (needs root) or a file larger than the RAM
+# to measure cold reads, otherwise the warm numbers show the copies in host memory
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import time
+
+import torch
+from safetensors import safe_open
+
+from library.utils import MemoryEfficientSafeOpen, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def iter_previous(path: str):
+    # the path before the zero copy reader: bytes from read() are copied again to a writable bytearray
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        for key, metadata in header.items():
+            if key == "__metadata__":
+                continue
+            offset_start, offset_end = metadata["data_offsets"]
+            dtype = MemoryEfficientSafeOpen._get_torch_dtype(metadata["dtype"])
+            if offset_start == offset_end:
+                yield key, torch.empty(metadata["shape"], dtype=dtype)
+                continue
+            f.seek(header_size + 8 + offset_start)
+            tensor_bytes = bytearray(f.read(offset_end - offset_start))
+            yield key, torch.frombuffer(tensor_bytes, dtype=torch.uint8).view(dtype).reshape(metadata["shape"])
+
+
+def iter_reader(path: str, use_mmap: bool, readahead: int, device: str):
+    with MemoryEfficientSafeOpen(path, use_mmap) as f:
+        yield from f.iter_tensors(device=device, readahead=readahead)
+
+
+def iter_safe_open(path: str, device: str):
+    with safe_open(path, framework="pt", device=device) as f:
+        for key in f.keys():
+            yield key, f.get_tensor(key)
+
+
+def drop_caches():
+    subprocess.run(["sync"], check=False)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def measure(name: str, iterator, device: str, file_size: int):
+    start = time.perf_counter()
+    checksum = 0.0
+    for _, tensor in iterator:
+        checksum += float(tensor.to(device).to(torch.float32).sum())  # touch every element
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    logger.info(f"{name:<32} {elapsed:7.2f}s {file_size / elapsed / 1024**3:6.2f} GB/s  checksum {checksum:.4e}")
+    return elapsed
+
+
+def main(args):
+    file_size = os.path.getsize(args.file)
+    logger.info(f"{args.file}: {file_size / 1024**3:.2f} GB, device {args.device}")
+
+    readers = {
+        "previous (read + bytearray)": lambda: iter_previous(args.file),
+        "read into tensor": lambda: iter_reader(args.file, False, 0, args.device),
+        f"read into tensor, readahead {args.readahead}": lambda: iter_reader(args.file, False, args.readahead, args.device),
+        f"mmap views, readahead {args.readahead}": lambda: iter_reader(args.file, True, args.readahead, args.device),
+        "safetensors.safe_open": lambda: iter_safe_open(args.file, "cpu"),
+    }
+    if args.device.startswith("cuda"):
+        readers["safetensors.safe_open (device)"] = lambda: iter_safe_open(args.file, args.device)
+
+    for name, create in readers.items():
+        for _ in range(args.repeat):
+            if args.drop_caches:
+                drop_caches()
+            measure(name, create(), args.device, file_size)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", type=str, help="safetensors file / safetensorsファイル")
+    parser.add_argument("--device", type=str, default="cpu", help="device to load to / 読み込み先のデバイス")
+    parser.add_argument("--readahead", type=int, default=4, help="tensors read ahead / 先読みするテンソル数")
+    parser.add_argument("--repeat", type=int, default=2, help="runs for each reader / 各リーダーの実行回数")
+    parser.add_argument(
+        "--drop_caches",
+        action="store_true",
+        help="drop the page cache before each run, needs root / 各実行の前にページキャッシュを破棄する（root権限が必要）",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+# estimate of the FLUX compute saved by --t5_trim_multiple: the captions of a dataset are tokenized with the T5-XXL
+# tokenizer, random batches are drawn, and the FLOPs of the FLUX blocks are computed for the padded length
+# (--t5xxl_max_token_length) and for the trimmed length of each batch. the FLOPs are analytic (linear layers and
+# attention of the double and single blocks), so no model or GPU is needed
+
+import argparse
+import glob
+import math
+import os
+import random
+from typing import List
+
+from library import strategy_flux
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_captions(path: str, caption_extension: str) -> List[str]:
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    captions = []
+    for file in sorted(glob.glob(os.path.join(path, "**", "*" + caption_extension), recursive=True)):
+        with open(file, "r", encoding="utf-8") as f:
+            captions.append(f.read().strip())
+    return captions
+
+
+def get_token_lengths(captions: List[str], max_length: int, tokenizer_cache_dir: str) -> List[int]:
+    tokenize_strategy = strategy_flux.FluxTokenizeStrategy(max_length, tokenizer_cache_dir)
+    lengths = []
+    for caption in captions:
+        _, _, t5_attn_mask = tokenize_strategy.tokenize(caption)
+        lengths.append(int(t5_attn_mask.sum()))
+    return lengths
+
+
+def block_flops(num_tokens: int, hidden_size: int, num_blocks: int) -> float:
+    # linear layers: qkv, proj and mlp (double) or linear1 and linear2 (single), both are 24 * hidden^2 per token.
+    # attention: q @ k and attn @ v, 4 * tokens^2 * hidden
+    return num_blocks * (24 * hidden_size**2 * num_tokens + 4 * num_tokens**2 * hidden_size)
+
+
+def main(args):
+    if args.token_lengths is not None:
+        lengths = args.token_lengths
+    else:
+        captions = load_captions(args.captions, args.caption_extension)
+        if len(captions) == 0:
+            logger.error(f"no captions found in {args.captions}")
+            return
+        lengths = get_token_lengths(captions, args.t5xxl_max_token_length, args.tokenizer_cache_dir)
+    lengths = [min(length, args.t5xxl_max_token_length) for length in lengths]
+    logger.info(f"{len(lengths)} captions, T5 tokens: mean {sum(lengths) / len(lengths):.1f}, max {max(lengths)}")
+
+    img_tokens = (args.height // 16) * (args.width // 16)
+    num_blocks = args.depth + args.depth_single_blocks
+    rng = random.Random(args.seed)
+    padded_flops = trimmed_flops = 0.0
+    trimmed_lengths = []
+    for _ in range(args.num_batches):
+        batch = [rng.choice(lengths) for _ in range(args.batch_size)]
+        length = min(max(1, math.ceil(max(batch) / args.t5_trim_multiple)) * args.t5_trim_multiple, args.t5xxl_max_token_length)
+        trimmed_lengths.append(length)
+        padded_flops += args.batch_size * block_flops(img_tokens + args.t5xxl_max_token_length, args.hidden_size, num_blocks)
+        trimmed_flops += args.batch_size * block_flops(img_tokens + length, args.hidden_size, num_blocks)
+
+    logger.info(
+        f"{args.width}x{args.height} ({img_tokens} image tokens), batch size {args.batch_size}, multiple {args.t5_trim_multiple}:"
+        f" mean trimmed length {sum(trimmed_lengths) / len(trimmed_lengths):.1f} / {args.t5xxl_max_token_length}"
+    )
+    logger.info(
+        f"FLUX blocks forward: padded {padded_flops / args.num_batches / 1e12:.2f} TFLOPs/step,"
+        f" trimmed {trimmed_flops / args.num_batches / 1e12:.2f} TFLOPs/step ({padded_flops / trimmed_flops:.2f}x)"
+    )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--captions", type=str, default=None, help="directory of caption files, or a text file with a caption per line")
+    parser.add_argument("--caption_extension", type=str, default=".txt", help="extension of caption files")
+    parser.add_argument("--token_lengths", type=int, nargs="+", default=None, help="T5 token lengths instead of --captions")
+    parser.add_argument("--tokenizer_cache_dir", type=str, default=None, help="cache directory of the tokenizer")
+    parser.add_argument("--t5xxl_max_token_length", type=int, default=512, help="padded length of T5-XXL")
+    parser.add_argument("--t5_trim_multiple", type=int, default=64, help="the trimmed length is rounded up to this multiple")
+    parser.add_argument("--batch_size", type=int, default=4, help="batch size")
+    parser.add_argument("--num_batches", type=int, default=1000, help="number of random batches")
+    parser.add_argument("--width", type=int, default=1024, help="image width")
+    parser.add_argument("--height", type=int, default=1024, help="image height")
+    parser.add_argument("--hidden_size", type=int, default=3072, help="hidden size of FLUX")
+    parser.add_argument("--depth", type=int, default=19, help="number of double blocks")
+    parser.add_argument("--depth_single_blocks", type=int, default=38, help="number of single blocks")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    if args.captions is None and args.token_lengths is None:
+        parser.error("--captions or --token_lengths is required")
+    main(args)
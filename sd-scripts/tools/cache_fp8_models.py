@@ -0,0 +1,40 @@
+# converts FLUX and T5-XXL models to fp8 (float8_e4m3fn) copies in a cache directory, the same as the first run of
+# flux_train_network.py with --fp8_base --fp8_cache_dir (and --fp8_cache_t5xxl for T5-XXL). run this once before training
+# to keep the conversion out of the training launch
+
+import argparse
+
+from library import flux_utils, fp8_model_cache
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    if args.flux is not None:
+        is_diffusers, _, _, ckpt_paths = flux_utils.analyze_checkpoint_state(args.flux)
+        if is_diffusers:
+            logger.error("fp8 cache is not supported for Diffusers FLUX model / DiffusersのFLUXモデルはfp8キャッシュに対応していません")
+        else:
+            path = fp8_model_cache.get_fp8_model_path(args.cache_dir, args.flux, ckpt_paths)
+            logger.info(f"FLUX: {path}")
+    if args.t5xxl is not None:
+        path = fp8_model_cache.get_fp8_model_path(args.cache_dir, args.t5xxl)
+        logger.info(f"T5-XXL: {path}")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir", type=str, required=True, help="cache directory, same as --fp8_cache_dir / キャッシュディレクトリ")
+    parser.add_argument("--flux", type=str, default=None, help="FLUX model file / FLUXモデルのファイル")
+    parser.add_argument("--t5xxl", type=str, default=None, help="T5-XXL model file, used with --fp8_cache_t5xxl / T5-XXLモデルのファイル（--fp8_cache_t5xxl用）")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
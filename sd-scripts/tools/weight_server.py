@@ -0,0 +1,73 @@
+# keeps shared memory copies of base model files for the training runs on this machine. run it in the background and
+# train with --use_weight_server: the first run requests the models and reads them from the files, the following runs
+# (resumes, retries) map the copies from /dev/shm instead of reading them again.
+# the directory is SD_SCRIPTS_WEIGHT_SHM_DIR (/dev/shm/sd-scripts-weights by default), the same for the server and the
+# training processes. the copies are kept after the server stops and are used again when it is restarted
+
+import argparse
+import os
+
+from library import weight_server
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    if args.shm_dir is not None:
+        os.environ["SD_SCRIPTS_WEIGHT_SHM_DIR"] = args.shm_dir
+    server = weight_server.WeightServer(
+        weight_server.get_shm_dir(),
+        None if args.capacity is None else int(args.capacity * 1024**3),
+        int(args.reserve * 1024**3),
+    )
+    if args.clear:
+        server.start()
+        for name in list(server.last_used):
+            server.remove(name)
+        server.stop()
+        return
+
+    server.start()
+    try:
+        for path in args.models:
+            server.add(path)
+        server.serve(args.interval)
+    except KeyboardInterrupt:
+        logger.info("weight server stopped / ウェイトサーバーを停止しました")
+    finally:
+        server.stop()
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", type=str, nargs="*", help="model files to copy at start / 開始時にコピーするモデルファイル")
+    parser.add_argument(
+        "--shm_dir",
+        type=str,
+        default=None,
+        help="shared memory directory, default is SD_SCRIPTS_WEIGHT_SHM_DIR or /dev/shm/sd-scripts-weights"
+        " / 共有メモリのディレクトリ。デフォルトはSD_SCRIPTS_WEIGHT_SHM_DIRまたは/dev/shm/sd-scripts-weights",
+    )
+    parser.add_argument(
+        "--capacity", type=float, default=None, help="maximum size of the copies in GB / コピーの最大サイズ（GB）"
+    )
+    parser.add_argument(
+        "--reserve",
+        type=float,
+        default=16.0,
+        help="available host memory in GB kept for the training, least recently used copies are removed below it"
+        " / 学習用に確保する空きメモリ（GB）。これを下回ると最も長く使われていないコピーから削除する",
+    )
+    parser.add_argument("--interval", type=float, default=1.0, help="polling interval in seconds / 確認間隔（秒）")
+    parser.add_argument("--clear", action="store_true", help="remove all copies and exit / すべてのコピーを削除して終了する")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
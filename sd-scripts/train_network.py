@@ -24,7 +24,8 @@ from accelerate.utils import set_seed
 from accelerate import Accelerator
 from diffusers import DDPMScheduler
 from diffusers.models.autoencoders.autoencoder_kl import AutoencoderKL
-from library import deepspeed_utils, model_util, strategy_base, strategy_sd
+from library import async_checkpoint, cache_io, deepspeed_utils, flat_params, hash_index, model_util, step_profiler, strategy_base, strategy_sd
+from library.custom_offloading_utils import synchronize_device
 
 import library.train_util as train_util
 from library.train_util import DreamBoothDataset
@@ -616,19 +617,26 @@ class NetworkTrainer:
 
         # 学習を準備する
         if cache_latents:
-            vae.to(accelerator.device, dtype=vae_dtype)
-            vae.requires_grad_(False)
-            vae.eval()
+            if vae is not None:  # None if all latents are cached to disk and vae is not loaded
+                vae.to(accelerator.device, dtype=vae_dtype)
+                vae.requires_grad_(False)
+                vae.eval()
 
             train_dataset_group.new_cache_latents(vae, accelerator)
             if val_dataset_group is not None:
                 val_dataset_group.new_cache_latents(vae, accelerator)
 
-            vae.to("cpu")
+            if vae is not None:
+                vae.to("cpu")
             clean_memory_on_device(accelerator.device)
 
             accelerator.wait_for_everyone()
 
+            if args.shared_memory_latents:
+                train_dataset_group.share_latents()
+                if val_dataset_group is not None:
+                    val_dataset_group.share_latents()
+
         # 必要ならテキストエンコーダーの出力をキャッシュする: Text Encoderはcpuまたはgpuへ移される
         # cache text encoder outputs if needed: Text Encoder is moved to cpu or gpu
         text_encoding_strategy = self.get_text_encoding_strategy(args)
@@ -745,6 +753,19 @@ class NetworkTrainer:
         #             v = len(v)
         #         accelerator.print(f"trainable_params: {k} = {v}")
 
+        flat_buffers = None
+        if args.flat_network_params:
+            assert not args.deepspeed, "flat_network_params is not supported with DeepSpeed / flat_network_paramsはDeepSpeedと併用できません"
+            if "adafactor" in args.optimizer_type.lower():
+                logger.warning(
+                    "Adafactor sees the flat buffers as 1-D parameters, its second moment is not factored"
+                    " / Adafactorはフラットバッファを1次元のパラメータとして扱うため、二次モーメントが分解されません"
+                )
+            # the buffers are allocated on the final device and dtype, because `.to()` copies the parameters out of them
+            network.to(accelerator.device, dtype=weight_dtype if args.full_fp16 or args.full_bf16 else None)
+            trainable_params, flat_buffers = flat_params.flatten_param_groups(trainable_params)
+            network.flat_buffers = flat_buffers  # used by save_weights to copy the weights to CPU at once
+
         optimizer_name, optimizer_args, optimizer = train_util.get_optimizer(args, trainable_params)
         optimizer_train_fn, optimizer_eval_fn = train_util.get_optimizer_train_eval_fn(optimizer, args)
 
@@ -755,13 +776,24 @@ class NetworkTrainer:
         if val_dataset_group is not None:
             val_dataset_group.set_current_strategies()
 
+        # cache files are read through an I/O thread pool with a deadline. workers inherit this configuration when forked
+        cache_io.configure(
+            max_workers=args.cache_read_threads,
+            timeout=args.cache_read_timeout,
+            retries=args.cache_read_retries,
+            log_every=args.cache_read_log_every,
+        )
+
         # DataLoaderのプロセス数：0 は persistent_workers が使えないので注意
         n_workers = min(args.max_data_loader_n_workers, os.cpu_count())  # cpu_count or max_data_loader_n_workers
 
+        # the order is determined by (seed, epoch), so resuming can seek to any step without loading the skipped batches
+        train_sampler = train_util.SeekableRandomSampler(train_dataset_group, args.seed)
+        train_dataset_group.set_readahead(train_sampler, current_epoch, args.cache_read_ahead, accelerator.num_processes)
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset_group,
             batch_size=1,
-            shuffle=True,
+            sampler=train_sampler,
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
@@ -830,6 +862,8 @@ class NetworkTrainer:
         unet.requires_grad_(False)
         unet.to(dtype=unet_weight_dtype)
         for i, t_enc in enumerate(text_encoders):
+            if t_enc is None:  # not loaded because the outputs are cached
+                continue
             t_enc.requires_grad_(False)
 
             # in case of cpu, dtype is already set to fp32 because cpu does not support fp8/fp16/bf16
@@ -876,11 +910,17 @@ class NetworkTrainer:
                 network, optimizer, train_dataloader, val_dataloader, lr_scheduler
             )
             training_model = network
+            if flat_buffers is not None and not all(buffer.is_intact() for buffer in flat_buffers):
+                raise RuntimeError(
+                    "network parameters were moved out of the flat buffers while preparing / 準備中にネットワークのパラメータがフラットバッファの外に移動されました"
+                )
 
         if args.gradient_checkpointing:
             # according to TI example in Diffusers, train is required
             unet.train()
             for i, (t_enc, frag) in enumerate(zip(text_encoders, self.get_text_encoders_train_flags(args, text_encoders))):
+                if t_enc is None:
+                    continue
                 t_enc.train()
 
                 # set top parameter requires_grad = True for gradient checkpointing works
@@ -890,7 +930,8 @@ class NetworkTrainer:
         else:
             unet.eval()
             for t_enc in text_encoders:
-                t_enc.eval()
+                if t_enc is not None:
+                    t_enc.eval()
 
         del t_enc
 
@@ -924,10 +965,18 @@ class NetworkTrainer:
             # +1 is needed because the state is saved before current_step is set from global_step
             logger.info(f"save train state to {train_state_file} at epoch {current_epoch.value} step {current_step.value+1}")
             with open(train_state_file, "w", encoding="utf-8") as f:
-                json.dump({"current_epoch": current_epoch.value, "current_step": current_step.value + 1}, f)
+                json.dump(
+                    {
+                        "current_epoch": current_epoch.value,
+                        "current_step": current_step.value + 1,
+                        "sampler": train_sampler.state_dict(),
+                    },
+                    f,
+                )
 
         steps_from_state = None
         epoch_from_state = None
+        sampler_restored = False
 
         def load_model_hook(models, input_dir):
             # remove models except network
@@ -940,7 +989,7 @@ class NetworkTrainer:
             # print(f"load model hook: {len(models)} models will be loaded")
 
             # load current epoch and step to
-            nonlocal steps_from_state, epoch_from_state
+            nonlocal steps_from_state, epoch_from_state, sampler_restored
             train_state_file = os.path.join(input_dir, "train_state.json")
             if os.path.exists(train_state_file):
                 with open(train_state_file, "r", encoding="utf-8") as f:
@@ -954,6 +1003,9 @@ class NetworkTrainer:
                     current_epoch.value = epoch_from_state
                     logger.info(f"Restored current_epoch to {epoch_from_state} from checkpoint")
 
+                if "sampler" in data:
+                    sampler_restored = train_sampler.load_state_dict(data["sampler"])
+
         accelerator.register_save_state_pre_hook(save_model_hook)
         accelerator.register_load_state_pre_hook(load_model_hook)
 
@@ -1241,7 +1293,15 @@ class NetworkTrainer:
             ), f"max_train_steps should be greater than initial step / max_train_stepsは初期ステップより大きい必要があります: {args.max_train_steps} vs {initial_step}"
 
         epoch_to_start = 0
+        initial_global_step = 0  # optimizer steps done before this run, initial_step becomes the batches to skip
         if initial_step > 0:
+            if sampler_restored and not args.skip_until_initial_step:
+                # seeking the sampler is free, so resume at the exact step when the data order can be restored
+                logger.info(
+                    "data order is restored from the state, resuming at the saved step / stateからデータの順序を復元したため、保存されたステップから再開します"
+                )
+                args.skip_until_initial_step = True
+
             if args.skip_until_initial_step:
                 # if skip_until_initial_step is specified, load data and discard it to ensure the same data is used
                 if not args.resume:
@@ -1249,10 +1309,11 @@ class NetworkTrainer:
                         f"initial_step is specified but not resuming. lr scheduler will be started from the beginning / initial_stepが指定されていますがresumeしていないため、lr schedulerは最初から始まります"
                     )
                 logger.info(f"skipping {initial_step} steps / {initial_step}ステップをスキップします")
+                initial_global_step = initial_step
                 initial_step *= args.gradient_accumulation_steps
 
-                # set epoch to start to make initial_step less than len(train_dataloader)
-                epoch_to_start = initial_step // math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+                # set epoch to start to make initial_step less than len(train_dataloader), both are in batches
+                epoch_to_start = initial_step // len(train_dataloader)
             else:
                 # if not, only epoch no is skipped for informative purpose
                 epoch_to_start = initial_step // math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -1265,6 +1326,7 @@ class NetworkTrainer:
         train_util.init_trackers(accelerator, args, "network_train")
 
         loss_recorder = train_util.LossRecorder()
+        step_metrics = train_util.DeferredMetrics(args.metrics_sync_every)
         val_step_loss_recorder = train_util.LossRecorder()
         val_epoch_loss_recorder = train_util.LossRecorder()
 
@@ -1272,12 +1334,47 @@ class NetworkTrainer:
         if val_dataset_group is not None:
             del val_dataset_group
 
+        # per-step phase profiler, opt-in
+        if args.profile_steps:
+            profile_dir = os.path.join(args.output_dir, "profile")
+            profile_name = (args.output_name or "last") + (f"_{accelerator.process_index}" if accelerator.num_processes > 1 else "")
+            profiler = step_profiler.StepProfiler(
+                os.path.join(profile_dir, f"{profile_name}_trace.json"),
+                os.path.join(profile_dir, f"{profile_name}_summary.jsonl"),
+                args.profile_summary_every,
+                synchronize=(lambda: synchronize_device(accelerator.device)) if args.profile_sync else None,
+            )
+            logger.info(f"profiling steps to {profile_dir} / ステップのプロファイルを出力します: {profile_dir}")
+        else:
+            profiler = step_profiler.StepProfiler.disabled()
+        step_profiler.set_profiler(profiler)
+
+        # background writer for checkpoints and states, opt-in
+        checkpoint_writer = None
+        if args.async_save and is_main_process:
+            checkpoint_writer = async_checkpoint.AsyncCheckpointWriter(args.async_save_max_pending, args.async_save_staging_dir)
+
         # callback for step start
         if hasattr(accelerator.unwrap_model(network), "on_step_start"):
             on_step_start_for_network = accelerator.unwrap_model(network).on_step_start
         else:
             on_step_start_for_network = lambda *args, **kwargs: None
 
+        def flush_step_metrics():
+            r"""
+            convert the pending step metrics to floats, then update the loss recorder, the progress bar and the trackers
+            """
+            with profiler.span("metrics_sync"):
+                entries = step_metrics.flush()
+            for entry in entries:
+                loss_recorder.add(epoch=entry["epoch"], step=entry["step"], loss=entry["loss"])
+                avr_loss: float = loss_recorder.moving_average
+                if entry["logs"] is not None:
+                    entry["logs"]["loss/average"] = avr_loss
+                    self.step_logging(accelerator, entry["logs"], entry["global_step"], entry["epoch"] + 1)
+            if entries:
+                progress_bar.set_postfix(**{**entries[-1]["max_mean_logs"], "avr_loss": avr_loss})
+
         # function for saving/removing
         def save_model(ckpt_name, unwrapped_nw, steps, epoch_no, force_sync_upload=False):
             os.makedirs(args.output_dir, exist_ok=True)
@@ -1292,15 +1389,29 @@ class NetworkTrainer:
             sai_metadata = self.get_sai_model_spec(args)
             metadata_to_save.update(sai_metadata)
 
-            unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
-            if args.huggingface_repo_id is not None:
-                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+            def upload():
+                hash_index.update_in_background(ckpt_file)  # for the tools which hash the saved model later
+                if args.huggingface_repo_id is not None:
+                    huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+
+            if checkpoint_writer is not None:
+                checkpoint_writer.save_weights(ckpt_file, unwrapped_nw.state_dict(), save_dtype, metadata_to_save, upload)
+            else:
+                unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
+                upload()
 
         def remove_model(old_ckpt_name):
             old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
-            if os.path.exists(old_ckpt_file):
-                accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
-                os.remove(old_ckpt_file)
+
+            def remove():
+                if os.path.exists(old_ckpt_file):
+                    accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
+                    os.remove(old_ckpt_file)
+
+            if checkpoint_writer is not None:
+                checkpoint_writer.submit(old_ckpt_file, remove)  # after the pending saves
+            else:
+                remove()
 
         # if text_encoder is not needed for training, delete it to save memory.
         # TODO this can be automated after SDXL sample prompt cache is implemented
@@ -1325,11 +1436,13 @@ class NetworkTrainer:
             for skip_epoch in range(epoch_to_start):  # skip epochs
                 logger.info(f"skipping epoch {skip_epoch+1} because initial_step (multiplied) is {initial_step}")
                 initial_step -= len(train_dataloader)
-            global_step = initial_step
+            global_step = initial_global_step
 
         # log device and dtype for each model
         logger.info(f"unet dtype: {unet_weight_dtype}, device: {unet.device}")
         for i, t_enc in enumerate(text_encoders):
+            if t_enc is None:
+                continue
             params_itr = t_enc.parameters()
             params_itr.__next__()  # skip the first parameter
             params_itr.__next__()  # skip the second parameter. because CLIP first two parameters are embeddings
@@ -1339,7 +1452,7 @@ class NetworkTrainer:
         clean_memory_on_device(accelerator.device)
 
         progress_bar = tqdm(
-            range(args.max_train_steps - initial_step), smoothing=0, disable=not accelerator.is_local_main_process, desc="steps"
+            range(args.max_train_steps - global_step), smoothing=0, disable=not accelerator.is_local_main_process, desc="steps"
         )
 
         validation_steps = (
@@ -1391,23 +1504,29 @@ class NetworkTrainer:
             accelerator.unwrap_model(network).on_epoch_start(text_encoder, unet)  # network.train() is called here
 
             # TRAINING
-            skipped_dataloader = None
-            if initial_step > 0:
-                skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
-                initial_step = 1
+            # seek the sampler instead of loading and discarding the skipped batches. each process takes every
+            # num_processes-th index, so the position in the sampler is multiplied by num_processes
+            train_sampler.seek(epoch, initial_step * accelerator.num_processes)
+            # enumerate starts at 0 after the seek, the per-epoch state is indexed by the position in the epoch
+            skipped_steps = initial_step
+            initial_step = 0
 
-            for step, batch in enumerate(skipped_dataloader or train_dataloader):
+            profiler.begin_epoch()
+
+            for step, batch in enumerate(train_dataloader):
                 current_step.value = global_step
-                if initial_step > 0:
-                    initial_step -= 1
-                    continue
+                profiler.begin_step(len(batch["loss_weights"]))
+                if batch.get("latents") is not None:
+                    profiler.set_step_attrs(bucket="x".join(str(x) for x in batch["latents"].shape[-2:]))
 
                 with accelerator.accumulate(training_model):
                     on_step_start_for_network(text_encoder, unet)
 
                     # preprocess batch for each model
-                    self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=True)
+                    with profiler.span("on_step_start"):
+                        self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=True)
 
+                    profiler.begin("forward")
                     loss = self.process_batch(
                         batch,
                         text_encoders,
@@ -1425,23 +1544,32 @@ class NetworkTrainer:
                         train_text_encoder=train_text_encoder,
                         train_unet=train_unet,
                     )
+                    profiler.end("forward")
 
-                    accelerator.backward(loss)
+                    with profiler.span("backward"):
+                        accelerator.backward(loss)
                     if accelerator.sync_gradients:
+                        profiler.begin("clip_norms")
                         self.all_reduce_network(accelerator, network)  # sync DDP grad manually
                         if args.max_grad_norm != 0.0:
-                            params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
+                            if flat_buffers is not None:
+                                params_to_clip = [buffer.flat_param for buffer in flat_buffers]
+                            else:
+                                params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
                             accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
 
                         if hasattr(network, "update_grad_norms"):
                             network.update_grad_norms()
                         if hasattr(network, "update_norms"):
                             network.update_norms()
+                        profiler.end("clip_norms")
 
-                    optimizer.step()
-                    lr_scheduler.step()
-                    optimizer.zero_grad(set_to_none=True)
+                    with profiler.span("optimizer"):
+                        optimizer.step()
+                        lr_scheduler.step()
+                        optimizer.zero_grad(set_to_none=flat_buffers is None)  # keep the gradients in the flat buffers
 
+                profiler.begin("norm_logs")
                 if args.scale_weight_norms:
                     keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
                         args.scale_weight_norms, accelerator.device
@@ -1451,13 +1579,14 @@ class NetworkTrainer:
                     max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
                 else:
                     if hasattr(network, "weight_norms"):
+                        # kept on the device, converted to floats by step_metrics
                         weight_norms = network.weight_norms()
-                        mean_norm = weight_norms.mean().item() if weight_norms is not None else None
+                        mean_norm = weight_norms.mean() if weight_norms is not None else None
                         grad_norms = network.grad_norms()
-                        mean_grad_norm = grad_norms.mean().item() if grad_norms is not None else None
+                        mean_grad_norm = grad_norms.mean() if grad_norms is not None else None
                         combined_weight_norms = network.combined_weight_norms()
-                        mean_combined_norm = combined_weight_norms.mean().item() if combined_weight_norms is not None else None
-                        maximum_norm = weight_norms.max().item() if weight_norms is not None else None
+                        mean_combined_norm = combined_weight_norms.mean() if combined_weight_norms is not None else None
+                        maximum_norm = weight_norms.max() if weight_norms is not None else None
                         keys_scaled = None
                         max_mean_logs = {}
                     else:
@@ -1465,6 +1594,7 @@ class NetworkTrainer:
                         mean_grad_norm = None
                         mean_combined_norm = None
                         max_mean_logs = {}
+                profiler.end("norm_logs")
 
                 # Checks if the accelerator has performed an optimization step behind the scenes
                 if accelerator.sync_gradients:
@@ -1472,38 +1602,39 @@ class NetworkTrainer:
                     global_step += 1
 
                     optimizer_eval_fn()
-                    self.sample_images(
-                        accelerator, args, None, global_step, accelerator.device, vae, tokenizers, text_encoder, unet
-                    )
+                    with profiler.span("sample"):
+                        self.sample_images(
+                            accelerator, args, None, global_step, accelerator.device, vae, tokenizers, text_encoder, unet
+                        )
                     progress_bar.unpause()
 
                     # 指定ステップごとにモデルを保存
                     if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
+                        profiler.begin("save")
                         accelerator.wait_for_everyone()
                         if accelerator.is_main_process:
                             ckpt_name = train_util.get_step_ckpt_name(args, "." + args.save_model_as, global_step)
                             save_model(ckpt_name, accelerator.unwrap_model(network), global_step, epoch)
 
                             if args.save_state:
-                                train_util.save_and_remove_state_stepwise(args, accelerator, global_step)
+                                train_util.save_and_remove_state_stepwise(args, accelerator, global_step, checkpoint_writer)
 
                             remove_step_no = train_util.get_remove_step_no(args, global_step)
                             if remove_step_no is not None:
                                 remove_ckpt_name = train_util.get_step_ckpt_name(args, "." + args.save_model_as, remove_step_no)
                                 remove_model(remove_ckpt_name)
+                        profiler.end("save")
                     optimizer_train_fn()
 
-                current_loss = loss.detach().item()
-                loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
-                avr_loss: float = loss_recorder.moving_average
-                logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**{**max_mean_logs, **logs})
-
+                # loss and norms are device tensors here. the step logs are generated now for the current lr, and the values are
+                # converted to floats and logged when step_metrics is flushed
+                current_loss = loss.detach()
+                logs = None
                 if is_tracking:
                     logs = self.generate_step_logs(
                         args,
                         current_loss,
-                        avr_loss,
+                        None,
                         lr_scheduler,
                         lr_descriptions,
                         optimizer,
@@ -1513,12 +1644,24 @@ class NetworkTrainer:
                         mean_grad_norm,
                         mean_combined_norm,
                     )
-                    self.step_logging(accelerator, logs, global_step, epoch + 1)
+                step_metrics.add(
+                    loss=current_loss,
+                    epoch=epoch,
+                    step=step + skipped_steps,
+                    global_step=global_step,
+                    max_mean_logs=max_mean_logs,
+                    logs=logs,
+                )
 
                 # VALIDATION PER STEP: global_step is already incremented
                 # for example, if validate_every_n_steps=100, validate at step 100, 200, 300, ...
                 should_validate_step = args.validate_every_n_steps is not None and global_step % args.validate_every_n_steps == 0
-                if accelerator.sync_gradients and validation_steps > 0 and should_validate_step:
+                validating = accelerator.sync_gradients and validation_steps > 0 and should_validate_step
+                if step_metrics.should_flush() or validating:
+                    flush_step_metrics()
+
+                if validating:
+                    profiler.begin("validation")
                     optimizer_eval_fn()
                     accelerator.unwrap_model(network).eval()
                     rng_states = switch_rng_state(args.validation_seed if args.validation_seed is not None else args.seed)
@@ -1585,16 +1728,22 @@ class NetworkTrainer:
                     optimizer_train_fn()
                     accelerator.unwrap_model(network).train()
                     progress_bar.unpause()
+                    profiler.end("validation")
+
+                profiler.end_step()
 
                 if global_step >= args.max_train_steps:
                     break
 
+            flush_step_metrics()
+
             # EPOCH VALIDATION
             should_validate_epoch = (
                 (epoch + 1) % args.validate_every_n_epochs == 0 if args.validate_every_n_epochs is not None else True
             )
 
             if should_validate_epoch and len(val_dataloader) > 0:
+                profiler.begin("epoch_validation")
                 optimizer_eval_fn()
                 accelerator.unwrap_model(network).eval()
                 rng_states = switch_rng_state(args.validation_seed if args.validation_seed is not None else args.seed)
@@ -1664,6 +1813,7 @@ class NetworkTrainer:
                 optimizer_train_fn()
                 accelerator.unwrap_model(network).train()
                 progress_bar.unpause()
+                profiler.end("epoch_validation")
 
             # END OF EPOCH
             if is_tracking:
@@ -1677,6 +1827,7 @@ class NetworkTrainer:
             if args.save_every_n_epochs is not None:
                 saving = (epoch + 1) % args.save_every_n_epochs == 0 and (epoch + 1) < num_train_epochs
                 if is_main_process and saving:
+                    profiler.begin("epoch_save")
                     ckpt_name = train_util.get_epoch_ckpt_name(args, "." + args.save_model_as, epoch + 1)
                     save_model(ckpt_name, accelerator.unwrap_model(network), global_step, epoch + 1)
 
@@ -1686,14 +1837,18 @@ class NetworkTrainer:
                         remove_model(remove_ckpt_name)
 
                     if args.save_state:
-                        train_util.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1, global_step)
+                        train_util.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1, global_step, checkpoint_writer)
+                    profiler.end("epoch_save")
 
-            self.sample_images(accelerator, args, epoch + 1, global_step, accelerator.device, vae, tokenizers, text_encoder, unet)
+            with profiler.span("epoch_sample"):
+                self.sample_images(accelerator, args, epoch + 1, global_step, accelerator.device, vae, tokenizers, text_encoder, unet)
             progress_bar.unpause()
             optimizer_train_fn()
 
             # end of epoch
 
+        profiler.close()
+
         # metadata["ss_epoch"] = str(num_train_epochs)
         metadata["ss_training_finished_at"] = str(time.time())
 
@@ -1704,12 +1859,17 @@ class NetworkTrainer:
         optimizer_eval_fn()
 
         if is_main_process and (args.save_state or args.save_state_on_train_end):
-            train_util.save_state_on_train_end(args, accelerator, global_step)
+            train_util.save_state_on_train_end(args, accelerator, global_step, checkpoint_writer)
 
         if is_main_process:
             ckpt_name = train_util.get_last_ckpt_name(args, "." + args.save_model_as)
             save_model(ckpt_name, network, global_step, num_train_epochs, force_sync_upload=True)
 
+        if checkpoint_writer is not None:
+            logger.info("waiting for checkpoints to be written / チェックポイントの書き込みを待機しています")
+            checkpoint_writer.close()
+
+        if is_main_process:
             logger.info("model saved.")
 
 
@@ -1882,6 +2042,63 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="Max number of validation dataset items processed. By default, validation will run the entire validation dataset / 処理される検証データセット項目の最大数。デフォルトでは、検証は検証データセット全体を実行します",
     )
+    parser.add_argument(
+        "--profile_steps",
+        action="store_true",
+        help="record the time of each phase of the training steps, output a Chrome trace and JSONL summaries to output_dir/profile"
+        " / 学習ステップの各フェーズの時間を記録し、Chromeトレースと JSONL のサマリを output_dir/profile に出力する",
+    )
+    parser.add_argument(
+        "--profile_summary_every",
+        type=int,
+        default=100,
+        help="steps per profile summary / プロファイルのサマリを出力するステップ間隔",
+    )
+    parser.add_argument(
+        "--profile_sync",
+        action="store_true",
+        help="synchronize the device at the end of each profiled phase for accurate GPU times (slows down training)"
+        " / 正確なGPU時間のため、プロファイルの各フェーズの終わりにデバイスを同期する（学習が遅くなる）",
+    )
+    parser.add_argument(
+        "--flat_network_params",
+        action="store_true",
+        help="allocate the network parameters and gradients in a few contiguous buffers, so the optimizer step, gradient"
+        " clipping and zeroing run on whole buffers. the optimizer sees one 1-D parameter per buffer: optimizers depending on"
+        " the parameter shapes (e.g. factored Adafactor) behave differently"
+        " / ネットワークのパラメータと勾配を少数の連続したバッファに割り当て、オプティマイザのステップ、勾配のクリッピング、"
+        "ゼロ化をバッファ全体で実行する。オプティマイザからはバッファごとに1次元のパラメータに見えるため、パラメータの形状に"
+        "依存するオプティマイザ（factored Adafactor など）は動作が変わる",
+    )
+    parser.add_argument(
+        "--metrics_sync_every",
+        type=int,
+        default=1,
+        help="copy the loss and norms from the device every N steps instead of every step, the progress bar and the logs are"
+        " updated in batches. they are always synchronized before validation and at the end of each epoch (default: 1)"
+        " / N ステップごとに loss とノルムをデバイスからコピーする。プログレスバーとログはまとめて更新される。"
+        "検証の前と各エポックの終わりには常に同期する（デフォルト: 1）",
+    )
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="write checkpoints and states in a background thread, training continues after taking a CPU snapshot"
+        " / チェックポイントと state をバックグラウンドのスレッドで書き込む。CPU へのスナップショット後に学習を続行する",
+    )
+    parser.add_argument(
+        "--async_save_max_pending",
+        type=int,
+        default=2,
+        help="max number of saves waiting to be written with --async_save, limits the memory used by snapshots (default: 2)"
+        " / --async_save で書き込み待ちにできる保存の最大数。スナップショットのメモリ使用量を制限する（デフォルト: 2）",
+    )
+    parser.add_argument(
+        "--async_save_staging_dir",
+        type=str,
+        default=None,
+        help="local directory where states are saved before being moved to output_dir with --async_save, system temp dir by default"
+        " / --async_save で state を output_dir に移動する前に保存するローカルディレクトリ。デフォルトはシステムの一時ディレクトリ",
+    )
     return parser
 
 
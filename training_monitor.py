@@ -259,8 +259,17 @@ class CheckpointManager:
         # Look for state directories (epoch states, step states, or last state)
         state_dirs = []
 
+        # A save interrupted while replacing a state leaves the previous state at <state>.old - move it back
+        for item in self.output_dir.glob('*.old'):
+            target = item.with_name(item.name[:-len('.old')])
+            if item.is_dir() and not target.exists():
+                logger.warning(f"Restoring interrupted state save: {item.name} -> {target.name}")
+                item.rename(target)
+
         # Pattern: <name>-state or <name>-<epoch>-state or <name>-step-<step>-state
         for item in self.output_dir.iterdir():
+            if item.suffix in ('.tmp', '.old'):
+                continue  # staging or previous copy of a state being replaced
             if item.is_dir() and 'state' in item.name.lower():
                 # Only include checkpoints that pass validation
                 if self.validate_checkpoint(item):